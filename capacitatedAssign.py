@@ -0,0 +1,220 @@
+import numpy as np
+import costEngine
+
+# Capacitated assignment of supply to hubs with storage limits.
+#
+# assignHubsToGridCells sends every cell to its nearest hub, so one hub can
+# take any amount of supply. Here the supply of the cells is routed to the
+# open hubs as a min-cost flow (a transportation problem): minimize
+#   sum over cells c and hubs h of distance(c, h) * flow(c, h)
+# with all supply of every cell shipped and at most capacity(h) kg per hub. A
+# cell may be split over several hubs. Demand does not use storage capacity
+# and stays with the nearest open hub.
+#
+# Algorithm: with only a few open hubs the residual graph is collapsed onto the
+# hubs - moving kg of cell c from hub g to hub h costs d(c, h) - d(c, g), so the
+# edge g -> h costs the minimum of that over the cells currently at g.
+#   1. start from the previous flow (warm start, cells of closed hubs go to
+#      their nearest open hub) or from the nearest-hub assignment
+#   2. cancel negative cycles (only needed after a warm start)
+#   3. push the excess of overloaded hubs along shortest paths (Bellman-Ford
+#      over the hubs) to hubs with spare capacity
+# The result is an optimal flow; infeasible hub sets (total capacity below
+# total supply) raise InfeasibleError.
+#
+# usage:
+#   assigner = CapacitatedAssigner(data.supply, data.cost_matrix, capacity)
+#   flow = assigner.assign(hubIndex) # (cells, nHubs) kg, warm-started from the previous call
+#   calcCostEffectivenessCapacitated(hubIndex, data.supply, data.demand, data.pPerSqm, data.cost_matrix, assigner)
+
+
+class InfeasibleError(ValueError):
+    pass
+
+
+# ---------- CAPACITY ----------
+def capacityFromArea(haBruto, usableShare=1.0, storageCoef=costEngine.storageCoefLong):
+    '''kg of supply a site can store per year, from its gross area in ha (HA_BRUTO in IBIS).'''
+    return np.asarray(haBruto, dtype=float) * 10000 * usableShare / storageCoef
+
+
+def candidateCapacity(candiInfo, ibis, column='HA_BRUTO', usableShare=1.0):
+    '''Capacity per candidate, joining the IBIS area column on RIN_NUMMER (unknown sites are uncapacitated).'''
+    area = candiInfo[['RIN_NUMMER']].merge(ibis[['RIN_NUMMER', column]].drop_duplicates('RIN_NUMMER'),
+                                           on='RIN_NUMMER', how='left')[column].to_numpy(dtype=float)
+    return np.where(np.isnan(area), np.inf, capacityFromArea(area, usableShare))
+
+
+# ---------- HUB GRAPH ----------
+def bellmanFord(edgeCost, start, eps=1e-9):
+    '''Shortest distances over the hub graph from the hubs where start is True.
+
+    Returns (dist, pred, cycleNode): cycleNode is a hub on a negative cycle, or -1.
+    Improvements below eps (m) are ignored.
+    '''
+    nHubs = len(edgeCost)
+    dist = np.where(start, 0.0, np.inf)
+    pred = np.full(nHubs, -1, dtype=np.intp)
+    for _ in range(nHubs):
+        through = dist[:, None] + edgeCost
+        best = np.argmin(through, axis=0)
+        candidate = through[best, np.arange(nHubs)]
+        better = candidate < dist - eps
+        if not better.any():
+            return dist, pred, -1
+        dist[better] = candidate[better]
+        pred[better] = best[better]
+    return dist, pred, int(np.flatnonzero(better)[0])
+
+
+class CapacitatedAssigner:
+    def __init__(self, supply, cost_matrix, capacity):
+        self.supply = np.asarray(supply, dtype=float)
+        self.cost_matrix = cost_matrix
+        self.capacity = np.asarray(capacity, dtype=float)
+        self.tol = 1e-9 * max(self.supply.sum(), 1)
+        self.hubIndex = None
+        self.flow = None
+        self.augmentations = 0
+        self.cyclesCancelled = 0
+
+    # ---------- START ----------
+    def _startFlow(self, hubIndex, dists, warmStart):
+        nCells, nHubs = dists.shape
+        flow = np.zeros((nCells, nHubs))
+        atNearest = np.ones(nCells, dtype=bool)
+        if warmStart and self.hubIndex is not None:
+            # keep the flow to hubs that are still open
+            previous = {hub: j for j, hub in enumerate(self.hubIndex)}
+            for j, hub in enumerate(hubIndex):
+                if hub in previous:
+                    flow[:, j] = self.flow[:, previous[hub]]
+            atNearest = flow.sum(axis=1) < self.supply - self.tol
+        nearest = np.argmin(dists, axis=1)
+        rows = np.flatnonzero(atNearest)
+        np.add.at(flow, (rows, nearest[rows]), self.supply[rows] - flow[rows].sum(axis=1))
+        return flow
+
+    # ---------- RESIDUAL GRAPH ----------
+    def _edges(self, dists, flow, hubs):
+        # cheapest way to move kg out of each hub in hubs, per target hub
+        for g in hubs:
+            cells = np.flatnonzero(flow[:, g] > self.tol)
+            if len(cells) == 0:
+                self.edgeCost[g] = np.inf
+                continue
+            moveCost = dists[cells] - dists[cells, g][:, None]
+            best = np.argmin(moveCost, axis=0)
+            self.edgeCost[g] = moveCost[best, np.arange(dists.shape[1])]
+            self.edgeCell[g] = cells[best]
+            self.edgeCost[g, g] = np.inf
+
+    def _push(self, dists, flow, path, amount):
+        # path: hubs [g0, g1, ..., gk]; every step moves kg of the edge's cell
+        for g, h in zip(path[:-1], path[1:]):
+            cell = self.edgeCell[g, h]
+            flow[cell, g] -= amount
+            flow[cell, h] += amount
+            flow[cell, g] = max(flow[cell, g], 0.0)
+        self._edges(dists, flow, set(path))
+
+    def _bottleneck(self, flow, path):
+        return min(flow[self.edgeCell[g, h], g] for g, h in zip(path[:-1], path[1:]))
+
+    # ---------- SOLVE ----------
+    def assign(self, hubIndex, warmStart=True):
+        '''Return the optimal flow (cells, nHubs) of supply kg to the hubs in hubIndex.'''
+        hubIndex = np.asarray(hubIndex, dtype=np.intp)
+        capacity = self.capacity[hubIndex]
+        if self.supply.sum() > capacity.sum() + self.tol:
+            raise InfeasibleError('total capacity {:.6g} below total supply {:.6g}'.format(
+                capacity.sum(), self.supply.sum()))
+        dists = np.asarray(self.cost_matrix[:, hubIndex], dtype=float)
+        nHubs = len(hubIndex)
+        flow = self._startFlow(hubIndex, dists, warmStart)
+        self.edgeCost = np.full((nHubs, nHubs), np.inf)
+        self.edgeCell = np.zeros((nHubs, nHubs), dtype=np.intp)
+        self._edges(dists, flow, range(nHubs))
+
+        # cancel negative cycles left over from the warm start; a hub with spare
+        # capacity reaches any hub at cost 0 through the sink (its load grows,
+        # the other one's shrinks)
+        while True:
+            spare = capacity - flow.sum(axis=0) > self.tol
+            cycleCost = self.edgeCost.copy()
+            viaSink = spare[:, None] & (cycleCost > 0)
+            cycleCost[viaSink] = 0.0
+            np.fill_diagonal(cycleCost, np.inf)
+            _, pred, node = bellmanFord(cycleCost, np.ones(nHubs, dtype=bool))
+            if node < 0:
+                break
+            for _ in range(nHubs): # step back onto the cycle
+                node = pred[node]
+            cycle = [node] # followed backwards: pred[x] -> x is an edge
+            while pred[cycle[-1]] != node:
+                cycle.append(pred[cycle[-1]])
+            path = [node] + cycle[:0:-1] + [node]
+            steps = list(zip(path[:-1], path[1:]))
+            load = flow.sum(axis=0)
+            amount = min(capacity[g] - load[g] if viaSink[g, h] else flow[self.edgeCell[g, h], g]
+                         for g, h in steps)
+            for g, h in steps:
+                if not viaSink[g, h]:
+                    cell = self.edgeCell[g, h]
+                    flow[cell, g] = max(flow[cell, g] - amount, 0.0)
+                    flow[cell, h] += amount
+            self._edges(dists, flow, set(path))
+            self.cyclesCancelled += 1
+
+        # move the excess of overloaded hubs along shortest paths
+        while True:
+            load = flow.sum(axis=0)
+            excess = load - capacity
+            if not (excess > self.tol).any():
+                break
+            dist, pred, _ = bellmanFord(self.edgeCost, excess > self.tol)
+            spare = np.where(-excess > self.tol, dist, np.inf)
+            target = int(np.argmin(spare))
+            if not np.isfinite(spare[target]):
+                raise InfeasibleError('no path from the overloaded hubs to spare capacity')
+            path = [target]
+            while not excess[path[-1]] > self.tol:
+                path.append(pred[path[-1]])
+            path = path[::-1]
+            amount = min(excess[path[0]], -excess[target], self._bottleneck(flow, path))
+            self._push(dists, flow, path, amount)
+            self.augmentations += 1
+
+        self.hubIndex, self.flow = hubIndex, flow
+        return flow
+
+    def stats(self):
+        return {'augmentations': self.augmentations, 'cyclesCancelled': self.cyclesCancelled}
+
+
+# ---------- EVALUATION ----------
+def evaluateHubsCapacitated(hubIndex, supply, demand, pPerSqm, cost_matrix, assigner, transport=None):
+    '''The four components (see costEngine.calcComponents) with supply routed by assigner.'''
+    hubIndex = np.asarray(hubIndex, dtype=np.intp)
+    nCandi = cost_matrix.shape[1]
+    flow = assigner.assign(hubIndex)
+    dists = np.asarray(cost_matrix[:, hubIndex], dtype=float)
+    cellHub, cellDist = costEngine.assignCells(hubIndex, cost_matrix)
+
+    hubSupply = np.zeros(nCandi)
+    np.add.at(hubSupply, hubIndex, flow.sum(axis=0))
+    hubDemand = np.bincount(cellHub, weights=demand, minlength=nCandi)
+    # supply load per (cell, hub) of the flow, demand load at the nearest hub
+    hubLoad = np.bincount(cellHub, weights=cellDist * costEngine.transportWeights(0, demand, transport),
+                          minlength=nCandi)
+    np.add.at(hubLoad, hubIndex, (dists * costEngine.transportWeights(flow, 0, transport)).sum(axis=0))
+    return costEngine.calcComponents(hubIndex, hubSupply, hubDemand, hubLoad, pPerSqm, transport)
+
+
+def calcCostEffectivenessCapacitated(hubIndex, supply, demand, pPerSqm, cost_matrix, assigner, transport=None):
+    '''Cost effectiveness with capacitated assignment; inf when the hubs cannot store all supply.'''
+    try:
+        components = evaluateHubsCapacitated(hubIndex, supply, demand, pPerSqm, cost_matrix, assigner, transport)
+    except InfeasibleError:
+        return np.inf
+    return costEngine.costEffectivenessFromComponents(*components)
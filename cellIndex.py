@@ -0,0 +1,161 @@
+import numpy as np
+
+# Working set of infoGrid cells for the objective.
+#
+# Cells without supply and without demand add nothing to any component, yet
+# every evaluation assigns them a hub. activeCells lists the cells that matter
+# and CompressedProblemData keeps only their rows of the cost matrix, which is
+# exact. An in-memory matrix is copied row-wise in its own dtype; a memory-mapped
+# one (a .cmx store or an .npy file) is not copied at all: RowSubset reads the
+# rows from it on every access, so e.g. a uint16 store stays on disk.
+#
+# Optionally, nearby active cells are merged into weighted points: cells in the
+# same radius x radius bin whose cost matrix rows differ by at most tol (for
+# every candidate) share the row of their first cell, the leader. The distance
+# of every merged cell to any hub is then off by at most tol. A merged point
+# carries the summed kg, so with the kg transport model the transport load is
+# off by at most tol times the merged kg (the trip model rounds trips up per
+# point instead of per cell).
+#
+# usage:
+#   active = CompressedProblemData(data) # drop-in for ProblemData, exact
+#   clustered = CompressedProblemData(data, tol=100, radius=300)
+#   costEngine.calcCostEffectivenessArrays(hubIndex, clustered.supply, ...)
+
+
+# ---------- ACTIVE CELLS ----------
+def activeCells(supply, demand):
+    '''Indexes of the cells with supply or demand.'''
+    return np.flatnonzero((np.asarray(supply) > 0) | (np.asarray(demand) > 0))
+
+
+class RowSubset:
+    '''Some rows of a cost matrix, read lazily from it.
+
+    Indexes like the matrix of just these rows; values come from the source on
+    every access (dequantized by a store), nothing is copied up front.
+    '''
+    ndim = 2
+
+    def __init__(self, source, rows):
+        self.source = source
+        self.rows = np.asarray(rows, dtype=np.intp)
+        self.shape = (len(self.rows), source.shape[1])
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        rows, cols = key if isinstance(key, tuple) else (key, slice(None))
+        rows = self.rows[rows]
+        if isinstance(key, tuple) and isinstance(key[0], slice) and not isinstance(cols, slice) and np.ndim(cols) == 1:
+            # [:, hubIndex] selects a block, not pairs of (row, column)
+            rows = rows[:, None]
+        return np.asarray(self.source[rows, cols])
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[:, :], dtype=dtype)
+
+
+def selectRows(cost_matrix, rows):
+    # memory-mapped matrices are read lazily, in-memory ones keep their dtype
+    if isinstance(cost_matrix, np.ndarray) and not isinstance(cost_matrix, np.memmap):
+        return cost_matrix[rows]
+    return RowSubset(cost_matrix, rows)
+
+
+def maxRowDistance(cost_matrix, cells, others, chunkSize=4096):
+    # largest |row of cells[i] - row of others[i]|, read in chunks
+    maxDist = 0.0
+    for start in range(0, len(cells), chunkSize):
+        a = np.asarray(cost_matrix[cells[start:start + chunkSize]], dtype=float)
+        b = np.asarray(cost_matrix[others[start:start + chunkSize]], dtype=float)
+        with np.errstate(invalid='ignore'):
+            diff = np.abs(a - b)
+        diff[a == b] = 0 # both unreachable
+        maxDist = max(maxDist, float(diff.max()))
+    return maxDist
+
+
+# ---------- CLUSTERING ----------
+def clusterCells(coords, rows, tol, radius):
+    '''Merge cells into points; return (labels, leaders).
+
+    coords and rows (cost matrix rows) are those of the cells to merge. labels
+    gives the point of every cell, leaders the cell whose row each point uses.
+    Within every radius bin cells join the first leader whose row is within tol.
+    '''
+    bins = np.floor(np.asarray(coords) / radius).astype(np.int64)
+    _, binOf = np.unique(bins, axis=0, return_inverse=True)
+    binOf = binOf.ravel()
+    labels = np.empty(len(coords), dtype=np.intp)
+    leaders = []
+    for cells in np.split(np.argsort(binOf, kind='stable'), np.flatnonzero(np.diff(np.sort(binOf))) + 1):
+        binLeaders = []
+        for cell in cells:
+            for point in binLeaders:
+                if np.max(np.abs(rows[cell] - rows[leaders[point]])) <= tol:
+                    labels[cell] = point
+                    break
+            else:
+                labels[cell] = len(leaders)
+                binLeaders.append(len(leaders))
+                leaders.append(cell)
+    return labels, np.array(leaders, dtype=np.intp)
+
+
+class CompressedProblemData:
+    '''The active cells of a ProblemData, optionally merged into weighted points.
+
+    cellIndex holds the original infoGrid row of every point (of its leader
+    when merged) and pointOf maps every active cell to its point.
+    '''
+    def __init__(self, data, tol=None, radius=None):
+        self.region = getattr(data, 'region', None)
+        self.dataDir = getattr(data, 'dataDir', 'data')
+        self.pPerSqm = data.pPerSqm
+        self.candiCoords = data.candiCoords
+        self.nCellsOriginal = data.nCells
+        self.active = activeCells(data.supply, data.demand)
+        supply, demand = data.supply[self.active], data.demand[self.active]
+
+        if tol is None:
+            self.pointOf = np.arange(len(self.active))
+            leaders = self.pointOf
+        else:
+            rows = RowSubset(data.cost_matrix, self.active)
+            self.pointOf, leaders = clusterCells(data.gridCoords[self.active], rows, tol, radius or tol)
+        nPoints = len(leaders)
+        self.cellIndex = self.active[leaders]
+        self.gridCoords = data.gridCoords[self.cellIndex]
+        self.cost_matrix = selectRows(data.cost_matrix, self.cellIndex)
+        self.supply = np.bincount(self.pointOf, weights=supply, minlength=nPoints)
+        self.demand = np.bincount(self.pointOf, weights=demand, minlength=nPoints)
+        # largest distance error of a merged cell (0 without clustering)
+        merged = np.flatnonzero(leaders[self.pointOf] != np.arange(len(self.active)))
+        self.maxDistError = maxRowDistance(data.cost_matrix, self.active[merged], self.cellIndex[self.pointOf[merged]])
+
+    @property
+    def nCells(self):
+        return len(self.supply)
+
+    @property
+    def nCandi(self):
+        return len(self.pPerSqm)
+
+    def expand(self, values, fill=np.nan):
+        '''Spread per-point values (e.g. the assigned hub) back over all infoGrid cells.'''
+        values = np.asarray(values)
+        full = np.full(self.nCellsOriginal, fill, dtype=np.result_type(values, np.asarray(fill)))
+        full[self.active] = values[self.pointOf]
+        return full
+
+    def stats(self):
+        return {
+            'cells': self.nCellsOriginal,
+            'activeCells': len(self.active),
+            'points': self.nCells,
+            'compression': self.nCellsOriginal / max(self.nCells, 1),
+            'maxDistError': self.maxDistError,
+        }
+
@@ -1,29 +1,85 @@
-from geovoronoi import voronoi_regions_from_coords
 import numpy as np
-import pandas as pd
 import geopandas as gpd
-from shapely.geometry import Polygon
-import time
-
-# ---------- READ REQUIRED FILES ---------- 
-# input that remains constant at each iteration, prepped in dataPrep.ipynb
-candiInfo = gpd.read_file('data/candiInfo_ams.shp')
-infoGrid = gpd.read_file('data/infoGrid_ams.shp')
-cost_matrix = np.load('data/costMatrix_ams.npy')
-
-# modify column names
-infoGrid = infoGrid.rename(columns={'totKgDeman': 'totKgDemand', 
-                        'totKgSuppl': 'totKgSupply'})
+import costEngine
+from problemData import loadProblemData
+from cellIndex import CompressedProblemData
+from sliceCache import SliceCache
+from objectiveCache import MemoizedObjective
+
+# ---------- REQUIRED DATA ---------- 
+# input that remains constant at each iteration, prepped in dataPrep.ipynb.
+# Loaded lazily on first use and memoized per region (see problemData.py), 
+# so importing / source_python-ing this file does not read anything. 
+defaultRegion = 'ams' # study area used when no region is passed
+# transport priced per kg and km (None) or per vehicle trip, e.g. costEngine.tripTransport(capacity=12000)
+transportModel = None
+
+# evaluate on the cells with supply or demand only (exact, see cellIndex.py)
+useActiveCells = True
+activeData = {}
+
+def getEvaluationData(region=None): 
+    region = region or defaultRegion
+    if not useActiveCells: 
+        return loadProblemData(region)
+    if region not in activeData: 
+        activeData[region] = CompressedProblemData(loadProblemData(region))
+    return activeData[region]
+
+# assignments of hub sets evaluated before, per region and useActiveCells, also used 
+# for sets one swap away (see sliceCache.py) - call sliceCacheStats() to see how often 
+# spsann reuses them
+useSliceCache = True
+sliceCacheMaxBytes = 256 * 2**20
+sliceCaches = {}
+
+def getSliceCache(region=None): 
+    region = region or defaultRegion
+    # assignments of the active-cell data do not fit the full grid and vice versa
+    key = (region, useActiveCells)
+    if key not in sliceCaches: 
+        sliceCaches[key] = SliceCache(getEvaluationData(region).cost_matrix, sliceCacheMaxBytes)
+    return sliceCaches[key]
+
+def sliceCacheStats(region=None): 
+    return getSliceCache(region).stats()
+
+# objective values of hub sets evaluated before, per region (see objectiveCache.py) 
+# set objectiveCachePath (e.g. 'results/objectiveCache.sqlite') to reuse values across runs, 
+# call objectiveCacheReport() at the end of a run for the hit rate
+useObjectiveCache = True
+objectiveCacheMaxSize = 100000
+objectiveCachePath = None
+objectiveCaches = {}
+
+def getObjectiveCache(region=None): 
+    region = region or defaultRegion
+    if region not in objectiveCaches: 
+        objectiveCaches[region] = MemoizedObjective(
+            lambda hubIndex: calcCostEffectivenessHubIndex(hubIndex, region), 
+            objectiveCacheMaxSize, objectiveCachePath, namespace=objectiveNamespace(region))
+    return objectiveCaches[region]
+
+def objectiveNamespace(region): 
+    # persisted values of different input data and transport models must not mix
+    namespace = '{}-{}'.format(region, loadProblemData(region).dataTag())
+    if transportModel is None:
+        return namespace
+    return '{}-trips-{capacity}-{year}'.format(namespace, **transportModel)
+
+def objectiveCacheReport(region=None): 
+    objectiveCache = getObjectiveCache(region)
+    objectiveCache.flush()
+    return objectiveCache.report()
 
 # --------- ASSIGN HUBS TO INFOGRID CELLS ---------
-def assignHubsToGridCells(points, infoGrid): 
-    def findHub(infoGrid_index): 
-        points_index = [int(x) for x in list(points.hubName)]
-        dists = cost_matrix[infoGrid_index, points_index]
-        idxmin = np.argmin(dists)
-        chosenPoint = points_index[idxmin]
-        return chosenPoint
-    infoGrid['hubName'] = infoGrid.index.map(lambda x: findHub(x))
+def assignHubsToGridCells(points, infoGrid, cost_matrix=None): 
+    if cost_matrix is None: 
+        cost_matrix = loadProblemData(defaultRegion).cost_matrix
+    # read only the columns of the open hubs, then pick the nearest hub per cell
+    points_index = [int(x) for x in list(points.hubName)]
+    dists = cost_matrix[np.ix_(infoGrid.index.to_numpy(), points_index)]
+    infoGrid['hubName'] = np.array(points_index)[np.argmin(dists, axis=1)]
     return infoGrid 
 
 # ---------- CALCULATE CO2 REDUCTION ------------- 
@@ -84,122 +140,93 @@ def calcTotStorageCost(points, infoGrid_hubsAssigned, candiInfo):
     return totStorageCost
 
 
-# ---------- CALCULATE TRANSPORTATION COSTS ------------- 
-def calcTotTransportationCost(points, infoGrid_hubsAssigned, cost_matrix): 
-    
-    # calculate transportation cost for one hub
-    def calcTransportationCost(hubName):
-        infoHub = infoGrid_hubsAssigned[infoGrid_hubsAssigned.hubName == hubName]
-        
-        # see data/transportation/tansCostPerKm_middelStukgoed.csv 
-        euroPerKm = 1.55 # cost per km of transporting 12 tonnes of material 
-        euroPerKmPerKg = 1.55 / 12 / 1000
-        transPriceCoef = euroPerKmPerKg
-
-        # find locations of demand and supply 
-        hubDemand = infoHub[infoHub.totKgDemand > 0]
-        hubSupply = infoHub[infoHub.totKgSupply > 0]
-
-        # calc totDist and matKg for supply and demand 
-        # cost_matrix[origin (clients), destination (facilities)]
-        totDistSupply = cost_matrix[hubSupply.index, hubName].sum()
-        matKgSupply = infoGrid_hubsAssigned.totKgSupply.sum() 
-        # is currently just sum of totKgSupply, without taking into account each trip 
-        totDistDemand = cost_matrix[hubDemand.index, hubName].sum()
-        matKgDemand = infoGrid_hubsAssigned.totKgDemand.sum()
-
-        # calc transportation cost 
-        transportationCost = transPriceCoef * (totDistSupply * matKgSupply + totDistDemand * matKgDemand)
-        transportationCost
-
-        return transportationCost
-    
-    # sum transportation emissions all hubs
-    points['transCost'] = points.hubName.map(lambda x: calcTransportationCost(x))
-    totTransCost = points.transCost.sum()
-    return totTransCost
-
+# ---------- CALCULATE TRANSPORTATION COSTS AND EMISSIONS ------------- 
+def calcTotTransportation(points, infoGrid_hubsAssigned, cost_matrix, transport=None): 
+    # returns (totTransCost, totTransEmissions), both from the same load per hub:
+    # sum over the hub's cells of distance * kg (or vehicle trips, see costEngine.tripTransport) 
+    priceCoef, emissionsCoef = costEngine.transportCoefs(transport)
 
-# ---------- CALCULATE TRANSPORTATION EMISSIONS ------------- 
-def calcTotTransportationEmissions(points, infoGrid_hubsAssigned, cost_matrix): 
-    
-    # calculate transportation emissions for one hub 
-    def calcTransportationEmissions(hubName): 
+    # calculate transportation load for one hub 
+    def calcTransportationLoad(hubName): 
         infoHub = infoGrid_hubsAssigned[infoGrid_hubsAssigned.hubName == hubName]
-        
-        # incorporating transEmissionsCoef
-        KgCo2PerKm = 0.5243 # kg CO2 emissions per km of 16t of material 
-        TonsCo2PerKm = KgCo2PerKm / 1000 
-        transEmissionsCoef = TonsCo2PerKm / 16000 
-
-        # find locations of demand and supply 
-        hubDemand = infoHub[infoHub.totKgDemand > 0]
-        hubSupply = infoHub[infoHub.totKgSupply > 0]
-        
-        # calc totDist and matKg for supply and demand 
-        # cost_matrix[origin (clients), destination (facilities)]
-        totDistSupply = cost_matrix[list(hubSupply.index), hubName].sum()
-        matKgSupply = infoGrid_hubsAssigned.totKgSupply.sum() 
-        # is currently just sum of totKgSupply, without taking into account each trip 
-        totDistDemand = cost_matrix[hubDemand.index, hubName].sum()
-        matKgDemand = infoGrid_hubsAssigned.totKgDemand.sum()
+        # cost_matrix[origin (clients), destination (facilities)], in m 
+        dists = cost_matrix[infoHub.index.to_numpy(), hubName]
+        weights = costEngine.transportWeights(infoHub.totKgSupply.to_numpy(dtype=float), 
+                                              infoHub.totKgDemand.to_numpy(dtype=float), transport)
+        return dists @ weights
+
+    # sum transportation cost and emissions of all hubs
+    points['transLoad'] = points.hubName.map(calcTransportationLoad)
+    points['transCost'] = priceCoef * points.transLoad
+    points['transEmissions'] = emissionsCoef * points.transLoad
+    return points.transCost.sum(), points.transEmissions.sum()
 
-        # calculate transportation emissions 
-        transportationEmissions = transEmissionsCoef * (totDistSupply * matKgSupply + totDistDemand * matKgDemand)
-        # TODO: better model this - see comments on calcTransportationCost
 
-        return transportationEmissions
+# ---------- CALCULATE COST EFFECTIVENESS ------------- 
+def calcTotCostEffectiveness(pointsArray, region=None): 
+    # pointsArray: [id, x, y] per hub, as passed by spsann
+    # -1 because index in R starts at 1, not 0
+    hubIndex = np.asarray(pointsArray)[:, 0].astype(int) - 1
+    if useObjectiveCache: 
+        return getObjectiveCache(region)(hubIndex)
+    return calcCostEffectivenessHubIndex(hubIndex, region)
+
+
+def calcTotCostEffectivenessBatch(solutions, region=None, indexBase=1): 
+    # solutions: K x nHubs array of candiInfo indexes, one solution per row 
+    # (1-based like the spsann point ids by default, use indexBase=0 from Python)
+    # returns K cost effectiveness values from one call, so the R <-> Python 
+    # conversion and the Python overhead are paid once per batch
+    solutions = np.atleast_2d(np.asarray(solutions)).astype(int) - indexBase
+    if useObjectiveCache: 
+        return getObjectiveCache(region).evaluateMany(
+            solutions, lambda unseen: calcCostEffectivenessBatchHubIndex(unseen, region))
+    return calcCostEffectivenessBatchHubIndex(solutions, region)
+
+
+def calcCostEffectivenessBatchHubIndex(solutions, region=None): 
+    data = getEvaluationData(region)
+    return costEngine.calcCostEffectivenessBatch(
+        solutions, data.supply, data.demand, data.pPerSqm, data.cost_matrix, transport=transportModel)
+
+
+def calcCostEffectivenessHubIndex(hubIndex, region=None): 
+    # hubIndex: 0-based candiInfo indexes of the open hubs
+    data = getEvaluationData(region)
+
+    # assignment, per-hub aggregation and all four sub-components in one pass
+    sliceCache = getSliceCache(region) if useSliceCache else None
+    totCo2Reduction, totStorageCost, totTransCost, totTransEmissions = costEngine.evaluateHubs(
+        hubIndex, data.supply, data.demand, data.pPerSqm, data.cost_matrix, sliceCache, transportModel)
 
-    # sum transportation emissions all hubs
-    points['transEmissions'] = points.hubName.map(lambda x: calcTransportationEmissions(x))
-    totTransEmissions = points.transEmissions.sum()
-    return totTransEmissions
+    # calculate cost effectiveness 
+    costEffectiveness = (totStorageCost + totTransCost) / (totCo2Reduction - totTransEmissions)
+    return costEffectiveness 
 
 
-# ---------- CALCULATE COST EFFECTIVENESS ------------- 
-def calcTotCostEffectiveness(pointsArray): 
+def calcTotCostEffectiveness_perHub(pointsArray, region=None): 
+    # reference implementation using the per-hub functions above 
+    # (slow - kept to check the vectorized engine against)
+    data = loadProblemData(region or defaultRegion)
+    infoGrid = data.infoGrid.copy()
+    candiInfo = data.candiInfo
+    cost_matrix = data.cost_matrix
     
-    timeStart = time.time() 
     # make points gdf   
     points = gpd.GeoDataFrame(
             pointsArray, geometry=gpd.points_from_xy(pointsArray[:,1], pointsArray[:,2]), 
             crs='EPSG:28992'
         ).rename(columns={0: 'hubName', 1: 'x', 2: 'y'})
     points.hubName = points.hubName.map(lambda x: int(x)-1) # -1 because index in R starts at 1, not 0
-    timePoints = time.time()
 
     # assign hubs to grid cells 
-    infoGrid_hubsAssigned = assignHubsToGridCells(points, infoGrid)
-    timeAssignHubs = time.time()
+    infoGrid_hubsAssigned = assignHubsToGridCells(points, infoGrid, cost_matrix)
 
     # calculate sub-components
     totCo2Reduction = calcTotCo2Reduction(points, infoGrid_hubsAssigned)
-    timeCo2 = time.time()
     totStorageCost = calcTotStorageCost(points, infoGrid_hubsAssigned, candiInfo)
-    timeStorage = time.time()
-    totTransCost = calcTotTransportationCost(points, infoGrid_hubsAssigned, cost_matrix)
-    timeTransCost = time.time() 
-    totTransEmissions = calcTotTransportationEmissions(points, infoGrid_hubsAssigned, cost_matrix)
-    timeTransEmissions = time.time()
+    totTransCost, totTransEmissions = calcTotTransportation(points, infoGrid_hubsAssigned, cost_matrix, transportModel)
 
     # calculate cost effectiveness 
     costEffectiveness = (totStorageCost + totTransCost) / (totCo2Reduction - totTransEmissions)
-    timeCostEff = time.time()
-    
-    # print('''
-    # points: {}
-    # assign hubs: {}
-    # co2: {}
-    # storage: {}
-    # transCost: {}
-    # transEmiss: {}
-    # '''.format(
-    #     timePoints - timeStart, 
-    #     timeAssignHubs - timePoints, 
-    #     timeCo2 - timeAssignHubs, 
-    #     timeStorage - timeCo2, 
-    #     timeTransCost - timeStorage, 
-    #     timeTransEmissions - timeTransCost 
-    # ))
-            
     return costEffectiveness 
@@ -0,0 +1,194 @@
+import numpy as np
+
+# NumPy evaluation engine for the cost effectiveness objective.
+# Works on plain arrays (hub indexes, supply, demand, land price, cost matrix)
+# and computes all four sub-components of calcTotCostEffectiveness in one pass,
+# instead of re-filtering infoGrid once per hub for every component.
+
+# ---------- COEFFICIENTS -------------
+# see costEffectiveness.py for where these numbers come from
+co2Emissions = 50 # dummy number - tons of CO2eq emissions associated per kg of wood
+
+def calcStorCoef(kgPerM3, percLogistics, throughPut):
+    kg = kgPerM3 * 3 * (12/throughPut) # kg stored per m3
+    storCoef = (1+(percLogistics/100)) / kg
+    return storCoef
+
+# sqm required to store 1 kg of material for 1 year
+storageCoefLong = calcStorCoef(kgPerM3=600, percLogistics=30, throughPut=36)
+storageCoefShort = calcStorCoef(kgPerM3=600, percLogistics=30, throughPut=3)
+
+# see data/transportation/tansCostPerKm_middelStukgoed.csv
+transPriceCoef = 1.55 / 12 / 1000 # euro per km per kg (1.55 euro per km for 12 tonnes)
+transEmissionsCoef = 0.5243 / 1000 / 16000 # tons CO2 per km per kg (0.5243 kg CO2 per km for 16 tonnes)
+metersPerKm = 1000 # the cost matrix holds network distances in m
+tariffPath = 'data/transportation/transCostPerKm_middelStukgoed.csv'
+
+
+# ---------- TRANSPORT MODELS -------------
+# Transport load = sum over cells of distance (km) to the assigned hub times the
+# cell's weight; cost and emissions are both a coefficient times that load.
+#   kg model (transport=None) - weight = kg of supply plus demand of the cell
+#   trip model                - weight = vehicle trips, ceil(kg / capacity) for
+#                               supply and for demand, priced per vehicle km
+def tripTransport(capacity=12000, year=None, path=tariffPath, kgCo2PerKm=0.5243):
+    '''Per-vehicle trip model with the tariff (euro per km) of year, the latest year by default.'''
+    import pandas as pd
+    tariffs = pd.read_csv(path, sep=';', encoding='utf-8-sig').set_index('Date').costPerKm
+    year = tariffs.index.max() if year is None else year
+    return {'capacity': capacity, 'year': int(year), 'priceCoef': float(tariffs[year]),
+            'emissionsCoef': kgCo2PerKm / 1000}
+
+
+def transportWeights(supply, demand, transport=None):
+    '''Load per m of cost matrix distance for every cell.'''
+    if transport is None:
+        return (supply + demand) / metersPerKm
+    capacity = transport['capacity']
+    return (np.ceil(supply / capacity) + np.ceil(demand / capacity)) / metersPerKm
+
+
+def transportCoefs(transport=None):
+    '''(euro, tons CO2) per unit of load.'''
+    if transport is None:
+        return transPriceCoef, transEmissionsCoef
+    return transport['priceCoef'], transport['emissionsCoef']
+
+
+# --------- ASSIGN HUBS TO INFOGRID CELLS ---------
+def assignCells(hubIndex, cost_matrix):
+    '''Return (cellHub, cellDist): nearest open hub of every cell and the distance to it.'''
+    hubIndex = np.asarray(hubIndex, dtype=np.intp)
+    dists = np.asarray(cost_matrix[:, hubIndex])
+    nearest = np.argmin(dists, axis=1) # ties go to the first hub, as in assignHubsToGridCells
+    cellHub = hubIndex[nearest]
+    cellDist = dists[np.arange(len(nearest)), nearest]
+    return cellHub, cellDist
+
+
+# ---------- PER-HUB AGGREGATES -------------
+def aggregateHubs(cellHub, cellDist, supply, demand, nCandi, weights):
+    '''Sum supply, demand and transport load (cellDist * weights) per candidate (length nCandi arrays).'''
+    hubSupply = np.bincount(cellHub, weights=supply, minlength=nCandi)
+    hubDemand = np.bincount(cellHub, weights=demand, minlength=nCandi)
+    hubLoad = np.bincount(cellHub, weights=cellDist * weights, minlength=nCandi)
+    return hubSupply, hubDemand, hubLoad
+
+
+# ---------- COMPONENTS FROM AGGREGATES -------------
+def calcComponents(hubIndex, hubSupply, hubDemand, hubLoad, pPerSqm, transport=None):
+    '''Return (totCo2Reduction, totStorageCost, totTransCost, totTransEmissions).
+
+    The aggregates are indexed by candidate; every entry of hubIndex is counted
+    once, so a hub listed twice is counted twice, like the per-hub functions do.
+    Batched: with hubIndex of shape (K, nHubs) and aggregates of shape
+    (K, nCandi) each component is an array of K values.
+    '''
+    hubIndex = np.asarray(hubIndex, dtype=np.intp)
+    def atHubs(aggregate):
+        return np.take_along_axis(aggregate, hubIndex, axis=-1)
+    supplyHub = atHubs(hubSupply)
+    demandHub = atHubs(hubDemand)
+
+    # co2 reduction - all supply is stored
+    totCo2Reduction = co2Emissions * supplyHub.sum(axis=-1)
+
+    # storage cost - surplus is stored long, the rest short
+    matKgStoredLong = np.maximum(supplyHub - demandHub, 0)
+    matKgStoredShort = np.minimum(supplyHub, demandHub)
+    totStorageCost = (pPerSqm[hubIndex] * (storageCoefLong * matKgStoredLong +
+                                           storageCoefShort * matKgStoredShort)).sum(axis=-1)
+
+    # transportation - cost and emissions from the same load
+    priceCoef, emissionsCoef = transportCoefs(transport)
+    transLoad = atHubs(hubLoad).sum(axis=-1)
+    totTransCost = priceCoef * transLoad
+    totTransEmissions = emissionsCoef * transLoad
+
+    return totCo2Reduction, totStorageCost, totTransCost, totTransEmissions
+
+
+def costEffectivenessFromComponents(totCo2Reduction, totStorageCost, totTransCost, totTransEmissions):
+    return (totStorageCost + totTransCost) / (totCo2Reduction - totTransEmissions)
+
+
+# ---------- SINGLE-PASS EVALUATION -------------
+def evaluateHubs(hubIndex, supply, demand, pPerSqm, cost_matrix, sliceCache=None, transport=None):
+    '''Evaluate a set of open hubs (0-based candiInfo indexes) in one pass.
+
+    Returns the four components, in the order of calcComponents. With a
+    sliceCache (see sliceCache.py) the assignment is served from the cache;
+    transport selects the transport model (kg model by default).
+    '''
+    hubIndex = np.asarray(hubIndex, dtype=np.intp)
+    if sliceCache is not None:
+        cellHub, cellDist = sliceCache.assignCells(hubIndex)
+    else:
+        cellHub, cellDist = assignCells(hubIndex, cost_matrix)
+    aggregates = aggregateHubs(cellHub, cellDist, supply, demand, cost_matrix.shape[1],
+                               transportWeights(supply, demand, transport))
+    return calcComponents(hubIndex, *aggregates, pPerSqm, transport)
+
+
+def calcCostEffectivenessArrays(hubIndex, supply, demand, pPerSqm, cost_matrix, sliceCache=None, transport=None):
+    return costEffectivenessFromComponents(
+        *evaluateHubs(hubIndex, supply, demand, pPerSqm, cost_matrix, sliceCache, transport))
+
+
+# ---------- BATCH EVALUATION -------------
+batchMaxBytes = 8 * 2**20 # size of the (solutions, cells) distance block per chunk
+
+def assignCellsBatch(solutions, cost_matrix):
+    '''Return (cellHub, cellDist) of shape (K, cells) for K solutions of shape (K, nHubs).
+
+    Every candidate column used by any solution is read once. The nearest hub is
+    found with a running minimum over the hub positions (ties go to the first
+    hub, as in assignCells), which avoids a (K, cells, nHubs) block in memory.
+    '''
+    columns, inverse = np.unique(solutions, return_inverse=True)
+    inverse = inverse.reshape(solutions.shape)
+    distsT = np.ascontiguousarray(np.asarray(cost_matrix[:, columns], dtype=float).T) # (columns, cells)
+    cellDist = distsT[inverse[:, 0]]
+    nearest = np.zeros(cellDist.shape, dtype=np.intp)
+    closer = np.empty(cellDist.shape, dtype=bool)
+    for j in range(1, solutions.shape[1]):
+        dists = distsT[inverse[:, j]]
+        np.less(dists, cellDist, out=closer)
+        np.copyto(cellDist, dists, where=closer)
+        nearest[closer] = j
+    cellHub = np.take_along_axis(solutions, nearest, axis=1)
+    return cellHub, cellDist
+
+
+def evaluateHubsBatch(solutions, supply, demand, pPerSqm, cost_matrix, maxBytes=batchMaxBytes, transport=None):
+    '''Evaluate K solutions (array of shape (K, nHubs), 0-based indexes) at once.
+
+    Returns the four components as arrays of K values.
+    '''
+    solutions = np.atleast_2d(np.asarray(solutions, dtype=np.intp))
+    nSolutions = len(solutions)
+    nCells, nCandi = cost_matrix.shape
+    chunkSize = max(1, int(maxBytes // (nCells * 8)))
+    weights = transportWeights(supply, demand, transport)
+    components = [np.empty(nSolutions) for _ in range(4)]
+    for start in range(0, nSolutions, chunkSize):
+        chunk = solutions[start:start + chunkSize]
+        k = len(chunk)
+        cellHub, cellDist = assignCellsBatch(chunk, cost_matrix)
+
+        # aggregate per (solution, candidate) with a single bincount over flat indexes
+        flat = (cellHub + np.arange(k)[:, None] * nCandi).ravel()
+        def perSolution(values):
+            return np.bincount(flat, weights=np.broadcast_to(values, cellHub.shape).ravel(),
+                               minlength=k * nCandi).reshape(k, nCandi)
+        aggregates = (perSolution(supply), perSolution(demand), perSolution(cellDist * weights))
+        chunkComponents = calcComponents(chunk, *aggregates, pPerSqm, transport)
+        for component, values in zip(components, chunkComponents):
+            component[start:start + k] = values
+    return tuple(components)
+
+
+def calcCostEffectivenessBatch(solutions, supply, demand, pPerSqm, cost_matrix, maxBytes=batchMaxBytes,
+                               transport=None):
+    return costEffectivenessFromComponents(
+        *evaluateHubsBatch(solutions, supply, demand, pPerSqm, cost_matrix, maxBytes, transport))
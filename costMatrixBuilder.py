@@ -0,0 +1,311 @@
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import os
+import time
+import xml.etree.ElementTree as ET
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import dijkstra
+from costMatrixStore import CostMatrixStore, createCostMatrix
+
+# Road network cost matrix builder, replacing makeCostMatrix in dataPrep.ipynb
+# (spaghetti.Network + allneighbordistances in one step).
+#
+# * the road graph (graphml with mm_len lengths, or an edges shapefile) is
+#   loaded into a scipy CSR matrix
+# * grid cells and candidates are snapped to the nearest point on the nearest
+#   edge, like spaghetti.snapobservations; the network distance between two
+#   snapped points goes through either end of their edges (or straight along
+#   the edge when both are on the same one)
+# * candidates are processed in chunks by worker processes; each chunk runs
+#   scipy.sparse.csgraph.dijkstra from the edge ends of its candidates, a few
+#   sources at a time, keeping only the distances to the edge ends of the grid
+#   cells. Chunk and source block sizes follow from the node and cell counts
+#   so a worker stays within about workerMaxBytes
+# * uint16 stores without a scale get one from an upper bound of the
+#   distances: the bounding box diagonal times maxDetour (a longer distance
+#   raises, see costMatrixStore.quantize)
+# * finished columns go straight into a .cmx store (see costMatrixStore.py) and
+#   are recorded in a <store>.progress.npy mask, so an interrupted build resumes
+#   with the missing columns only
+#
+# usage:
+#   python costMatrixBuilder.py --region ams --workers 8
+#   buildCostMatrix(graph, gridCoords, candiCoords, 'data/costMatrix_nl.cmx')
+
+workerMaxBytes = 512 * 2**20 # dijkstra rows and distance blocks per worker
+maxChunkSize = 64
+maxDetour = 3.0 # network distance / bounding box diagonal assumed for uint16 scales
+
+
+# ---------- ROAD GRAPH ----------
+class RoadGraph:
+    '''Undirected road graph: node coordinates and edges (u, v, length) with their geometry.'''
+    def __init__(self, nodeCoords, u, v, length, lines):
+        self.nodeCoords = np.asarray(nodeCoords, dtype=float)
+        self.u = np.asarray(u, dtype=np.intp)
+        self.v = np.asarray(v, dtype=np.intp)
+        self.length = np.asarray(length, dtype=float)
+        self.lines = lines # shapely LineStrings, used for snapping
+
+    @property
+    def nNodes(self):
+        return len(self.nodeCoords)
+
+    def csr(self):
+        # both directions, the shortest of parallel edges
+        rows = np.concatenate([self.u, self.v])
+        cols = np.concatenate([self.v, self.u])
+        lengths = np.concatenate([self.length, self.length])
+        order = np.lexsort((lengths, cols, rows))
+        rows, cols, lengths = rows[order], cols[order], lengths[order]
+        first = np.ones(len(rows), dtype=bool)
+        first[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+        keep = first & (rows != cols)
+        return sparse.csr_matrix((lengths[keep], (rows[keep], cols[keep])), shape=(self.nNodes, self.nNodes))
+
+
+def readGraphml(path, lengthAttribute='mm_len'):
+    '''Road graph from a graphml file with node ids "(x, y)" and a LINESTRING geometry per edge.'''
+    import shapely.wkt
+    ns = {'g': 'http://graphml.graphdrawing.org/xmlns'}
+    root = ET.parse(path).getroot()
+    keys = {k.get('attr.name'): k.get('id') for k in root.findall('g:key', ns)}
+    graph = root.find('g:graph', ns)
+    nodeIndex = {}
+    nodeCoords = []
+    for node in graph.findall('g:node', ns):
+        nodeIndex[node.get('id')] = len(nodeCoords)
+        nodeCoords.append([float(x) for x in node.get('id').strip('()').split(',')])
+    u, v, length, lines = [], [], [], []
+    for edge in graph.findall('g:edge', ns):
+        data = {d.get('key'): d.text for d in edge.findall('g:data', ns)}
+        line = shapely.wkt.loads(data[keys['geometry']])
+        u.append(nodeIndex[edge.get('source')])
+        v.append(nodeIndex[edge.get('target')])
+        length.append(float(data[keys[lengthAttribute]]) if keys.get(lengthAttribute) in data else line.length)
+        lines.append(line)
+    return RoadGraph(nodeCoords, u, v, length, lines)
+
+
+def readEdges(path, lengthColumn='mm_len', precision=3):
+    '''Road graph from an edges shapefile; nodes are the line ends (rounded to precision m).'''
+    import geopandas as gpd
+    edges = gpd.read_file(path).explode(index_parts=False)
+    lines = list(edges.geometry)
+    ends = np.array([[line.coords[0], line.coords[-1]] for line in lines]).reshape(-1, 2)
+    nodeCoords, inverse = np.unique(np.round(ends, precision), axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1, 2)
+    length = edges[lengthColumn].to_numpy(dtype=float) if lengthColumn in edges else edges.geometry.length.to_numpy()
+    return RoadGraph(nodeCoords, inverse[:, 0], inverse[:, 1], length, lines)
+
+
+def readGraph(path):
+    return readGraphml(path) if path.endswith('.graphml') else readEdges(path)
+
+
+# ---------- SNAPPING ----------
+def snapPoints(graph, coords):
+    '''Snap points to the nearest edge: return (edge, distance to u, distance to v, snap distance).
+
+    Distances along the edge are scaled to the edge length of the graph.
+    '''
+    import shapely
+    tree = shapely.STRtree(graph.lines)
+    points = shapely.points(np.asarray(coords, dtype=float))
+    _, edge = tree.query_nearest(points, return_distance=False, all_matches=False)
+    lines = np.array(graph.lines, dtype=object)[edge]
+    position = shapely.line_locate_point(lines, points) / np.maximum(shapely.length(lines), 1e-12)
+    toU = position * graph.length[edge]
+    return edge, toU, graph.length[edge] - toU, shapely.distance(points, lines)
+
+
+# ---------- MEMORY ----------
+def chunkSizes(nNodes, nClients, maxBytes=workerMaxBytes):
+    '''(candidates per chunk, dijkstra sources per call) for a worker budget of maxBytes.
+
+    A quarter of the budget goes to the dense (sources, nodes) dijkstra output,
+    the rest to the per-chunk rows over the client edge ends and the
+    (clients, chunk) distance blocks.
+    '''
+    sourceBlock = max(1, maxBytes // 4 // (8 * nNodes))
+    targets = min(nNodes, 2 * nClients)
+    bytesPerColumn = 8 * (4 * targets + 4 * nClients)
+    chunkSize = int(np.clip(3 * maxBytes // 4 // bytesPerColumn, 1, maxChunkSize))
+    return chunkSize, sourceBlock
+
+
+def distanceBound(graph, gridCoords, candiCoords, snapDist=0.0):
+    '''Upper bound of the network distances, used as maxDist for uint16 stores.'''
+    coords = np.vstack([graph.nodeCoords, gridCoords, candiCoords])
+    return float(np.hypot(*(coords.max(axis=0) - coords.min(axis=0)))) * maxDetour + snapDist
+
+
+# ---------- COLUMNS (runs in the workers) ----------
+_worker = {}
+
+def clientTargets(u, v, cEdge):
+    '''Nodes at the ends of the clients' edges and the position of every client's u and v among them.'''
+    nodes, inverse = np.unique(np.concatenate([u[cEdge], v[cEdge]]), return_inverse=True)
+    inverse = inverse.ravel()
+    return nodes, inverse[:len(cEdge)], inverse[len(cEdge):]
+
+
+def initWorker(csrParts, nNodes, u, v, clients, facilities, sourceBlock):
+    data, indices, indptr = csrParts
+    _worker['graph'] = sparse.csr_matrix((data, indices, indptr), shape=(nNodes, nNodes))
+    _worker['u'], _worker['v'] = u, v
+    _worker['clients'], _worker['facilities'] = clients, facilities
+    _worker['targets'], _worker['sourceBlock'] = clientTargets(u, v, clients[0]), sourceBlock
+
+
+def computeColumns(columns, graph=None, u=None, v=None, clients=None, facilities=None, targets=None,
+                   sourceBlock=None):
+    '''Network distances from every client to the facilities in columns, shape (clients, columns).'''
+    if graph is None:
+        graph, u, v = _worker['graph'], _worker['u'], _worker['v']
+        clients, facilities = _worker['clients'], _worker['facilities']
+        targets, sourceBlock = _worker['targets'], _worker['sourceBlock']
+    cEdge, cToU, cToV, cSnap = clients
+    fEdge, fToU, fToV, fSnap = facilities
+    fEdge, fToU, fToV = fEdge[columns], fToU[columns], fToV[columns]
+    nodes, cU, cV = clientTargets(u, v, cEdge) if targets is None else targets
+    # dijkstra from the edge ends of this chunk, a block of sources at a time,
+    # keeping only the distances to the clients' edge ends
+    sources, inverse = np.unique(np.concatenate([u[fEdge], v[fEdge]]), return_inverse=True)
+    inverse = inverse.ravel()
+    sourceBlock = sourceBlock or len(sources)
+    fromSources = np.empty((len(sources), len(nodes)))
+    for start in range(0, len(sources), sourceBlock):
+        block = sources[start:start + sourceBlock]
+        fromSources[start:start + len(block)] = dijkstra(graph, directed=False, indices=block)[:, nodes]
+    fromU, fromV = fromSources[inverse[:len(columns)]], fromSources[inverse[len(columns):]]
+    # facility -> client edge ends, through either end of the facility's edge
+    toNodes = np.minimum(fToU[:, None] + fromU, fToV[:, None] + fromV) # (columns, nodes)
+    del fromSources, fromU, fromV
+    # -> client, through either end of the client's edge
+    dists = np.minimum(cToU[:, None] + toNodes[:, cU].T, cToV[:, None] + toNodes[:, cV].T)
+    # client and facility on the same edge
+    same = cEdge[:, None] == fEdge[None, :]
+    dists = np.where(same, np.minimum(dists, np.abs(cToU[:, None] - fToU[None, :])), dists)
+    if cSnap is not None:
+        dists = dists + cSnap[:, None] + fSnap[None, columns]
+    return dists
+
+
+# ---------- BUILD ----------
+def progressPath(storePath):
+    return storePath + '.progress.npy'
+
+
+def readProgress(storePath, nCols):
+    path = progressPath(storePath)
+    if os.path.exists(storePath) and os.path.exists(path):
+        done = np.load(path)
+        if len(done) == nCols:
+            return done
+    return np.zeros(nCols, dtype=bool)
+
+
+def writeProgress(storePath, done):
+    # write-then-rename, so an interruption never leaves a half-written mask
+    tmpPath = progressPath(storePath) + '.tmp.npy'
+    np.save(tmpPath, done)
+    os.replace(tmpPath, progressPath(storePath))
+
+
+def buildCostMatrix(graph, gridCoords, candiCoords, storePath, dtype='float32', scale=None, chunkSize=None,
+                    nWorkers=None, snapDist=False, rowIds=None, colIds=None, verbose=True, maxBytes=workerMaxBytes):
+    '''Build (or resume building) the cells x candidates network distance matrix in storePath.
+
+    snapDist adds the distance from each point to its snapped location (like
+    spaghetti's snap_dist). nWorkers=0 computes in this process. chunkSize
+    defaults to what fits maxBytes per worker (see chunkSizes). Returns the
+    store and a dict with the throughput.
+    '''
+    nRows, nCols = len(gridCoords), len(candiCoords)
+    clients = snapPoints(graph, gridCoords)
+    facilities = snapPoints(graph, candiCoords)
+    if not snapDist:
+        clients, facilities = clients[:3] + (None,), facilities[:3] + (None,)
+    csr = graph.csr()
+
+    done = readProgress(storePath, nCols)
+    if done.any():
+        store = CostMatrixStore(storePath, mode='r+')
+        if store.shape != (nRows, nCols):
+            raise ValueError('{} has shape {}, expected {}'.format(storePath, store.shape, (nRows, nCols)))
+    else:
+        maxDist = distanceBound(graph, gridCoords, candiCoords,
+                                clients[3].max() + facilities[3].max() if snapDist else 0.0)
+        store = createCostMatrix(storePath, (nRows, nCols), dtype, rowIds, colIds, maxDist=maxDist, scale=scale)
+    autoChunkSize, sourceBlock = chunkSizes(graph.nNodes, nRows, maxBytes)
+    chunkSize = chunkSize or autoChunkSize
+    todo = np.flatnonzero(~done)
+    chunks = [todo[i:i + chunkSize] for i in range(0, len(todo), chunkSize)]
+    if verbose:
+        print('{}: {} of {} candidates to compute, {} nodes, {} edges, {} candidates per chunk{}'.format(
+            storePath, len(todo), nCols, graph.nNodes, len(graph.length), chunkSize,
+            ', {:g} m per uint16 unit'.format(store.scale) if dtype == 'uint16' else ''))
+
+    timeStart = time.time()
+    computed = 0
+    def finish(columns, block):
+        nonlocal computed
+        store[:, columns] = block
+        store.flush()
+        done[columns] = True
+        writeProgress(storePath, done)
+        computed += len(columns)
+        if verbose:
+            elapsed = time.time() - timeStart
+            print('{} / {} candidates, {:.1f} candidates per second'.format(
+                done.sum(), nCols, computed / elapsed if elapsed > 0 else float('inf')))
+
+    if nWorkers == 0:
+        targets = clientTargets(graph.u, graph.v, clients[0])
+        for columns in chunks:
+            finish(columns, computeColumns(columns, csr, graph.u, graph.v, clients, facilities, targets, sourceBlock))
+    else:
+        nWorkers = nWorkers or os.cpu_count()
+        initargs = ((csr.data, csr.indices, csr.indptr), graph.nNodes, graph.u, graph.v, clients, facilities,
+                    sourceBlock)
+        with ProcessPoolExecutor(max_workers=nWorkers, initializer=initWorker, initargs=initargs) as pool:
+            maxInFlight = 2 * nWorkers
+            inFlight = {}
+            for columns in chunks + [None]:
+                if columns is not None:
+                    inFlight[pool.submit(computeColumns, columns)] = columns
+                # a bounded number of chunks queued, drain everything at the end
+                while inFlight and (len(inFlight) >= maxInFlight or columns is None):
+                    finished, _ = wait(inFlight, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        finish(inFlight.pop(future), future.result())
+
+    elapsed = time.time() - timeStart
+    return store, {'candidates': computed, 'elapsed': elapsed,
+                   'candidatesPerSecond': computed / elapsed if elapsed > 0 else float('inf')}
+
+
+if __name__ == '__main__':
+    import argparse
+    from problemData import loadProblemData
+    parser = argparse.ArgumentParser(description='Build the network cost matrix of a region into a .cmx store')
+    parser.add_argument('--region', default='ams')
+    parser.add_argument('--graph', help='graphml or edges shapefile, default data/roads/{region}_graph.graphml '
+                                        '(ams) or data/roads/nl_edges.shp (nl)')
+    parser.add_argument('--out', help='default data/costMatrix_{region}.cmx')
+    parser.add_argument('--dtype', choices=('float64', 'float32', 'uint16'), default='float32')
+    parser.add_argument('--scale', type=float, help='metres per unit for uint16, default from the bounding box')
+    parser.add_argument('--chunk', type=int, help='candidates per chunk, default from --maxMB')
+    parser.add_argument('--maxMB', type=float, default=workerMaxBytes / 2**20, help='memory per worker')
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--snapDist', action='store_true')
+    args = parser.parse_args()
+    data = loadProblemData(args.region)
+    graphPath = args.graph or ('data/roads/nl_edges.shp' if args.region == 'nl'
+                               else 'data/roads/{}_graph.graphml'.format(args.region))
+    _, res = buildCostMatrix(readGraph(graphPath), data.gridCoords, data.candiCoords,
+                             args.out or 'data/costMatrix_{}.cmx'.format(args.region), args.dtype, args.scale,
+                             args.chunk, args.workers, args.snapDist, maxBytes=int(args.maxMB * 2**20))
+    print('{} candidates in {:.1f} s ({:.1f} candidates per second)'.format(
+        res['candidates'], res['elapsed'], res['candidatesPerSecond']))
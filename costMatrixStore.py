@@ -0,0 +1,179 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+
+# Binary, memory-mapped store for the cell x candidate cost matrix.
+#
+# File layout (.cmx):
+#   8 bytes   magic b'CMXSTORE'
+#   4 bytes   header length (little-endian uint32)
+#   header    JSON: dtype, shape, scale, rowIds, colIds
+#   padding   up to a 64 byte boundary
+#   data      the matrix in column-major (Fortran) order
+#
+# Column-major order means the columns of a set of candidate hubs are
+# contiguous on disk, so cost_matrix[:, hubIndex] only touches those columns.
+#
+# dtypes:
+#   float64 - exact copy of the makeCostMatrix output
+#   float32 - half the size, ~1e-7 relative error
+#   uint16  - distances quantized to `scale` metres; 65535 marks unreachable (inf),
+#             distances beyond 65534 * scale raise instead of being clipped
+#
+# usage:
+#   writeCostMatrix('data/costMatrix_ams.cmx', matrix, dtype='float32')
+#   cost_matrix = openCostMatrix('data/costMatrix_ams.cmx')
+#   cost_matrix[:, [3, 17, 42]] # float64 array, only 3 columns read
+
+magic = b'CMXSTORE'
+alignment = 64
+dtypes = ('float64', 'float32', 'uint16')
+uint16Missing = np.iinfo(np.uint16).max
+
+
+class CostMatrixStore:
+    def __init__(self, path, mode='r'):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(magic)) != magic:
+                raise ValueError('{} is not a cost matrix store'.format(path))
+            headerLength = int(np.frombuffer(f.read(4), dtype='<u4')[0])
+            self.header = json.loads(f.read(headerLength).decode('utf-8'))
+        self.dtype = self.header['dtype']
+        self.shape = tuple(self.header['shape'])
+        self.scale = self.header['scale']
+        self.rowIds = self.header['rowIds']
+        self.colIds = self.header['colIds']
+        self.raw = np.memmap(path, dtype=self.dtype, mode=mode, offset=dataOffset(headerLength),
+                             shape=self.shape, order='F')
+
+    @property
+    def ndim(self):
+        return 2
+
+    def __len__(self):
+        return self.shape[0]
+
+    def dequantize(self, values):
+        if self.dtype == 'uint16':
+            out = values.astype(float) * self.scale
+            out[values == uint16Missing] = np.inf
+            return out
+        return np.asarray(values, dtype=float)
+
+    def quantize(self, values):
+        values = np.asarray(values, dtype=float)
+        if self.dtype == 'uint16':
+            out = np.full(values.shape, uint16Missing, dtype=np.uint16)
+            finite = np.isfinite(values)
+            units = np.rint(values[finite] / self.scale)
+            if units.size and (units.min() < 0 or units.max() > uint16Missing - 1):
+                raise ValueError('distances from {:.6g} to {:.6g} m do not fit uint16 with scale {:g} m '
+                                 '(0 to {:.6g} m)'.format(values[finite].min(), values[finite].max(), self.scale,
+                                                          (uint16Missing - 1) * self.scale))
+            out[finite] = units
+            return out
+        return values.astype(self.dtype)
+
+    def __getitem__(self, key):
+        return self.dequantize(np.asarray(self.raw[key]))
+
+    def __setitem__(self, key, values):
+        self.raw[key] = self.quantize(values)
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[:, :], dtype=dtype)
+
+    def column(self, j):
+        return self[:, j]
+
+    def flush(self):
+        self.raw.flush()
+
+
+def dataOffset(headerLength):
+    offset = len(magic) + 4 + headerLength
+    return offset + (-offset) % alignment
+
+
+# ---------- WRITING ----------
+def createCostMatrix(path, shape, dtype='float32', rowIds=None, colIds=None, maxDist=None, scale=None):
+    '''Create an empty store on disk and return it opened for writing.
+
+    For uint16 either scale (metres per unit) or maxDist (largest finite
+    distance to represent) is needed.
+    '''
+    if dtype not in dtypes:
+        raise ValueError('dtype must be one of {}'.format(dtypes))
+    nRows, nCols = shape
+    if dtype == 'uint16':
+        if scale is None:
+            if maxDist is None:
+                raise ValueError('uint16 needs scale or maxDist')
+            scale = max(1.0, float(np.ceil(maxDist / (uint16Missing - 1))))
+    else:
+        scale = 1.0
+    header = {
+        'dtype': dtype, 'shape': [int(nRows), int(nCols)], 'scale': scale,
+        'rowIds': list(range(nRows)) if rowIds is None else [int(i) for i in rowIds],
+        'colIds': list(range(nCols)) if colIds is None else [int(i) for i in colIds],
+    }
+    headerBytes = json.dumps(header).encode('utf-8')
+    offset = dataOffset(len(headerBytes))
+    with open(path, 'wb') as f:
+        f.write(magic)
+        f.write(np.array([len(headerBytes)], dtype='<u4').tobytes())
+        f.write(headerBytes)
+        f.write(b'\0' * (offset - f.tell()))
+        f.truncate(offset + nRows * nCols * np.dtype(dtype).itemsize)
+    return CostMatrixStore(path, mode='r+')
+
+
+def writeCostMatrix(path, matrix, dtype='float32', rowIds=None, colIds=None, scale=None):
+    matrix = np.asarray(matrix, dtype=float)
+    finite = matrix[np.isfinite(matrix)]
+    maxDist = finite.max() if finite.size else 1.0
+    store = createCostMatrix(path, matrix.shape, dtype, rowIds, colIds, maxDist=maxDist, scale=scale)
+    store[:, :] = matrix
+    store.flush()
+    return store
+
+
+def openCostMatrix(path):
+    return CostMatrixStore(path, mode='r')
+
+
+# ---------- CONVERSION FROM makeCostMatrix OUTPUTS ----------
+def readCostMatrixFile(path):
+    '''Return (matrix, rowIds, colIds) from a .csv (pandas, with index) or .npy file.'''
+    if path.endswith('.csv'):
+        df = pd.read_csv(path, index_col=0)
+        return df.to_numpy(dtype=float), df.index.to_numpy(), df.columns.astype(int).to_numpy()
+    if path.endswith('.npy'):
+        matrix = np.load(path)
+        return matrix, None, None
+    raise ValueError('unsupported cost matrix file: {}'.format(path))
+
+
+def convertCostMatrix(sourcePath, destPath=None, dtype='float32', scale=None):
+    if destPath is None:
+        destPath = os.path.splitext(sourcePath)[0] + '.cmx'
+    matrix, rowIds, colIds = readCostMatrixFile(sourcePath)
+    store = writeCostMatrix(destPath, matrix, dtype, rowIds, colIds, scale)
+    finite = np.isfinite(matrix)
+    maxError = np.abs(store[:, :][finite] - matrix[finite]).max() if finite.any() else 0.0
+    print('{} -> {} ({}, {} x {}, max abs error {:.3g} m)'.format(
+        sourcePath, destPath, dtype, matrix.shape[0], matrix.shape[1], maxError))
+    return store
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Convert a makeCostMatrix output (.csv/.npy) to a .cmx store')
+    parser.add_argument('source')
+    parser.add_argument('dest', nargs='?')
+    parser.add_argument('--dtype', choices=dtypes, default='float32')
+    parser.add_argument('--scale', type=float, help='metres per unit for uint16')
+    args = parser.parse_args()
+    convertCostMatrix(args.source, args.dest, args.dtype, args.scale)
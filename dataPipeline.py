@@ -0,0 +1,419 @@
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import time
+import numpy as np
+import pandas as pd
+
+# Cached data preparation, replacing the linear dataPrep.ipynb.
+#
+# The notebook steps are stages with declared inputs (upstream stages and raw
+# files) and parameters:
+#   ibis -> landPrice (kriging) -> candiInfo -\
+#   supply/demand -> potential -\               clip -> costMatrix
+#   demand -> grid (lattice) -> infoGrid -----/        /
+#   network (road graph) -----------------------------/
+# Every artifact is cached in cacheDir under a hash of the stage, its
+# parameters, the hashes of its upstream artifacts and the contents of its raw
+# files. A stage only hashes the parameters it declares, so changing e.g.
+# cell_size reruns grid, infoGrid, clip and costMatrix while the kriging is
+# reused, and changing variogramModel leaves the grid alone. ams and nl share
+# every stage before clip. The grid is an implicit lattice (see gridLattice.py),
+# points are binned into its cells without building polygons.
+#
+# Artifacts are pickled, except landPrice, a GeoTIFF like the notebook's
+# export_kde_raster, and costMatrix, a .cmx store (see costMatrixStore.py; an
+# interrupted build resumes, see costMatrixBuilder.py).
+# A stage counts as cached once its manifest ({stage}_{hash}.json, with the
+# parameters and input hashes) is written, which happens after the artifact.
+# Bump a stage's version after changing its code.
+#
+# usage:
+#   python dataPipeline.py --region ams --set cell_size=200
+#   pipeline = Pipeline('ams', params={'variogramModel': 'spherical'})
+#   candiInfo = pipeline.get('candiInfo')
+#   publish(pipeline) # data/{candiInfo_ams.shp, infoGrid_ams.csv, costMatrix_ams.cmx}, results/*.tif
+
+crs = 'EPSG:28992'
+
+rawFiles = {
+    'ibis': '../_bigData/Ibis 2021/ibis2021_fixed.shp',
+    'supply': '../_bigData/pblUrbanMiningModels/shpsCleaned/supply_NL.shp',
+    'demand': '../_bigData/pblUrbanMiningModels/shpsCleaned/demand_NL.shp',
+}
+roadGraphs = {'ams': 'data/roads/ams_graph.graphml', 'nl': 'data/roads/nl_edges.shp'}
+# xmin, ymin, xmax, ymax of the study area; None keeps the whole country
+regionBounds = {
+    'ams': [98034.63572185, 466256.83004902, 143001.39747729, 509186.04208061],
+    'nl': None,
+}
+
+defaultParams = {
+    'maxMilieu': [2, 3], # environmental categories of candidate sites
+    'variogramModel': 'exponential', # linear, power, gaussian, spherical, exponential or hole-effect
+    'krigingGridSize': 100, # kriging grid is krigingGridSize x krigingGridSize
+    'krigingNeighbours': None, # None: global pykrige kriging, else local kriging (e.g. 64 for nl)
+    'priceSampling': 'nearest', # nearest (the pixel under the site, as rasterio's sample) or bilinear
+    'minBuildYear': 1920,
+    'potentialShare': 1 / 6, # oldest share of supply, random share of demand (next 5 years)
+    'demandSeed': 42,
+    'gridBuffer': 1000, # grid covers the demand bounds plus this buffer (m)
+    'cell_size': 100,
+    'dtype': 'float32', # cost matrix store dtype
+    'snapDist': False,
+}
+
+
+# ---------- STAGE FUNCTIONS ----------
+def filterIbis(inputs, params):
+    '''IBIS work sites of the chosen environmental categories, as centroids.'''
+    import geopandas as gpd
+    ibis = gpd.read_file(inputs['files']['ibis'])
+    ibis = ibis[['RIN_NUMMER', 'HA_BRUTO', 'PLAN_FASE', 'MX_VPRIJS', # MX_VPRIJS has the most non-zero values
+                 'MILIEUZONE', 'WLOC_TYPE', 'MAX_MILIEU', 'geometry']]
+    ibis = ibis[ibis.MAX_MILIEU != 'X']
+    ibis['MAX_MILIEU'] = ibis.MAX_MILIEU.astype(int)
+    ibis = ibis[ibis.MAX_MILIEU.isin(params['maxMilieu'])]
+    ibis['geometry'] = ibis.geometry.centroid
+    return ibis.reset_index(drop=True)
+
+
+def krigeLandPrice(inputs, params, path, nWorkers=None, verbose=True):
+    '''Ordinary kriging of the known selling prices onto a regular grid, written as a GeoTIFF to path.
+
+    With krigingNeighbours every grid point is kriged from that many nearest
+    observations (localKriging.py) instead of pykrige's global system. The
+    raster has the transform of export_kde_raster in the notebook.
+    '''
+    from localKriging import exportRaster
+    landPrice = inputs['ibis']
+    landPrice = landPrice[landPrice.MX_VPRIJS > 0]
+    min_x, min_y, max_x, max_y = landPrice.total_bounds
+    XX = np.linspace(min_x, max_x, params['krigingGridSize'])
+    YY = np.linspace(min_y, max_y, params['krigingGridSize'])
+    x, y = landPrice.geometry.x.to_numpy(), landPrice.geometry.y.to_numpy()
+    values = landPrice.MX_VPRIJS.to_numpy(dtype=float)
+    if params['krigingNeighbours'] is not None:
+        from localKriging import krigeGrid
+        Z, _, _ = krigeGrid(np.column_stack([x, y]), values, XX, YY, params['variogramModel'],
+                            params['krigingNeighbours'], nWorkers=nWorkers)
+    else:
+        from pykrige.ok import OrdinaryKriging
+        OK = OrdinaryKriging(
+            x,
+            y,
+            values,
+            variogram_model=params['variogramModel'],
+            verbose=False,
+            enable_plotting=False,
+            coordinates_type='euclidean',
+        )
+        Z, _ = OK.execute('grid', XX, YY)
+    # write-then-rename, so an interruption never leaves a half-written raster
+    exportRaster(np.asarray(Z), XX, YY, path + '.tmp', proj=crs)
+    os.replace(path + '.tmp', path)
+
+
+def makeCandiInfo(inputs, params):
+    '''All filtered IBIS sites within the kriged raster, with the predicted price as pPerSqm.'''
+    from rasterSample import readRaster, pointCoords
+    ibis = inputs['ibis']
+    raster = readRaster(inputs['landPrice'])
+    x0, y0, x1, y1 = raster.bounds
+    x, y = ibis.geometry.x.to_numpy(), ibis.geometry.y.to_numpy()
+    candiInfo = ibis[(x > x0) & (x < x1) & (y > y0) & (y < y1)][['RIN_NUMMER', 'MAX_MILIEU', 'geometry']].copy()
+    candiInfo['pPerSqm'] = raster.sample(pointCoords(candiInfo), params['priceSampling'])
+    return candiInfo.reset_index(drop=True)
+
+
+def selectPotential(inputs, params):
+    '''Supply (oldest buildings) and demand (random cells) expected in the next 5 years.'''
+    import geopandas as gpd
+    supply = gpd.read_file(inputs['files']['supply']).reset_index(drop=True)
+    demand = gpd.read_file(inputs['files']['demand']).reset_index(drop=True)
+
+    supplyPot = supply[supply.buildYear > params['minBuildYear']].sort_values('buildYear', kind='stable')
+    supplyPot = supplyPot.head(int(len(supplyPot) * params['potentialShare']))
+    supplyPot = supplyPot[['wood', 'geometry']].rename(columns={'wood': 'totKgSupply'})
+
+    demandPot = demand.sample(int(len(demand) * params['potentialShare']), random_state=params['demandSeed'])
+    demandPot = demandPot[['wood', 'geometry']].rename(columns={'wood': 'totKgDemand'})
+    return {'supply': supplyPot, 'demand': demandPot}
+
+
+def makeGrid(inputs, params):
+    '''Lattice of cell_size m cells covering all demand (plus gridBuffer), as in the notebook.'''
+    import geopandas as gpd
+    from gridLattice import Lattice
+    # the bounds of the whole demand layer, not of the sampled potential
+    demand = gpd.read_file(inputs['files']['demand'])
+    xmin, ymin, xmax, ymax = demand.buffer(params['gridBuffer']).total_bounds
+    cell_size = params['cell_size']
+    nx = len(np.arange(xmin, xmax + cell_size, cell_size))
+    ny = len(np.arange(ymin, ymax + cell_size, cell_size))
+    # the notebook's cells reach from x0 - cell_size to x0 for x0 in arange(xmin, ...)
+    return Lattice(xmin - cell_size, ymin, cell_size, nx, ny)
+
+
+def pointCoords(gdf):
+    return np.column_stack([gdf.geometry.centroid.x, gdf.geometry.centroid.y])
+
+
+def makeInfoGrid(inputs, params):
+    '''Supply and demand summed per grid cell; cells with neither are dropped.'''
+    import geopandas as gpd
+    lattice = inputs['grid']
+    potential = inputs['potential']
+    demandCells, demandKg = lattice.aggregate(pointCoords(potential['demand']), potential['demand'].totKgDemand)
+    supplyCells, supplyKg = lattice.aggregate(pointCoords(potential['supply']), potential['supply'].totKgSupply)
+    cells = np.union1d(demandCells, supplyCells)
+    totKgDemand = np.zeros(len(cells))
+    totKgDemand[np.searchsorted(cells, demandCells)] = demandKg
+    totKgSupply = np.zeros(len(cells))
+    totKgSupply[np.searchsorted(cells, supplyCells)] = supplyKg
+    centroids = lattice.centroids(cells)
+    return gpd.GeoDataFrame({'index': cells, 'totKgDemand': totKgDemand, 'totKgSupply': totKgSupply},
+                            geometry=gpd.points_from_xy(centroids[:, 0], centroids[:, 1]), crs=crs)
+
+
+def clipRegion(inputs, params):
+    '''candiInfo and infoGrid within the region bounds.'''
+    candiInfo, infoGrid = inputs['candiInfo'], inputs['infoGrid']
+    if params['bounds'] is not None:
+        xmin, ymin, xmax, ymax = params['bounds']
+        candiInfo = candiInfo.cx[xmin:xmax, ymin:ymax]
+        infoGrid = infoGrid.cx[xmin:xmax, ymin:ymax]
+    return {'candiInfo': candiInfo.reset_index(drop=True), 'infoGrid': infoGrid.reset_index(drop=True)}
+
+
+def readNetwork(inputs, params):
+    from costMatrixBuilder import readGraph
+    return readGraph(inputs['files']['graph'])
+
+
+def buildCostMatrixStage(inputs, params, path, nWorkers=None, verbose=True):
+    from costMatrixBuilder import buildCostMatrix
+    clipped = inputs['clip']
+    candiInfo, infoGrid = clipped['candiInfo'], clipped['infoGrid']
+    buildCostMatrix(inputs['network'],
+                    np.column_stack([infoGrid.geometry.x, infoGrid.geometry.y]),
+                    np.column_stack([candiInfo.geometry.x, candiInfo.geometry.y]),
+                    path, dtype=params['dtype'], nWorkers=nWorkers, snapDist=params['snapDist'], verbose=verbose)
+
+
+# ---------- STAGES ----------
+class Stage:
+    '''A pipeline step.
+
+    inputs are upstream stage names, files keys of raw input files and params
+    the parameter names the stage depends on. run(inputs, params) gets the
+    upstream artifacts and inputs['files'] (the raw file paths) and returns the
+    artifact, which is pickled; with another suffix run(inputs, params, path)
+    writes the artifact to path itself.
+    '''
+    def __init__(self, name, run, inputs=(), files=(), params=(), suffix='.pkl', version=1):
+        self.name = name
+        self.run = run
+        self.inputs = tuple(inputs)
+        self.files = tuple(files)
+        self.params = tuple(params)
+        self.suffix = suffix
+        self.version = version
+
+
+stages = [
+    Stage('ibis', filterIbis, files=['ibis'], params=['maxMilieu']),
+    Stage('landPrice', krigeLandPrice, inputs=['ibis'],
+          params=['variogramModel', 'krigingGridSize', 'krigingNeighbours'], suffix='.tif', version=2),
+    Stage('candiInfo', makeCandiInfo, inputs=['ibis', 'landPrice'], params=['priceSampling']),
+    Stage('potential', selectPotential, files=['supply', 'demand'],
+          params=['minBuildYear', 'potentialShare', 'demandSeed']),
+    Stage('grid', makeGrid, files=['demand'], params=['gridBuffer', 'cell_size'], version=3),
+    Stage('infoGrid', makeInfoGrid, inputs=['grid', 'potential'], version=2),
+    Stage('clip', clipRegion, inputs=['candiInfo', 'infoGrid'], params=['bounds']),
+    Stage('network', readNetwork, files=['graph']),
+    Stage('costMatrix', buildCostMatrixStage, inputs=['clip', 'network'], params=['dtype', 'snapDist'],
+          suffix='.cmx'),
+]
+
+
+# ---------- HASHING ----------
+_fileHashes = {}
+
+def fileHash(path):
+    '''Hash of the contents of path and, for shapefiles, of its sidecar files.'''
+    stem, ext = os.path.splitext(path)
+    parts = [path]
+    if ext == '.shp':
+        parts += [stem + sidecar for sidecar in ('.dbf', '.shx', '.prj', '.cpg') if os.path.exists(stem + sidecar)]
+    h = hashlib.sha256()
+    for part in parts:
+        stat = os.stat(part)
+        key = (os.path.abspath(part), stat.st_size, stat.st_mtime_ns)
+        if key not in _fileHashes:
+            partHash = hashlib.sha256()
+            with open(part, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    partHash.update(block)
+            _fileHashes[key] = partHash.hexdigest()
+        h.update(_fileHashes[key].encode())
+    return h.hexdigest()
+
+
+# ---------- PIPELINE ----------
+class Pipeline:
+    def __init__(self, region='ams', params=None, files=None, cacheDir='data/cache', nWorkers=None, verbose=True):
+        if region not in regionBounds:
+            raise ValueError('unknown region {!r}, expected one of {}'.format(region, tuple(regionBounds)))
+        self.region = region
+        self.params = dict(defaultParams, bounds=regionBounds[region])
+        self.params.update(params or {})
+        unknown = set(params or {}) - set(self.params)
+        if unknown:
+            raise ValueError('unknown parameter(s) {}'.format(', '.join(sorted(unknown))))
+        self.files = dict(rawFiles, graph=roadGraphs[region])
+        self.files.update(files or {})
+        self.cacheDir = cacheDir
+        self.nWorkers = nWorkers # only used by landPrice and costMatrix, does not change the result
+        self.verbose = verbose
+        self.stages = {stage.name: stage for stage in stages}
+        self._keys = {}
+        self._artifacts = {}
+
+    def describe(self, name):
+        '''Everything the artifact of a stage depends on.'''
+        stage = self.stages[name]
+        return {
+            'stage': name,
+            'version': stage.version,
+            'params': {p: self.params[p] for p in stage.params},
+            'inputs': {i: self.key(i) for i in stage.inputs},
+            'files': {f: fileHash(self.files[f]) for f in stage.files},
+        }
+
+    def key(self, name):
+        if name not in self._keys:
+            text = json.dumps(self.describe(name), sort_keys=True, default=str)
+            self._keys[name] = hashlib.sha256(text.encode()).hexdigest()[:16]
+        return self._keys[name]
+
+    def path(self, name):
+        return os.path.join(self.cacheDir, '{}_{}{}'.format(name, self.key(name), self.stages[name].suffix))
+
+    def manifestPath(self, name):
+        return os.path.join(self.cacheDir, '{}_{}.json'.format(name, self.key(name)))
+
+    def isCached(self, name):
+        return os.path.exists(self.manifestPath(name)) and os.path.exists(self.path(name))
+
+    def get(self, name):
+        '''The artifact of a stage, from the cache or built (with its missing upstream stages).'''
+        if name in self._artifacts:
+            return self._artifacts[name]
+        stage = self.stages[name]
+        path = self.path(name)
+        if self.isCached(name):
+            if self.verbose:
+                print('{}: cached ({})'.format(name, path))
+        else:
+            inputs = {i: self.get(i) for i in stage.inputs}
+            inputs['files'] = {f: self.files[f] for f in stage.files}
+            params = {p: self.params[p] for p in stage.params}
+            os.makedirs(self.cacheDir, exist_ok=True)
+            if self.verbose:
+                print('{}: running'.format(name))
+            timeStart = time.time()
+            if stage.suffix == '.pkl':
+                artifact = stage.run(inputs, params)
+                # write-then-rename, so an interruption never leaves a half-written artifact
+                with open(path + '.tmp', 'wb') as f:
+                    pickle.dump(artifact, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(path + '.tmp', path)
+            else:
+                stage.run(inputs, params, path, nWorkers=self.nWorkers, verbose=self.verbose)
+            manifest = dict(self.describe(name), elapsed=time.time() - timeStart)
+            with open(self.manifestPath(name), 'w') as f:
+                json.dump(manifest, f, indent=2, default=str)
+            if self.verbose:
+                print('{}: done in {:.1f} s'.format(name, manifest['elapsed']))
+        self._artifacts[name] = self.load(name)
+        return self._artifacts[name]
+
+    def load(self, name):
+        path = self.path(name)
+        if self.stages[name].suffix != '.pkl':
+            return path # written by the stage itself (.tif raster, .cmx store)
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    def status(self):
+        '''Key and cache state of every stage, without running anything.'''
+        rows = []
+        for name in self.stages:
+            try:
+                rows.append({'stage': name, 'key': self.key(name), 'cached': self.isCached(name)})
+            except FileNotFoundError as e:
+                rows.append({'stage': name, 'key': None, 'cached': False, 'missing': e.filename})
+        return pd.DataFrame(rows)
+
+
+# ---------- OUTPUTS ----------
+def publish(pipeline, dataDir='data', resultsDir='results'):
+    '''Build the region and write the files problemData.py reads, and the land price raster.'''
+    clipped = pipeline.get('clip')
+    costMatrixPath = pipeline.get('costMatrix')
+    region = pipeline.region
+    candiInfo, infoGrid = clipped['candiInfo'], clipped['infoGrid']
+
+    candiInfo.to_file(os.path.join(dataDir, 'candiInfo_{}.shp'.format(region)))
+    infoGridCsv = pd.DataFrame({
+        'totKgSupply': infoGrid.totKgSupply.to_numpy(dtype=float),
+        'totKgDemand': infoGrid.totKgDemand.to_numpy(dtype=float),
+        'x': infoGrid.geometry.x.to_numpy(),
+        'y': infoGrid.geometry.y.to_numpy(),
+    })
+    infoGridCsv.to_csv(os.path.join(dataDir, 'infoGrid_{}.csv'.format(region)))
+    shutil.copyfile(costMatrixPath, os.path.join(dataDir, 'costMatrix_{}.cmx'.format(region)))
+    # where dataPrep.ipynb wrote it
+    os.makedirs(resultsDir, exist_ok=True)
+    shutil.copyfile(pipeline.get('landPrice'), os.path.join(
+        resultsDir, 'landPrice_pk_kriging_{}.tif'.format(pipeline.params['variogramModel'])))
+    return {'candidates': len(candiInfo), 'cells': len(infoGrid)}
+
+
+def parseParam(text):
+    name, _, value = text.partition('=')
+    try:
+        return name, json.loads(value)
+    except ValueError:
+        return name, value # plain strings, e.g. variogramModel=spherical
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Build candiInfo, infoGrid and the cost matrix of a region')
+    parser.add_argument('--region', choices=tuple(regionBounds), default='ams')
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                        help='override a parameter, e.g. cell_size=200 (JSON values); one of {}'.format(
+                            ', '.join(defaultParams)))
+    for key in rawFiles:
+        parser.add_argument('--' + key, help='default {}'.format(rawFiles[key]))
+    parser.add_argument('--graph', help='road graph, default data/roads/{region}_graph.graphml (ams) or '
+                                        'data/roads/nl_edges.shp (nl)')
+    parser.add_argument('--cacheDir', default='data/cache')
+    parser.add_argument('--dataDir', default='data')
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--stage', help='only build this stage (and what it needs)')
+    parser.add_argument('--status', action='store_true', help='show which stages are cached and exit')
+    args = parser.parse_args()
+
+    files = {key: getattr(args, key) for key in list(rawFiles) + ['graph'] if getattr(args, key)}
+    pipeline = Pipeline(args.region, dict(parseParam(p) for p in args.set), files, args.cacheDir, args.workers)
+    if args.status:
+        print(pipeline.status().to_string(index=False))
+    elif args.stage:
+        pipeline.get(args.stage)
+    else:
+        print(publish(pipeline, args.dataDir))
@@ -0,0 +1,174 @@
+import numpy as np
+import costEngine
+
+# Stateful cost effectiveness evaluator for single-hub swap moves.
+# Keeps, for every infoGrid cell, its nearest and second-nearest open hub and
+# the per-hub supply/demand/distance aggregates, so that moving one hub only
+# touches the cells whose assignment changes.
+#
+# usage (one annealing iteration):
+#   evaluator = DeltaEvaluator(hubIndex, supply, demand, pPerSqm, cost_matrix)
+#   newValue = evaluator.proposeMove(oldHub, newCandidate)
+#   evaluator.commit()   # accept
+#   evaluator.rollback() # or reject
+#
+# Ties are broken like costEngine.assignCells: the hub that comes first in
+# hubIndex wins, and a new candidate takes the position of the hub it replaces.
+
+
+# ---------- NEAREST AND SECOND-NEAREST HUB -------------
+def twoNearest(dists, hubIndex):
+    '''Return (nearestHub, nearestDist, secondHub, secondDist) for each row of dists.
+
+    dists[:, j] holds the distances to hubIndex[j]. With a single hub the second
+    hub is -1 at infinite distance.
+    '''
+    rows = np.arange(dists.shape[0])
+    first = np.argmin(dists, axis=1)
+    nearestHub, nearestDist = hubIndex[first], dists[rows, first]
+    if dists.shape[1] == 1:
+        return nearestHub, nearestDist, np.full(len(rows), -1, dtype=np.intp), np.full(len(rows), np.inf)
+    masked = dists.copy()
+    masked[rows, first] = np.inf
+    second = np.argmin(masked, axis=1)
+    return nearestHub, nearestDist, hubIndex[second], dists[rows, second]
+
+
+def beats(distA, posA, distB, posB):
+    # hub A is preferred over hub B: closer, or equally close and earlier in hubIndex
+    return (distA < distB) | ((distA == distB) & (posA < posB))
+
+
+class DeltaEvaluator:
+    def __init__(self, hubIndex, supply, demand, pPerSqm, cost_matrix, transport=None):
+        self.supply = np.asarray(supply, dtype=float)
+        self.demand = np.asarray(demand, dtype=float)
+        self.pPerSqm = np.asarray(pPerSqm, dtype=float)
+        self.cost_matrix = cost_matrix
+        self.nCandi = cost_matrix.shape[1]
+        self.transport = transport
+        self.weights = costEngine.transportWeights(self.supply, self.demand, transport)
+        self.reset(hubIndex)
+
+    # ---------- FULL (RE)EVALUATION -------------
+    def reset(self, hubIndex):
+        '''Recompute all state from scratch for the open hubs in hubIndex.'''
+        hubIndex = np.array(hubIndex, dtype=np.intp)
+        if len(np.unique(hubIndex)) != len(hubIndex):
+            raise ValueError('hubIndex contains duplicate hubs')
+        self.hubIndex = hubIndex
+        # position of each open hub in hubIndex (closed candidates and -1 rank last)
+        self.position = np.full(self.nCandi + 1, self.nCandi, dtype=np.intp)
+        self.position[hubIndex] = np.arange(len(hubIndex))
+        dists = np.asarray(self.cost_matrix[:, hubIndex], dtype=float)
+        self.cellHub, self.cellDist, self.secondHub, self.secondDist = twoNearest(dists, hubIndex)
+        self.aggregates = costEngine.aggregateHubs(
+            self.cellHub, self.cellDist, self.supply, self.demand, self.nCandi, self.weights)
+        self.costEffectiveness = self._evaluate(self.hubIndex, self.aggregates)
+        self.proposal = None
+        return self.costEffectiveness
+
+    def _evaluate(self, hubIndex, aggregates):
+        components = costEngine.calcComponents(
+            hubIndex, *aggregates, self.pPerSqm, self.transport)
+        return costEngine.costEffectivenessFromComponents(*components)
+
+    def _contributions(self, cells, dists):
+        # per-cell terms of costEngine.aggregateHubs
+        return self.supply[cells], self.demand[cells], dists * self.weights[cells]
+
+    # ---------- SWAP MOVES -------------
+    def proposeMove(self, oldHub, newCandidate):
+        '''Return the cost effectiveness after replacing oldHub by newCandidate.
+
+        The state is left unchanged until commit() is called.
+        '''
+        if self.proposal is not None:
+            raise RuntimeError('commit() or rollback() the previous proposal first')
+        if self.position[oldHub] == self.nCandi:
+            raise ValueError('hub {} is not open'.format(oldHub))
+        if self.position[newCandidate] != self.nCandi:
+            raise ValueError('candidate {} is already open'.format(newCandidate))
+        newPos = self.position[oldHub]
+        newDist = np.asarray(self.cost_matrix[:, newCandidate], dtype=float)
+
+        # cells that lose their hub go to the better of their second hub and the new one,
+        # all other cells only move if the new candidate beats their current hub
+        losesHub = self.cellHub == oldHub
+        changed = np.flatnonzero(
+            losesHub | beats(newDist, newPos, self.cellDist, self.position[self.cellHub]))
+        toNew = ~losesHub[changed] | beats(
+            newDist[changed], newPos, self.secondDist[changed], self.position[self.secondHub[changed]])
+        movedHub = np.where(toNew, newCandidate, self.secondHub[changed])
+        movedDist = np.where(toNew, newDist[changed], self.secondDist[changed])
+
+        # update the per-hub aggregates of the affected cells only
+        aggregates = [a.copy() for a in self.aggregates]
+        removed = self._contributions(changed, self.cellDist[changed])
+        added = self._contributions(changed, movedDist)
+        for aggregate, rem, add in zip(aggregates, removed, added):
+            np.subtract.at(aggregate, self.cellHub[changed], rem)
+            np.add.at(aggregate, movedHub, add)
+            aggregate[oldHub] = 0 # every cell of the closed hub has moved, drop rounding residue
+
+        hubIndex = self.hubIndex.copy()
+        hubIndex[newPos] = newCandidate
+        value = self._evaluate(hubIndex, aggregates)
+        self.proposal = {
+            'oldHub': oldHub, 'newCandidate': newCandidate, 'newPos': newPos, 'newDist': newDist,
+            'hubIndex': hubIndex, 'aggregates': aggregates, 'value': value,
+            'changed': changed, 'toNew': toNew, 'movedHub': movedHub, 'movedDist': movedDist,
+        }
+        return value
+
+    def commit(self):
+        '''Accept the pending proposal.'''
+        if self.proposal is None:
+            raise RuntimeError('no pending proposal')
+        p = self.proposal
+        oldHub, newCandidate, newDist = p['oldHub'], p['newCandidate'], p['newDist']
+        changed, toNew = p['changed'], p['toNew']
+        previousHub = self.cellHub[changed]
+        previousDist = self.cellDist[changed]
+        previousSecondHub = self.secondHub.copy()
+        previousSecondDist = self.secondDist.copy()
+
+        self.position[oldHub] = self.nCandi
+        self.position[newCandidate] = p['newPos']
+        self.hubIndex = p['hubIndex']
+        self.aggregates = p['aggregates']
+        self.costEffectiveness = p['value']
+        self.cellHub[changed] = p['movedHub']
+        self.cellDist[changed] = p['movedDist']
+
+        # second-nearest hubs
+        # - moved to the new hub from a surviving hub: the previous nearest hub
+        # - moved to the new hub from the closed hub: the previous second hub (unchanged)
+        # - moved from the closed hub to its second hub: unknown, rescan
+        # - kept its hub: the better of its second hub and the new one,
+        #   or a rescan if its second hub was the closed one
+        fromSurvivor = toNew & (previousHub != oldHub)
+        self.secondHub[changed[fromSurvivor]] = previousHub[fromSurvivor]
+        self.secondDist[changed[fromSurvivor]] = previousDist[fromSurvivor]
+        kept = np.ones(len(self.cellHub), dtype=bool)
+        kept[changed] = False
+        rescan = kept & (previousSecondHub == oldHub)
+        rescan[changed[~toNew]] = True
+        newSecond = kept & ~rescan & beats(
+            newDist, self.position[newCandidate], previousSecondDist, self.position[previousSecondHub])
+        self.secondHub[newSecond] = newCandidate
+        self.secondDist[newSecond] = newDist[newSecond]
+        rows = np.flatnonzero(rescan)
+        if len(rows) > 0:
+            dists = np.asarray(self.cost_matrix[np.ix_(rows, self.hubIndex)], dtype=float)
+            _, _, self.secondHub[rows], self.secondDist[rows] = twoNearest(dists, self.hubIndex)
+
+        self.proposal = None
+        return self.costEffectiveness
+
+    def rollback(self):
+        '''Reject the pending proposal.'''
+        if self.proposal is None:
+            raise RuntimeError('no pending proposal')
+        self.proposal = None
+        return self.costEffectiveness
@@ -0,0 +1,172 @@
+from concurrent.futures import FIRST_COMPLETED, wait
+import heapq
+import itertools
+import math
+import os
+import numpy as np
+import pandas as pd
+import costEngine
+import parallelAnnealing
+import spatialAnnealing
+from problemData import indexesToStr, loadProblemData
+
+# Streaming exhaustive enumeration of k-combinations of candidate hubs.
+#
+# Replaces optimize_enumeration in spatialOptimization.ipynb, which kept every
+# solution and score in memory and scored failures as 999999. Here:
+# * combinations come lazily from a generator, in chunks
+# * chunks are batch-evaluated (costEngine.calcCostEffectivenessBatch) in a
+#   process pool sharing the problem data (see parallelAnnealing.py), with a
+#   bounded number of chunks in flight
+# * only a top-K heap and running statistics are kept, so memory stays flat
+# * evaluations that raise or return a non-finite value are counted and
+#   reported with their error, never scored
+#
+# usage:
+#   res = enumerateTopK(3, candidates=range(20), topK=10)
+#   res['top'], res['stats'] # candiIndexes in top are 1-based, like firstGuesses_ams.csv
+
+maxErrorsKept = 10
+
+
+# ---------- COMBINATIONS ----------
+def combinationChunks(candidates, nHubs, chunkSize):
+    combinations = itertools.combinations(candidates, nHubs)
+    while True:
+        chunk = np.array(list(itertools.islice(combinations, chunkSize)), dtype=np.intp)
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+# ---------- CHUNK EVALUATION ----------
+def scoreChunk(chunk, data, transport=None):
+    '''Return (values, errors); failed rows get NaN and an entry in errors.'''
+    errors = {}
+    try:
+        values = costEngine.calcCostEffectivenessBatch(chunk, data.supply, data.demand, data.pPerSqm, data.cost_matrix,
+                                                       transport=transport)
+    except Exception:
+        # find the rows that fail one by one
+        values = np.full(len(chunk), np.nan)
+        for i, hubIndex in enumerate(chunk):
+            try:
+                values[i] = costEngine.calcCostEffectivenessArrays(
+                    hubIndex, data.supply, data.demand, data.pPerSqm, data.cost_matrix, transport=transport)
+            except Exception as e:
+                errors[i] = repr(e)
+    for i in np.flatnonzero(~np.isfinite(values)):
+        errors.setdefault(i, 'non-finite value {}'.format(values[i]))
+    return values, [(chunk[i].tolist(), error) for i, error in sorted(errors.items())]
+
+
+def summarizeChunk(chunk, topK, data, transport=None):
+    # chunk-local top-K and statistics, so only a few rows travel back to the parent
+    values, errors = scoreChunk(chunk, data, transport)
+    ok = np.isfinite(values)
+    okValues = values[ok]
+    best = np.argsort(okValues)[:topK]
+    return {
+        'top': list(zip(okValues[best].tolist(), chunk[ok][best].tolist())),
+        'count': int(ok.sum()),
+        'sum': float(okValues.sum()),
+        'sumSq': float((okValues ** 2).sum()),
+        'min': float(okValues.min()) if len(okValues) else math.inf,
+        'max': float(okValues.max()) if len(okValues) else -math.inf,
+        'failed': len(values) - int(ok.sum()),
+        'errors': errors[:maxErrorsKept],
+    }
+
+
+def summarizeChunkInWorker(chunk, topK):
+    return summarizeChunk(chunk, topK, parallelAnnealing._worker['data'], parallelAnnealing._worker['transport'])
+
+
+# ---------- RESULT ACCUMULATION ----------
+class TopK:
+    def __init__(self, k):
+        self.k = k
+        self.heap = [] # (-value, tiebreak, hubIndex): the worst kept solution is on top
+        self.counter = itertools.count()
+        self.stats = {'count': 0, 'sum': 0.0, 'sumSq': 0.0, 'min': math.inf, 'max': -math.inf, 'failed': 0}
+        self.errors = []
+
+    def add(self, summary):
+        for value, hubIndex in summary['top']:
+            item = (-value, next(self.counter), hubIndex)
+            if len(self.heap) < self.k:
+                heapq.heappush(self.heap, item)
+            elif value < -self.heap[0][0]:
+                heapq.heapreplace(self.heap, item)
+        for key in ('count', 'sum', 'sumSq', 'failed'):
+            self.stats[key] += summary[key]
+        self.stats['min'] = min(self.stats['min'], summary['min'])
+        self.stats['max'] = max(self.stats['max'], summary['max'])
+        self.errors += summary['errors'][:maxErrorsKept - len(self.errors)]
+
+    def result(self):
+        rows = sorted((-negValue, hubIndex) for negValue, _, hubIndex in self.heap)
+        top = pd.DataFrame({
+            'rank': np.arange(1, len(rows) + 1),
+            'objective': [r[0] for r in rows],
+            'candiIndexes': [indexesToStr(r[1]) for r in rows],
+        })
+        s = self.stats
+        n = s['count']
+        mean = s['sum'] / n if n else math.nan
+        stats = {
+            'evaluated': n,
+            'failed': s['failed'],
+            'mean': mean,
+            'std': math.sqrt(max(s['sumSq'] / n - mean ** 2, 0)) if n else math.nan,
+            'min': s['min'],
+            'max': s['max'],
+        }
+        return {'top': top, 'stats': stats, 'errors': self.errors}
+
+
+# ---------- ENUMERATION ----------
+def enumerateTopK(nHubs, candidates=None, topK=10, region='ams', chunkSize=2000, nWorkers=None,
+                  data=None, verbose=False, transport=None):
+    '''Evaluate all nHubs-combinations of candidates and keep the topK best.
+
+    nWorkers=0 evaluates in this process. Failed evaluations are counted in
+    stats['failed'] and the first few are listed in errors (and printed when
+    verbose). transport defaults to spatialAnnealing.defaultTransport().
+    '''
+    data = loadProblemData(region) if data is None else data
+    transport = spatialAnnealing.defaultTransport() if transport is None else transport
+    candidates = np.arange(data.nCandi) if candidates is None else np.asarray(candidates, dtype=np.intp)
+    total = math.comb(len(candidates), nHubs)
+    chunks = combinationChunks(candidates, nHubs, chunkSize)
+    best = TopK(topK)
+
+    if nWorkers == 0:
+        for chunk in chunks:
+            best.add(summarizeChunk(chunk, topK, data, transport))
+    else:
+        nWorkers = nWorkers or os.cpu_count()
+        pool, blocks = parallelAnnealing.makePool(data, nWorkers, transport)
+        try:
+            with pool:
+                maxInFlight = 2 * nWorkers
+                inFlight = set()
+                for chunk in itertools.chain(chunks, [None]):
+                    if chunk is not None:
+                        inFlight.add(pool.submit(summarizeChunkInWorker, chunk, topK))
+                    # keep a bounded number of chunks queued, drain everything at the end
+                    while inFlight and (len(inFlight) >= maxInFlight or chunk is None):
+                        finished, inFlight = wait(inFlight, return_when=FIRST_COMPLETED)
+                        for future in finished:
+                            best.add(future.result())
+                        if verbose:
+                            done = best.stats['count'] + best.stats['failed']
+                            print('{} / {} combinations ({:.1%})'.format(done, total, done / total))
+        finally:
+            parallelAnnealing.releaseBlocks(blocks)
+
+    res = best.result()
+    res['stats']['combinations'] = total
+    if verbose and res['stats']['failed']:
+        print('{} of {} evaluations failed, e.g. {}'.format(res['stats']['failed'], total, res['errors'][0]))
+    return res
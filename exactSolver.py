@@ -0,0 +1,284 @@
+import itertools
+import time
+import numpy as np
+import costEngine
+import spatialAnnealing
+from problemData import loadProblemData
+
+# Exact solvers for small and mid-size instances, as ground truth for the
+# annealer. They replace optimize_enumeration in spatialOptimization.ipynb,
+# which built all 2^n open/closed vectors and kept those with nHubs ones.
+#
+# Structure of the objective used for the bounds (see costEngine.py):
+#   costEffectiveness = (storage + a * L) / (C0 - b * L)
+#   L  = sum over cells of w_c * distance to the nearest open hub
+#        with w_c = costEngine.transportWeights (kg or trips per meter)
+#   C0 = co2Emissions * totKgSupply (every cell is assigned to exactly one hub)
+#   storage >= min open land price * (storageCoefShort * totKgSupply
+#              + (storageCoefLong - storageCoefShort) * max(totKgSupply - totKgDemand, 0))
+#   (a, b) = costEngine.transportCoefs
+# The transport model defaults to the one the annealer uses
+# (spatialAnnealing.defaultTransport), so the optima are comparable.
+# The objective grows with L and with storage, so lower bounds on both give a
+# lower bound on the objective.
+#
+# solveBranchAndBound - depth-first over k-combinations (generated lazily, in
+#                       order of candidate quality), pruning with that bound
+# solveMilp           - p-median-like MILP with closest-assignment constraints,
+#                       the ratio handled with Dinkelbach iterations (HiGHS via
+#                       scipy.optimize.milp)
+# enumerateCombinations - plain lazy enumeration of the k-combinations
+#
+# All return a dict with hubIndex (0-based candiInfo indexes) and objective.
+
+
+def cellWeights(supply, demand, transport=None):
+    return costEngine.transportWeights(supply, demand, transport)
+
+
+def storageLowerBoundFactor(supply, demand):
+    # storage >= min land price of the open hubs * this factor
+    totKgSupply, totKgDemand = supply.sum(), demand.sum()
+    return (costEngine.storageCoefShort * totKgSupply +
+            (costEngine.storageCoefLong - costEngine.storageCoefShort) * max(totKgSupply - totKgDemand, 0))
+
+
+def boundFromParts(storageLB, loadLB, co2, transport=None):
+    # works on scalars and arrays; no bound (-inf) where the denominator is not positive
+    priceCoef, emissionsCoef = costEngine.transportCoefs(transport)
+    denominator = co2 - emissionsCoef * loadLB
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bound = (storageLB + priceCoef * loadLB) / denominator
+    return np.where(denominator > 0, bound, -np.inf)
+
+
+def evaluate(hubIndex, data, transport=None):
+    return costEngine.calcCostEffectivenessArrays(hubIndex, data.supply, data.demand, data.pPerSqm, data.cost_matrix,
+                                                  transport=transport)
+
+
+# ---------- INCUMBENT ----------
+def greedyIncumbent(candidates, nHubs, data, transport=None):
+    # add the candidate that improves the objective most, one hub at a time (batch evaluated)
+    chosen = np.zeros(0, dtype=np.intp)
+    for _ in range(nHubs):
+        remaining = np.setdiff1d(candidates, chosen)
+        solutions = np.column_stack([np.repeat([chosen], len(remaining), axis=0), remaining])
+        values = costEngine.calcCostEffectivenessBatch(
+            solutions, data.supply, data.demand, data.pPerSqm, data.cost_matrix, transport=transport)
+        chosen = solutions[np.argmin(values)]
+    return chosen
+
+
+# ---------- LAZY ENUMERATION ----------
+def enumerateCombinations(nHubs, candidates=None, region='ams', data=None, transport=None):
+    '''Evaluate every k-combination of the candidates (generated lazily, nothing is stored).'''
+    data = loadProblemData(region) if data is None else data
+    transport = spatialAnnealing.defaultTransport() if transport is None else transport
+    candidates = np.arange(data.nCandi) if candidates is None else np.asarray(candidates, dtype=np.intp)
+    best, bestHubIndex, count = np.inf, None, 0
+    for combination in itertools.combinations(candidates, nHubs):
+        value = evaluate(np.array(combination), data, transport)
+        count += 1
+        if value < best:
+            best, bestHubIndex = value, np.array(combination)
+    return {'hubIndex': bestHubIndex, 'objective': best, 'evaluated': count}
+
+
+# ---------- BRANCH AND BOUND ----------
+def solveBranchAndBound(nHubs, candidates=None, region='ams', data=None, incumbent=None, timeLimit=None,
+                        transport=None):
+    '''Proven optimum over k-combinations of candidates (all candiInfo sites by default).
+
+    incumbent (a starting solution) tightens pruning from the start; without it
+    a greedy solution is used. If timeLimit (seconds) is hit, the best solution
+    so far is returned with proven=False.
+    '''
+    data = loadProblemData(region) if data is None else data
+    transport = spatialAnnealing.defaultTransport() if transport is None else transport
+    candidates = np.arange(data.nCandi) if candidates is None else np.asarray(candidates, dtype=np.intp)
+    if not 0 < nHubs <= len(candidates):
+        raise ValueError('nHubs must be between 1 and the number of candidates')
+    timeStart = time.time()
+    supply, demand = data.supply, data.demand
+    weights = cellWeights(supply, demand, transport)
+    co2 = costEngine.co2Emissions * supply.sum()
+    storageFactor = storageLowerBoundFactor(supply, demand)
+
+    # order candidates by their single-hub load, so good combinations come first
+    dists = np.asarray(data.cost_matrix[:, candidates], dtype=float)
+    order = np.argsort(weights @ dists)
+    candidates, dists = candidates[order], dists[:, order]
+    prices = data.pPerSqm[candidates]
+    m = len(candidates)
+    # best distance / price over the candidates from position i onwards
+    suffixMinDist = np.full((dists.shape[0], m + 1), np.inf)
+    suffixMinDist[:, :m] = np.minimum.accumulate(dists[:, ::-1], axis=1)[:, ::-1]
+    suffixMinPrice = np.append(np.minimum.accumulate(prices[::-1])[::-1], np.inf)
+
+    if incumbent is None:
+        incumbent = greedyIncumbent(candidates, nHubs, data, transport)
+    state = {'best': evaluate(incumbent, data, transport), 'bestHubIndex': np.asarray(incumbent),
+             'nodes': 0, 'evaluated': 0, 'pruned': 0, 'timedOut': False}
+
+    def search(chosen, nearest, minPrice, start):
+        # chosen: positions picked so far, nearest: distance per cell to the chosen hubs
+        if timeLimit is not None and time.time() - timeStart > timeLimit:
+            state['timedOut'] = True
+            return
+        state['nodes'] += 1
+        need = nHubs - len(chosen)
+        if need == 0:
+            # bound with the exact load first, full evaluation only if it can still win
+            load = weights @ nearest
+            if boundFromParts(minPrice * storageFactor, load, co2, transport) >= state['best']:
+                state['pruned'] += 1
+                return
+            hubIndex = candidates[chosen]
+            value = evaluate(hubIndex, data, transport)
+            state['evaluated'] += 1
+            if value < state['best']:
+                state['best'], state['bestHubIndex'] = value, hubIndex
+            return
+        # bounds of all children at once; any completion only adds hubs from positions after j
+        children = np.arange(start, m - need + 1)
+        childNearest = np.minimum(nearest[:, None], dists[:, children])
+        childPrice = np.minimum(minPrice, prices[children])
+        if need > 1:
+            loadLB = weights @ np.minimum(childNearest, suffixMinDist[:, children + 1])
+            priceLB = np.minimum(childPrice, suffixMinPrice[children + 1])
+        else:
+            loadLB = weights @ childNearest
+            priceLB = childPrice
+        bounds = boundFromParts(priceLB * storageFactor, loadLB, co2, transport)
+        # most promising child first; each combination is still visited once
+        for i in np.argsort(bounds, kind='stable'):
+            if bounds[i] >= state['best']:
+                state['pruned'] += 1
+                continue
+            search(chosen + [children[i]], childNearest[:, i], childPrice[i], children[i] + 1)
+            if state['timedOut']:
+                return
+
+    search([], np.full(dists.shape[0], np.inf), np.inf, 0)
+    return {
+        'hubIndex': np.sort(state['bestHubIndex']),
+        'objective': state['best'],
+        'proven': not state['timedOut'],
+        'nodes': state['nodes'],
+        'evaluated': state['evaluated'],
+        'pruned': state['pruned'],
+        'elapsed': time.time() - timeStart,
+    }
+
+
+# ---------- MILP (DINKELBACH) ----------
+def buildMilp(dists, supply, demand, nHubs, closestAssignment):
+    '''Constraint matrix for variables [y (m) | x (cells * m, cell-major) | long (m)].'''
+    from scipy import sparse
+    from scipy.optimize import LinearConstraint
+    n, m = dists.shape
+    nx = n * m
+    nVars = m + nx + m
+    xIndex = m + np.arange(nx).reshape(n, m)
+    constraints = []
+
+    # every cell is assigned to exactly one hub
+    A = sparse.csr_matrix((np.ones(nx), (np.repeat(np.arange(n), m), xIndex.ravel())), shape=(n, nVars))
+    constraints.append(LinearConstraint(A, 1, 1))
+    # only to open hubs: x_cj - y_j <= 0
+    rows = np.arange(nx)
+    A = sparse.csr_matrix((np.concatenate([np.ones(nx), -np.ones(nx)]),
+                           (np.concatenate([rows, rows]), np.concatenate([xIndex.ravel(), np.tile(np.arange(m), n)]))),
+                          shape=(nx, nVars))
+    constraints.append(LinearConstraint(A, -np.inf, 0))
+    # nHubs open
+    A = sparse.csr_matrix((np.ones(m), (np.zeros(m, dtype=int), np.arange(m))), shape=(1, nVars))
+    constraints.append(LinearConstraint(A, nHubs, nHubs))
+    # long_j >= supply_j - demand_j of the cells assigned to j
+    net = supply - demand
+    A = sparse.csr_matrix((np.concatenate([np.ones(m), -np.repeat(net, m)]),
+                           (np.concatenate([np.arange(m), np.tile(np.arange(m), n)]),
+                            np.concatenate([m + nx + np.arange(m), xIndex.ravel()]))), shape=(m, nVars))
+    constraints.append(LinearConstraint(A, 0, np.inf))
+    # closest assignment: if j is open, the cell goes to j or to a hub at least as close
+    if closestAssignment:
+        rowList, colList, valList = [], [], []
+        for c in range(n):
+            ranked = np.argsort(dists[c], kind='stable')
+            sortedDists = dists[c, ranked]
+            counts = np.searchsorted(sortedDists, sortedDists, side='right')
+            r, pos = np.nonzero(np.arange(m)[None, :] < counts[:, None])
+            rowIds = c * m + ranked[r]
+            rowList += [rowIds, c * m + ranked]
+            colList += [xIndex[c, ranked[pos]], ranked]
+            valList += [np.ones(len(r)), -np.ones(m)]
+        A = sparse.csr_matrix((np.concatenate(valList), (np.concatenate(rowList), np.concatenate(colList))),
+                              shape=(nx, nVars))
+        constraints.append(LinearConstraint(A, 0, np.inf))
+    return constraints, nVars
+
+
+def solveMilp(nHubs, candidates=None, region='ams', data=None, closestAssignment=True, timeLimit=None,
+              tol=1e-9, maxIterations=30, verbose=False, transport=None):
+    '''Optimum via MILP (needs scipy >= 1.9). Meant for mid-size candidate sets.
+
+    The ratio objective N / D is minimized with Dinkelbach's method: solve
+    min N - lambda * D, set lambda to the ratio of that solution, repeat until
+    min N - lambda * D reaches 0.
+    '''
+    from scipy.optimize import milp, Bounds
+    data = loadProblemData(region) if data is None else data
+    transport = spatialAnnealing.defaultTransport() if transport is None else transport
+    candidates = np.arange(data.nCandi) if candidates is None else np.asarray(candidates, dtype=np.intp)
+    timeStart = time.time()
+    supply, demand = data.supply, data.demand
+    weights = cellWeights(supply, demand, transport)
+    co2 = costEngine.co2Emissions * supply.sum()
+    priceCoef, emissionsCoef = costEngine.transportCoefs(transport)
+    dists = np.asarray(data.cost_matrix[:, candidates], dtype=float)
+    prices = data.pPerSqm[candidates]
+    n, m = dists.shape
+    constraints, nVars = buildMilp(dists, supply, demand, nHubs, closestAssignment)
+    integrality = np.zeros(nVars)
+    integrality[:m] = 1
+    bounds = Bounds(np.zeros(nVars), np.concatenate([np.ones(m + n * m), np.full(m, np.inf)]))
+
+    # objective parts per variable: storage (N only) and load L
+    storageX = (costEngine.storageCoefShort * prices[None, :] * supply[:, None]).ravel()
+    storageLong = (costEngine.storageCoefLong - costEngine.storageCoefShort) * prices
+    loadX = (weights[:, None] * dists).ravel()
+
+    hubIndex = greedyIncumbent(candidates, nHubs, data, transport)
+    lam = evaluate(hubIndex, data, transport)
+    iterations = 0
+    for iterations in range(1, maxIterations + 1):
+        c = np.concatenate([np.zeros(m),
+                            storageX + (priceCoef + lam * emissionsCoef) * loadX,
+                            storageLong])
+        options = {}
+        if timeLimit is not None:
+            options['time_limit'] = max(1.0, timeLimit - (time.time() - timeStart))
+        res = milp(c, integrality=integrality, bounds=bounds, constraints=constraints, options=options)
+        if res.x is None:
+            raise RuntimeError('MILP failed: {}'.format(res.message))
+        x = res.x
+        load = loadX @ x[m:m + n * m]
+        numerator = storageX @ x[m:m + n * m] + storageLong @ x[m + n * m:] + priceCoef * load
+        denominator = co2 - emissionsCoef * load
+        gap = numerator - lam * denominator
+        hubIndex = candidates[x[:m] > 0.5]
+        if verbose:
+            print('iteration {}: lambda {:.8g}, gap {:.3g}'.format(iterations, lam, gap))
+        if gap >= -tol * abs(lam * denominator):
+            break
+        lam = numerator / denominator
+
+    return {
+        'hubIndex': np.sort(hubIndex),
+        'objective': evaluate(hubIndex, data, transport),
+        'milpObjective': lam,
+        'proven': res.success and gap >= -tol * abs(lam * denominator),
+        'iterations': iterations,
+        'elapsed': time.time() - timeStart,
+    }
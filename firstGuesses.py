@@ -0,0 +1,159 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+from problemData import indexesToStr, loadProblemData
+
+# k-means first guesses for every number of hubs in one pass.
+#
+# data_firstHubLocations_kMeans.ipynb fitted a fresh, unweighted KMeans on all
+# infoGrid cells for every n and looked up the nearest candidate per cluster
+# in a loop. Here:
+# * cells are weighted by their kg (supply + demand by default), empty cells
+#   drop out
+# * k-means is run for k = 1, 2, ... with the k - 1 centres as warm start plus
+#   one new centre at the cell with the largest weighted squared distance
+# * updates are weighted mini-batch steps (Sculley 2010) on batches of
+#   batchSize cells, or plain Lloyd steps when all cells fit in one batch
+# * centres are snapped to candidates with one cKDTree query; a centre whose
+#   nearest candidate is taken gets its next nearest, so the hubs are distinct
+# The csv has the layout of data/firstGuesses_ams.csv (1-based, for R). It is
+# written to results/ by default so the tracked first guesses are not
+# overwritten; the annealing scripts read data/firstGuesses_{region}.csv.
+#
+# usage:
+#   python firstGuesses.py --region ams # results/firstGuesses_kmeans_ams.csv
+#   python firstGuesses.py --region nl --maxHubs 49 --out data/firstGuesses_nl.csv
+#   guesses = kMeansFirstGuesses(data, maxHubs=49) # {nHubs: 0-based candiInfo indexes}
+
+defaultBatchSize = 4096
+snapNeighbours = 8
+
+
+# ---------- WEIGHTS ----------
+def cellWeights(supply, demand, weights='mass'):
+    if weights == 'mass':
+        return np.asarray(supply, dtype=float) + np.asarray(demand, dtype=float)
+    if weights == 'supply':
+        return np.asarray(supply, dtype=float)
+    if weights == 'demand':
+        return np.asarray(demand, dtype=float)
+    if weights == 'none':
+        return np.ones(len(supply))
+    raise ValueError('unknown weights {!r}, expected mass, supply, demand or none'.format(weights))
+
+
+# ---------- K-MEANS ----------
+def nearestCentre(X, centres):
+    '''Nearest centre of every point and the squared distance to it.'''
+    d, nearest = cKDTree(centres).query(X)
+    return nearest, d ** 2
+
+
+def kMeansStep(X, w, centres, counts, rng, batchSize, cumulative):
+    '''One (mini-batch) update of centres in place; returns the largest centre shift.'''
+    k = len(centres)
+    if len(X) <= batchSize:
+        nearest, _ = nearestCentre(X, centres)
+        sumW = np.bincount(nearest, weights=w, minlength=k)
+        sumWX = np.column_stack([np.bincount(nearest, weights=w * X[:, i], minlength=k) for i in (0, 1)])
+        moved = sumW > 0
+        new = centres.copy()
+        new[moved] = sumWX[moved] / sumW[moved, None]
+    else:
+        batch = np.searchsorted(cumulative, rng.random(batchSize) * cumulative[-1], side='right')
+        nearest, _ = nearestCentre(X[batch], centres)
+        # cells are drawn in proportion to their weight, so each draw counts once
+        sumW = np.bincount(nearest, minlength=k).astype(float)
+        sumX = np.column_stack([np.bincount(nearest, weights=X[batch, i], minlength=k) for i in (0, 1)])
+        counts += sumW
+        moved = sumW > 0
+        new = centres.copy()
+        new[moved] += (sumX[moved] - sumW[moved, None] * centres[moved]) / counts[moved, None]
+    shift = np.sqrt(((new - centres) ** 2).sum(axis=1)).max()
+    centres[:] = new
+    return shift
+
+
+def kMeansAllK(X, w, maxHubs, batchSize=defaultBatchSize, maxIter=50, tol=1.0, seed=0):
+    '''Weighted k-means centres for k = 1..maxHubs, each warm-started from k - 1.
+
+    tol is the centre shift (m) below which a k is considered converged;
+    mini-batches stop after maxIter steps at the latest.
+    '''
+    rng = np.random.default_rng(seed)
+    cumulative = np.cumsum(w) # batches are drawn in proportion to the weights
+    centres = (w[:, None] * X).sum(axis=0, keepdims=True) / w.sum()
+    result = {1: centres.copy()}
+    for k in range(2, maxHubs + 1):
+        # new centre where the weighted squared distance to the current centres is largest
+        _, d = nearestCentre(X, centres)
+        centres = np.vstack([centres, X[np.argmax(w * d)]])
+        counts = np.zeros(k)
+        for _ in range(maxIter):
+            if kMeansStep(X, w, centres, counts, rng, batchSize, cumulative) < tol:
+                break
+        result[k] = centres.copy()
+    return result
+
+
+# ---------- SNAPPING ----------
+def snapToCandidates(centresPerK, candiCoords, neighbours=snapNeighbours):
+    '''Distinct nearest candidates for every set of centres, with one cKDTree query.'''
+    ks = sorted(centresPerK)
+    allCentres = np.vstack([centresPerK[k] for k in ks])
+    neighbours = min(neighbours, len(candiCoords))
+    _, nearest = cKDTree(candiCoords).query(allCentres, k=neighbours)
+    nearest = nearest.reshape(len(allCentres), neighbours)
+    guesses = {}
+    start = 0
+    for k in ks:
+        taken = set()
+        hubs = []
+        for options in nearest[start:start + k]:
+            hub = next((int(c) for c in options if c not in taken), None)
+            if hub is None: # all shortlisted candidates taken: nearest free one
+                free = np.setdiff1d(np.arange(len(candiCoords)), list(taken))
+                hub = int(free[np.argmin(((candiCoords[free] - allCentres[start + len(hubs)]) ** 2).sum(axis=1))])
+            taken.add(hub)
+            hubs.append(hub)
+        guesses[k] = np.array(hubs, dtype=np.intp)
+        start += k
+    return guesses
+
+
+def kMeansFirstGuesses(data, maxHubs=49, weights='mass', batchSize=defaultBatchSize, seed=0):
+    '''{nHubs: 0-based candiInfo indexes} for nHubs = 1..maxHubs.'''
+    w = cellWeights(data.supply, data.demand, weights)
+    keep = w > 0
+    centres = kMeansAllK(data.gridCoords[keep], w[keep], maxHubs, batchSize, seed=seed)
+    return snapToCandidates(centres, data.candiCoords)
+
+
+def writeFirstGuesses(guesses, path):
+    # 1-based and comma separated, like data/firstGuesses_ams.csv
+    firstGuesses = pd.DataFrame({
+        'nHubs': sorted(guesses),
+        'candiIndexes': [indexesToStr(guesses[k]) for k in sorted(guesses)],
+    })
+    firstGuesses.to_csv(path)
+    return firstGuesses
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Weighted k-means first guesses for nHubs = 1..maxHubs')
+    parser.add_argument('--region', default='ams')
+    parser.add_argument('--maxHubs', type=int, default=49)
+    parser.add_argument('--weights', choices=('mass', 'supply', 'demand', 'none'), default='mass')
+    parser.add_argument('--batchSize', type=int, default=defaultBatchSize)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', help='default results/firstGuesses_kmeans_{region}.csv')
+    args = parser.parse_args()
+    timeStart = time.time()
+    guesses = kMeansFirstGuesses(loadProblemData(args.region), args.maxHubs, args.weights, args.batchSize, args.seed)
+    out = args.out or 'results/firstGuesses_kmeans_{}.csv'.format(args.region)
+    os.makedirs(os.path.dirname(out) or '.', exist_ok=True)
+    writeFirstGuesses(guesses, out)
+    print('{} first guesses written to {} in {:.1f} s'.format(len(guesses), out, time.time() - timeStart))
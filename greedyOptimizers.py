@@ -0,0 +1,330 @@
+import time
+import numpy as np
+import costEngine
+import spatialAnnealing
+from cellIndex import CompressedProblemData
+from problemData import loadProblemData
+
+# Constructive heuristics for the cost effectiveness objective.
+#
+#   greedyAdd  - open hubs one at a time, always the candidate that gives the
+#                lowest objective
+#   greedyDrop - start with every candidate open and close the least useful
+#                hub until nHubs are left
+#   teitzBart  - vertex substitution: swap an open hub with a closed candidate
+#                while that lowers the objective
+#
+# Every step scores all candidates (or all open hubs, or all swaps of a chunk
+# of candidates) at once from the per-hub bookkeeping of GreedyState: the
+# nearest and second nearest open hub of every cell and the supply, demand and
+# storage cost per open hub. Only the hubs whose cells move change their
+# storage cost, so a move's objective is the current one plus a few per-hub
+# differences:
+#   add j      - cells closer to j than to their hub move to j
+#   drop h     - cells of h move to their second nearest hub
+#   swap h, j  - cells of h go to j or their second hub, other cells to j if
+#                it is closer
+# Gains ignore distance ties; every accepted move is re-evaluated exactly.
+# transport defaults to the model the annealer uses
+# (spatialAnnealing.defaultTransport), so greedy starts rank as it scores them.
+#
+# usage:
+#   res = optimizeGreedy(45, method='add') # greedy add + Teitz-Bart
+#   res['hubIndex'], res['objective']
+#   python greedyOptimizers.py --nHubs 49 --out data/firstGuesses_greedy_ams.csv
+
+chunkBytes = 32 * 2**20 # size of the (cells, candidates) blocks per chunk
+
+
+def storageCost(price, supply, demand):
+    # surplus is stored long, the rest short (see costEngine.calcComponents)
+    return price * (costEngine.storageCoefLong * np.maximum(supply - demand, 0) +
+                    costEngine.storageCoefShort * np.minimum(supply, demand))
+
+
+def onehot(positions, n):
+    '''(n, len(positions)) indicator matrix; negative positions are left out.'''
+    m = np.zeros((n, len(positions)))
+    ok = positions >= 0
+    m[positions[ok], np.flatnonzero(ok)] = 1.0
+    return m
+
+
+class GreedyState:
+    def __init__(self, data, hubIndex=(), transport=None):
+        self.supply = np.asarray(data.supply, dtype=float)
+        self.demand = np.asarray(data.demand, dtype=float)
+        self.pPerSqm = np.asarray(data.pPerSqm, dtype=float)
+        self.cost_matrix = data.cost_matrix
+        self.nCells, self.nCandi = self.cost_matrix.shape
+        transport = spatialAnnealing.defaultTransport() if transport is None else transport
+        self.transport = transport
+        self.weights = costEngine.transportWeights(self.supply, self.demand, transport)
+        self.priceCoef, self.emissionsCoef = costEngine.transportCoefs(transport)
+        self.co2 = costEngine.co2Emissions * self.supply.sum()
+        self.evaluated = 0
+        self.reset(hubIndex)
+
+    # ---------- BOOKKEEPING ----------
+    def reset(self, hubIndex):
+        '''Recompute the assignment and per-hub aggregates for the open hubs in hubIndex.'''
+        self.hubIndex = np.array(hubIndex, dtype=np.intp)
+        nHubs = len(self.hubIndex)
+        self.isOpen = np.zeros(self.nCandi, dtype=bool)
+        self.isOpen[self.hubIndex] = True
+        rows = np.arange(self.nCells)
+        if nHubs == 0:
+            self.pos1 = self.pos2 = np.full(self.nCells, -1)
+            self.d1 = self.d2 = np.full(self.nCells, np.inf)
+        else:
+            dists = np.asarray(self.cost_matrix[:, self.hubIndex], dtype=float)
+            self.pos1 = np.argmin(dists, axis=1)
+            self.d1 = dists[rows, self.pos1]
+            if nHubs > 1:
+                dists[rows, self.pos1] = np.inf
+                self.pos2 = np.argmin(dists, axis=1)
+                self.d2 = dists[rows, self.pos2]
+            else:
+                self.pos2, self.d2 = np.full(self.nCells, -1), np.full(self.nCells, np.inf)
+        self.prices = self.pPerSqm[self.hubIndex]
+        self.hubSupply = np.bincount(self.pos1[self.pos1 >= 0], weights=self.supply[self.pos1 >= 0],
+                                     minlength=nHubs)
+        self.hubDemand = np.bincount(self.pos1[self.pos1 >= 0], weights=self.demand[self.pos1 >= 0],
+                                     minlength=nHubs)
+        self.hubStorage = storageCost(self.prices, self.hubSupply, self.hubDemand)
+        self.storage = self.hubStorage.sum()
+        self.load = self.weights @ self.d1 if nHubs else np.inf
+        self.value = self.objective(self.storage, self.load)
+        return self.value
+
+    def objective(self, storage, load):
+        with np.errstate(invalid='ignore'):
+            value = (storage + self.priceCoef * load) / (self.co2 - self.emissionsCoef * load)
+        return np.where(np.isfinite(load), value, np.inf)
+
+    def exactValue(self, hubIndex=None):
+        hubIndex = self.hubIndex if hubIndex is None else hubIndex
+        return costEngine.calcCostEffectivenessArrays(hubIndex, self.supply, self.demand, self.pPerSqm,
+                                                      self.cost_matrix, transport=self.transport)
+
+    def chunks(self, candidates, rowsPerColumn=1):
+        size = max(1, chunkBytes // (8 * max(self.nCells, len(self.hubIndex) ** 2) * rowsPerColumn))
+        for start in range(0, len(candidates), size):
+            columns = candidates[start:start + size]
+            yield columns, np.asarray(self.cost_matrix[:, columns], dtype=float)
+
+    # ---------- MOVE VALUES ----------
+    def addValues(self, candidates):
+        '''Objective after opening each candidate (inf for open ones).'''
+        candidates = np.asarray(candidates, dtype=np.intp)
+        nHubs = len(self.hubIndex)
+        values = np.empty(len(candidates))
+        start = 0
+        for columns, D in self.chunks(candidates):
+            moves = D < self.d1[:, None] # ties stay with the open hub
+            movedSupply = self.supply @ moves
+            movedDemand = self.demand @ moves
+            # the hubs that lose cells
+            perHub = onehot(self.pos1, nHubs)
+            lostSupply = perHub @ (self.supply[:, None] * moves)
+            lostDemand = perHub @ (self.demand[:, None] * moves)
+            storage = (self.storage + (storageCost(self.prices[:, None], self.hubSupply[:, None] - lostSupply,
+                                                   self.hubDemand[:, None] - lostDemand) -
+                                       self.hubStorage[:, None]).sum(axis=0) +
+                       storageCost(self.pPerSqm[columns], movedSupply, movedDemand))
+            load = self.weights @ np.minimum(self.d1[:, None], D)
+            values[start:start + len(columns)] = np.where(self.isOpen[columns], np.inf,
+                                                          self.objective(storage, load))
+            start += len(columns)
+        self.evaluated += len(candidates)
+        return values
+
+    def pairGains(self, mask=None):
+        '''Supply and demand each (hub, second hub) pair passes on when the hub closes.
+
+        Returns (pairs, first, second, supply, demand); with mask (cells, k) only the
+        masked cells count and supply/demand are (pairs, k).
+        '''
+        ok = self.pos2 >= 0
+        pairId = np.where(ok, self.pos1 * len(self.hubIndex) + self.pos2, -1)
+        pairs, inverse = np.unique(pairId[ok], return_inverse=True)
+        cellPair = np.full(self.nCells, -1)
+        cellPair[ok] = inverse.ravel()
+        first, second = pairs // len(self.hubIndex), pairs % len(self.hubIndex)
+        perPair = onehot(cellPair, len(pairs))
+        if mask is None:
+            return pairs, first, second, perPair @ self.supply, perPair @ self.demand
+        return (pairs, first, second, perPair @ (self.supply[:, None] * mask),
+                perPair @ (self.demand[:, None] * mask))
+
+    def dropValues(self):
+        '''Objective after closing each open hub (by position in hubIndex).'''
+        nHubs = len(self.hubIndex)
+        if nHubs <= 1:
+            return np.full(nHubs, np.inf)
+        _, first, second, gainSupply, gainDemand = self.pairGains()
+        # storage change of the hubs that take over the cells
+        change = (storageCost(self.prices[second], self.hubSupply[second] + gainSupply,
+                              self.hubDemand[second] + gainDemand) - self.hubStorage[second])
+        storage = self.storage - self.hubStorage + np.bincount(first, weights=change, minlength=nHubs)
+        load = self.load + np.bincount(self.pos1, weights=self.weights * (self.d2 - self.d1), minlength=nHubs)
+        self.evaluated += nHubs
+        return self.objective(storage, load)
+
+    def swapValues(self, columns, D):
+        '''Objective after replacing each open hub (rows) by each candidate of columns.'''
+        nHubs = len(self.hubIndex)
+        perHub = onehot(self.pos1, nHubs)
+        toNew = D < self.d1[:, None] # cells that move to the candidate if their hub stays
+        toNewSecond = D < self.d2[:, None] # cells of the closed hub that go to the candidate
+        movedSupply = self.supply @ toNew
+        lostSupply = perHub @ (self.supply[:, None] * toNew)
+        lostDemand = perHub @ (self.demand[:, None] * toNew)
+        keptSupply = perHub @ (self.supply[:, None] * toNewSecond)
+        keptDemand = perHub @ (self.demand[:, None] * toNewSecond)
+
+        # every other hub loses the cells closer to the candidate ...
+        lossChange = (storageCost(self.prices[:, None], self.hubSupply[:, None] - lostSupply,
+                                  self.hubDemand[:, None] - lostDemand) - self.hubStorage[:, None])
+        storage = self.storage - self.hubStorage[:, None] + lossChange.sum(axis=0) - lossChange
+        # ... and second hubs take the cells of the closed hub that do not go to the candidate
+        if nHubs > 1:
+            _, first, second, gainSupply, gainDemand = self.pairGains(~toNewSecond)
+            leftSupply = self.hubSupply[second, None] - lostSupply[second]
+            leftDemand = self.hubDemand[second, None] - lostDemand[second]
+            correction = (storageCost(self.prices[second, None], leftSupply + gainSupply, leftDemand + gainDemand) -
+                          storageCost(self.prices[second, None], leftSupply, leftDemand))
+            storage += onehot(first, nHubs) @ correction
+        # the candidate: cells of other hubs closer to it, cells of the closed hub with it before their second
+        newSupply = movedSupply - lostSupply + keptSupply
+        newDemand = (self.demand @ toNew) - lostDemand + keptDemand
+        storage += storageCost(self.pPerSqm[columns], newSupply, newDemand)
+
+        nearest = np.minimum(self.d1[:, None], D)
+        load = (self.weights @ nearest) + perHub @ (self.weights[:, None] * (np.minimum(self.d2[:, None], D) - nearest))
+        self.evaluated += nHubs * len(columns)
+        return np.where(self.isOpen[columns], np.inf, self.objective(storage, load))
+
+
+# ---------- OPTIMIZERS ----------
+def evaluationData(data=None, region='ams'):
+    # the active cells only, exact (see cellIndex.py)
+    data = loadProblemData(region) if data is None else data
+    return data if isinstance(data, CompressedProblemData) else CompressedProblemData(data)
+
+
+def greedyAdd(nHubs, data=None, region='ams', start=(), candidates=None, transport=None, trace=None):
+    '''Open the best candidate until nHubs are open; returns the GreedyState.
+
+    trace, a list, receives (nHubs, hubIndex, objective) after every step.
+    '''
+    state = GreedyState(evaluationData(data, region), start, transport)
+    candidates = np.arange(state.nCandi) if candidates is None else np.asarray(candidates, dtype=np.intp)
+    while len(state.hubIndex) < nHubs:
+        values = state.addValues(candidates)
+        best = candidates[np.argmin(values)]
+        state.reset(np.append(state.hubIndex, best))
+        if trace is not None:
+            trace.append((len(state.hubIndex), state.hubIndex.copy(), float(state.value)))
+    return state
+
+
+def greedyDrop(nHubs, data=None, region='ams', start=None, transport=None, trace=None):
+    '''Close the least useful hub until nHubs are left (starting from all candidates).'''
+    data = evaluationData(data, region)
+    start = np.arange(data.cost_matrix.shape[1]) if start is None else start
+    state = GreedyState(data, start, transport)
+    while len(state.hubIndex) > nHubs:
+        worst = np.argmin(state.dropValues())
+        state.reset(np.delete(state.hubIndex, worst))
+        if trace is not None:
+            trace.append((len(state.hubIndex), state.hubIndex.copy(), float(state.value)))
+    return state
+
+
+def teitzBart(state, candidates=None, maxPasses=20, tol=1e-12):
+    '''Vertex substitution on state, in place.
+
+    Candidates are scanned in chunks; the best swap of a chunk is made at once if
+    it improves the (exact) objective. Stops after a pass without improvement.
+    Returns the number of swaps.
+    '''
+    candidates = np.arange(state.nCandi) if candidates is None else np.asarray(candidates, dtype=np.intp)
+    current = state.exactValue()
+    swaps = 0
+    for _ in range(maxPasses):
+        improved = False
+        for columns, D in state.chunks(candidates, rowsPerColumn=3):
+            values = state.swapValues(columns, D)
+            position, column = np.unravel_index(np.argmin(values), values.shape)
+            if not values[position, column] < current - tol:
+                continue
+            hubIndex = state.hubIndex.copy()
+            hubIndex[position] = columns[column]
+            value = state.exactValue(hubIndex)
+            if value < current - tol: # a tie may make the estimate optimistic
+                state.reset(hubIndex)
+                current = value
+                swaps += 1
+                improved = True
+        if not improved:
+            break
+    return swaps
+
+
+def optimizeGreedy(nHubs, method='add', improve=True, region='ams', data=None, transport=None):
+    '''Greedy add or drop, optionally followed by Teitz-Bart; returns hubIndex, objective and counts.'''
+    timeStart = time.time()
+    if method == 'add':
+        state = greedyAdd(nHubs, data, region, transport=transport)
+    elif method == 'drop':
+        state = greedyDrop(nHubs, data, region, transport=transport)
+    else:
+        raise ValueError('unknown method {!r}, expected add or drop'.format(method))
+    constructed = state.exactValue()
+    swaps = teitzBart(state) if improve else 0
+    return {
+        'hubIndex': state.hubIndex.copy(),
+        'objective': state.exactValue(),
+        'constructed': constructed,
+        'swaps': swaps,
+        'evaluated': state.evaluated,
+        'elapsed': time.time() - timeStart,
+    }
+
+
+def greedyFirstGuesses(maxHubs, improve=True, region='ams', data=None, transport=None):
+    '''{nHubs: 0-based candiInfo indexes} for nHubs = 1..maxHubs from one greedy-add pass.'''
+    data = evaluationData(data, region)
+    trace = []
+    greedyAdd(maxHubs, data, transport=transport, trace=trace)
+    guesses = {}
+    for n, hubIndex, _ in trace:
+        if improve:
+            state = GreedyState(data, hubIndex, transport)
+            teitzBart(state)
+            hubIndex = state.hubIndex
+        guesses[n] = np.sort(hubIndex)
+    return guesses
+
+
+if __name__ == '__main__':
+    import argparse
+    from firstGuesses import writeFirstGuesses
+    parser = argparse.ArgumentParser(description='Greedy add / drop + Teitz-Bart hub locations')
+    parser.add_argument('--region', default='ams')
+    parser.add_argument('--nHubs', type=int, default=45)
+    parser.add_argument('--method', choices=('add', 'drop'), default='add')
+    parser.add_argument('--noImprove', action='store_true', help='skip the Teitz-Bart pass')
+    parser.add_argument('--out', help='write first guesses for nHubs = 1..nHubs (greedy add) to this csv')
+    args = parser.parse_args()
+    if args.out:
+        timeStart = time.time()
+        guesses = greedyFirstGuesses(args.nHubs, not args.noImprove, args.region)
+        writeFirstGuesses(guesses, args.out)
+        print('{} first guesses written to {} in {:.1f} s'.format(len(guesses), args.out, time.time() - timeStart))
+    else:
+        res = optimizeGreedy(args.nHubs, args.method, not args.noImprove, args.region)
+        print('cost effectiveness: {:.6g} (constructed {:.6g}, {} swaps, {:.1f} s)'.format(
+            res['objective'], res['constructed'], res['swaps'], res['elapsed']))
+        print('candiIndexes (1-based): {}'.format(','.join(str(i + 1) for i in sorted(res['hubIndex']))))
@@ -0,0 +1,82 @@
+import numpy as np
+
+# Implicit regular grid for aggregating supply and demand points.
+#
+# dataPrep.ipynb built every 100 m cell as a shapely box in a double loop and
+# sjoin-ed the points twice. A Lattice is only an origin, a cell size and a
+# shape: the cell of a point is floor((x - x0) / cellSize) (same for y) and the
+# kg per cell come from one bincount over the occupied cells. Polygons are only
+# made on request (toGeoDataFrame), for export.
+#
+# Cells are numbered column by column, index = ix * ny + iy, the order of the
+# notebook loops. A point on a cell border belongs to the cell above / to the
+# right of it (sjoin counted it in every cell it touches).
+#
+# usage:
+#   lattice = Lattice.fromBounds(demand.total_bounds, 100)
+#   cells, kg = lattice.aggregate(coords, weights) # occupied cells only
+#   lattice.centroids(cells)
+#   lattice.toGeoDataFrame(cells).to_file('results/grid.shp')
+
+
+class Lattice:
+    def __init__(self, x0, y0, cellSize, nx, ny):
+        self.x0 = float(x0)
+        self.y0 = float(y0)
+        self.cellSize = float(cellSize)
+        self.nx = int(nx)
+        self.ny = int(ny)
+
+    @classmethod
+    def fromBounds(cls, bounds, cellSize):
+        '''Smallest lattice with its lower left corner at (xmin, ymin) covering bounds.'''
+        xmin, ymin, xmax, ymax = bounds
+        nx = max(int(np.ceil((xmax - xmin) / cellSize)), 1)
+        ny = max(int(np.ceil((ymax - ymin) / cellSize)), 1)
+        return cls(xmin, ymin, cellSize, nx, ny)
+
+    @property
+    def nCells(self):
+        return self.nx * self.ny
+
+    @property
+    def bounds(self):
+        return (self.x0, self.y0, self.x0 + self.nx * self.cellSize, self.y0 + self.ny * self.cellSize)
+
+    # ---------- POINTS -> CELLS ----------
+    def cellOf(self, coords):
+        '''Cell index of every point, -1 outside the lattice.'''
+        coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        ix = np.floor((coords[:, 0] - self.x0) / self.cellSize)
+        iy = np.floor((coords[:, 1] - self.y0) / self.cellSize)
+        inside = (ix >= 0) & (ix < self.nx) & (iy >= 0) & (iy < self.ny)
+        return np.where(inside, ix * self.ny + iy, -1).astype(np.int64)
+
+    def aggregate(self, coords, weights):
+        '''Summed weights per occupied cell: (cells, sums), cells sorted. Points outside are dropped.'''
+        cell = self.cellOf(coords)
+        inside = cell >= 0
+        cells, inverse = np.unique(cell[inside], return_inverse=True)
+        sums = np.bincount(inverse.ravel(), weights=np.asarray(weights, dtype=float)[inside], minlength=len(cells))
+        return cells, sums
+
+    # ---------- CELLS -> GEOMETRY ----------
+    def cellXY(self, cells):
+        cells = np.asarray(cells, dtype=np.int64)
+        return cells // self.ny, cells % self.ny
+
+    def centroids(self, cells=None):
+        '''(n, 2) centre coordinates of cells (all cells when None).'''
+        cells = np.arange(self.nCells) if cells is None else cells
+        ix, iy = self.cellXY(cells)
+        return np.column_stack([self.x0 + (ix + 0.5) * self.cellSize, self.y0 + (iy + 0.5) * self.cellSize])
+
+    def toGeoDataFrame(self, cells=None, crs='EPSG:28992'):
+        '''Cell polygons with their index, for export only.'''
+        import geopandas as gpd
+        import shapely
+        cells = np.arange(self.nCells) if cells is None else np.asarray(cells, dtype=np.int64)
+        ix, iy = self.cellXY(cells)
+        xmin, ymin = self.x0 + ix * self.cellSize, self.y0 + iy * self.cellSize
+        boxes = shapely.box(xmin, ymin, xmin + self.cellSize, ymin + self.cellSize)
+        return gpd.GeoDataFrame({'index': cells}, geometry=boxes, crs=crs)
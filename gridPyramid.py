@@ -0,0 +1,210 @@
+import time
+import numpy as np
+import pandas as pd
+import costEngine
+import spatialAnnealing
+from cellIndex import CompressedProblemData
+from gridLattice import Lattice
+from problemData import loadProblemData
+
+# Multi-resolution grid pyramid and coarse-to-fine annealing.
+#
+# Level 0 holds the active infoGrid cells (exact, see cellIndex.py). Every
+# coarser level bins them into a lattice with cells factor times larger, all
+# lattices sharing one origin, so every cell has exactly one parent on the next
+# level (factors must divide each other, e.g. 1, 4, 16 for 100 m, 400 m and
+# 1.6 km); parentOf[i] gives it for every cell of level i. By default the
+# factors are powers of 2 picked from the grid: each level has at most
+# 1 / levelReduction of the cells of the finer one and the coarsest keeps at
+# least minCoarseCells.
+#
+# A coarse cell carries the summed kg of its cells and, as its cost matrix row,
+# their rows averaged with the transport weights of the transport model
+# (spatialAnnealing.defaultTransport by default), scaled to the weight of the
+# coarse cell itself: while all its cells go to the same hub the transport
+# load is exact, also for the trip model, whose weights do not add up.
+#
+# Candidates are the same on every level, so hub indexes carry over. The
+# coarse-to-fine mode anneals the coarsest level with the full schedule, then
+# refines on every finer level with a short, cool schedule whose jitter window
+# is one coarse cell.
+#
+# usage:
+#   pyramid = GridPyramid(loadProblemData('ams'), cellSize=2000, factors=(1, 2, 4))
+#   res = optimizeCoarseToFine(firstGuess(45), pyramid, seed=1)
+#   res['hubIndex'], res['objective'], res['levels']
+
+# without explicit factors, levels are picked from the grid (see pyramidFactors)
+minCoarseCells = 32 # coarsest level keeps at least this many cells
+levelReduction = 4 # every level has at most 1 / levelReduction of the cells of the next finer one
+maxLevels = 4
+
+
+def gridSpacing(coords):
+    '''Smallest distance between distinct x (or y) values of the cell centroids.'''
+    steps = [np.diff(np.unique(np.round(coords[:, axis], 6))) for axis in (0, 1)]
+    steps = np.concatenate(steps)
+    return float(steps[steps > 0].min())
+
+
+class PyramidLevel:
+    '''One level: duck-types ProblemData for costEngine and spatialAnnealing.'''
+    def __init__(self, base, lattice, cells, pointOf, transport=None):
+        self.region = base.region
+        self.dataDir = base.dataDir
+        self.pPerSqm = base.pPerSqm
+        self.candiCoords = base.candiCoords
+        self.lattice = lattice
+        self.cells = cells # lattice index of every cell of this level
+        self.pointOf = pointOf # cell of this level for every level 0 cell
+        self.transport = transport
+        nCells = len(cells)
+        self.supply = np.bincount(pointOf, weights=base.supply, minlength=nCells)
+        self.demand = np.bincount(pointOf, weights=base.demand, minlength=nCells)
+        # summed load per unit distance of the cells, divided by the weight the coarse cell gets
+        weights = costEngine.transportWeights(base.supply, base.demand, transport)
+        rows = np.zeros((nCells, base.nCandi))
+        np.add.at(rows, pointOf, np.asarray(base.cost_matrix, dtype=float) * weights[:, None])
+        self.cost_matrix = rows / costEngine.transportWeights(self.supply, self.demand, transport)[:, None]
+        self.gridCoords = lattice.centroids(cells)
+
+    @property
+    def cellSize(self):
+        return self.lattice.cellSize
+
+    @property
+    def nCells(self):
+        return len(self.supply)
+
+    @property
+    def nCandi(self):
+        return len(self.pPerSqm)
+
+
+def levelLattice(coords, cellSize, factor):
+    # all levels share the origin, so every cell has one parent on each coarser level
+    x0, y0 = coords.min(axis=0) - cellSize / 2
+    extent = coords.max(axis=0) + cellSize / 2 - (x0, y0)
+    size = cellSize * factor
+    return Lattice(x0, y0, size, np.ceil(extent[0] / size) + 1, np.ceil(extent[1] / size) + 1)
+
+
+def pyramidFactors(coords, cellSize, minCells=minCoarseCells, reduction=levelReduction, levels=maxLevels):
+    '''Powers of 2 for the levels: each cuts the cell count by reduction, keeping at least minCells.'''
+    factors = [1]
+    lastCells = len(coords)
+    factor = 2
+    while len(factors) < levels:
+        cells = len(np.unique(levelLattice(coords, cellSize, factor).cellOf(coords)))
+        if cells < minCells:
+            break
+        if cells * reduction <= lastCells:
+            factors.append(factor)
+            lastCells = cells
+        factor *= 2
+    return tuple(factors)
+
+
+class GridPyramid:
+    def __init__(self, data, cellSize=None, factors=None, transport=None):
+        self.base = CompressedProblemData(data) # active cells, exact
+        coords = self.base.gridCoords
+        self.cellSize = gridSpacing(coords) if cellSize is None else cellSize
+        factors = pyramidFactors(coords, self.cellSize) if factors is None else sorted(factors)
+        if factors[0] != 1 or any(b % a for a, b in zip(factors[:-1], factors[1:])):
+            raise ValueError('factors must start at 1 and divide each other, got {}'.format(factors))
+        self.factors = tuple(factors)
+        self.transport = spatialAnnealing.defaultTransport() if transport is None else transport
+
+        self.levels = []
+        for factor in factors:
+            lattice = levelLattice(coords, self.cellSize, factor)
+            cells, pointOf = np.unique(lattice.cellOf(coords), return_inverse=True)
+            self.levels.append(PyramidLevel(self.base, lattice, cells, pointOf.ravel(), self.transport))
+
+        # parent on level i + 1 of every cell of level i; a level 0 cell must end up
+        # in the same cell whether binned directly or through the levels in between
+        self.parentOf = []
+        for fine, coarse in zip(self.levels[:-1], self.levels[1:]):
+            parentCells = coarse.lattice.cellOf(fine.gridCoords)
+            parentOf = np.searchsorted(coarse.cells, parentCells)
+            if not np.isin(parentCells, coarse.cells).all() or np.any(parentOf[fine.pointOf] != coarse.pointOf):
+                raise ValueError('cells of the {:g} m level do not nest in the {:g} m level'.format(
+                    fine.cellSize, coarse.cellSize))
+            self.parentOf.append(parentOf)
+
+    def stats(self):
+        return pd.DataFrame([{'level': i, 'cellSize': level.cellSize, 'cells': level.nCells}
+                             for i, level in enumerate(self.levels)])
+
+
+def evaluateLevel(hubIndex, level):
+    return costEngine.calcCostEffectivenessArrays(hubIndex, level.supply, level.demand, level.pPerSqm,
+                                                  level.cost_matrix, transport=level.transport)
+
+
+# ---------- COARSE-TO-FINE ----------
+def refineSchedule(cellSize, initialTemperature=2e-5, chains=100, stopping=5):
+    '''Short, cool schedule that only moves hubs within about one coarse cell.'''
+    return spatialAnnealing.scheduleSPSANN(initialAcceptance=(0, 1), initialTemperature=initialTemperature,
+                                           chains=chains, stopping=stopping, xMax=cellSize, yMax=cellSize,
+                                           swapProbability=0)
+
+
+def optimizeCoarseToFine(startHubIndex, pyramid, schedule=None, refineSchedules=None, seed=None, verbose=False):
+    '''Anneal on the coarsest level, then refine level by level down to level 0.
+
+    refineSchedules lists one schedule per finer level (coarse to fine); by
+    default refineSchedule of the next coarser cell size. The objective is that
+    of level 0, which equals the full-resolution objective.
+    '''
+    schedule = spatialAnnealing.scheduleSPSANN(initialTemperature=None) if schedule is None else schedule
+    rng = np.random.default_rng(seed)
+    order = list(range(len(pyramid.levels)))[::-1]
+    if refineSchedules is None:
+        refineSchedules = [refineSchedule(pyramid.levels[i + 1].cellSize) for i in order[1:]]
+
+    hubIndex = np.asarray(startHubIndex, dtype=np.intp)
+    levels = []
+    timeStart = time.time()
+    for step, i in enumerate(order):
+        level = pyramid.levels[i]
+        res = spatialAnnealing.optimizeHubs(hubIndex, schedule=schedule if step == 0 else refineSchedules[step - 1],
+                                            seed=rng.integers(2 ** 32), data=level, transport=level.transport)
+        hubIndex = res['hubIndex']
+        levels.append({'level': i, 'cellSize': level.cellSize, 'cells': level.nCells,
+                       'iterations': res['iterations'], 'objective': res['objective'], 'elapsed': res['elapsed']})
+        if verbose:
+            print('level {} ({:g} m, {} cells): {:.6g} after {} iterations'.format(
+                i, level.cellSize, level.nCells, res['objective'], res['iterations']))
+
+    levels = pd.DataFrame(levels)
+    finest = pyramid.levels[0].nCells
+    return {
+        'hubIndex': hubIndex,
+        'objective': evaluateLevel(hubIndex, pyramid.levels[0]),
+        'levels': levels,
+        'iterations': int(levels.iterations.sum()),
+        # iterations weighted by the cells they touch, in level 0 iterations
+        'fullResolutionIterations': float((levels.iterations * levels.cells).sum() / finest),
+        'elapsed': time.time() - timeStart,
+    }
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Coarse-to-fine annealing on a grid pyramid')
+    parser.add_argument('--region', default='ams')
+    parser.add_argument('--nHubs', type=int, default=45)
+    parser.add_argument('--cellSize', type=float, help='infoGrid cell size (m), default from the cell spacing')
+    parser.add_argument('--factors', type=int, nargs='+', help='cell size factors, e.g. 1 4 16; default from the grid')
+    parser.add_argument('--initialTemperature', type=float, help='default: calibrated on the coarsest level')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+    pyramid = GridPyramid(loadProblemData(args.region), args.cellSize, args.factors)
+    print(pyramid.stats().to_string(index=False))
+    res = optimizeCoarseToFine(spatialAnnealing.firstGuess(args.nHubs, args.region), pyramid,
+                               spatialAnnealing.scheduleSPSANN(initialTemperature=args.initialTemperature),
+                               seed=args.seed, verbose=True)
+    print('best cost effectiveness: {:.6g} ({} iterations, {:.0f} at full resolution, {:.1f} s)'.format(
+        res['objective'], res['iterations'], res['fullResolutionIterations'], res['elapsed']))
@@ -0,0 +1,87 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+# Nearest-hub assignment with a Euclidean KD-tree prefilter.
+#
+# costEngine.assignCells reads the network distance from every cell to every
+# open hub. Here a cKDTree over the open hubs gives the k Euclidean-nearest
+# hubs of each cell and only those k network distances are read.
+#
+# Exactness comes from a detour bound computed once for the cost matrix: for
+# every cell c and every candidate h
+#     network(c, h) >= ratio * euclidean(c, h) - slack[c]
+# (slack is per cell because the network distance starts at the node the cell
+# centroid is snapped to, which may be far off). A hub outside the shortlist is
+# at least as far (Euclidean) as the (k+1)-th nearest hub, so if the best
+# shortlisted network distance is below ratio * euclidean(k+1) - slack[c] no
+# other hub can be closer. Cells that fail the test are assigned with a full
+# scan of their row, so the result always equals costEngine.assignCells.
+#
+# usage:
+#   prefilter = KDTreeAssigner(data.cost_matrix, data.gridCoords, data.candiCoords)
+#   cellHub, cellDist = prefilter.assignCells(hubIndex)
+#   calcCostEffectivenessArrays(hubIndex, ..., sliceCache=prefilter) # same interface as SliceCache
+
+defaultK = 8
+detourChunkRows = 2048
+
+
+def detourSlack(cost_matrix, gridCoords, candiCoords, ratio=1.0, chunkRows=detourChunkRows):
+    '''Per-cell slack so that network >= ratio * euclidean - slack holds for every candidate.'''
+    nCells = len(gridCoords)
+    slack = np.empty(nCells)
+    for start in range(0, nCells, chunkRows):
+        rows = slice(start, min(start + chunkRows, nCells))
+        euclid = np.sqrt(((gridCoords[rows, None, :] - candiCoords[None, :, :]) ** 2).sum(axis=2))
+        slack[rows] = (ratio * euclid - np.asarray(cost_matrix[rows], dtype=float)).max(axis=1)
+    return np.maximum(slack, 0)
+
+
+class KDTreeAssigner:
+    def __init__(self, cost_matrix, gridCoords, candiCoords, k=defaultK, ratio=1.0, slack=None):
+        self.cost_matrix = cost_matrix
+        self.gridCoords = np.asarray(gridCoords, dtype=float)
+        self.candiCoords = np.asarray(candiCoords, dtype=float)
+        self.k = k
+        self.ratio = ratio
+        self.slack = detourSlack(cost_matrix, self.gridCoords, self.candiCoords, ratio) if slack is None else slack
+        self.cells = 0
+        self.fallbacks = 0
+
+    def assignCells(self, hubIndex):
+        '''Same as costEngine.assignCells (ties go to the first hub in hubIndex).'''
+        hubIndex = np.asarray(hubIndex, dtype=np.intp)
+        nHubs = len(hubIndex)
+        nCells = len(self.gridCoords)
+        k = min(self.k, nHubs)
+        tree = cKDTree(self.candiCoords[hubIndex])
+        if k < nHubs:
+            euclid, position = tree.query(self.gridCoords, k=k + 1)
+            outside = euclid[:, k] # nothing outside the shortlist is closer than this
+            position = position[:, :k]
+        else:
+            _, position = tree.query(self.gridCoords, k=k)
+            outside = np.full(nCells, np.inf)
+        position = position.reshape(nCells, k)
+
+        # network distances of the shortlist; ties go to the lowest position, as in argmin
+        dists = np.asarray(self.cost_matrix[np.arange(nCells)[:, None], hubIndex[position]], dtype=float)
+        cellDist = dists.min(axis=1)
+        nearest = np.where(dists == cellDist[:, None], position, nHubs).min(axis=1)
+
+        # cells where a hub outside the shortlist could still be closer: full scan
+        uncertain = np.flatnonzero(cellDist >= self.ratio * outside - self.slack)
+        if len(uncertain):
+            rowDists = np.asarray(self.cost_matrix[np.ix_(uncertain, hubIndex)], dtype=float)
+            nearest[uncertain] = np.argmin(rowDists, axis=1)
+            cellDist[uncertain] = rowDists[np.arange(len(uncertain)), nearest[uncertain]]
+        self.cells += nCells
+        self.fallbacks += len(uncertain)
+        return hubIndex[nearest], cellDist
+
+    def stats(self):
+        return {
+            'cells': self.cells,
+            'fallbacks': self.fallbacks,
+            'fallbackRate': self.fallbacks / self.cells if self.cells else 0.0,
+        }
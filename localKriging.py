@@ -0,0 +1,305 @@
+from concurrent.futures import ProcessPoolExecutor
+import os
+import numpy as np
+from scipy.optimize import least_squares
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import pdist
+
+# Moving-window ordinary kriging of the land price.
+#
+# dataPrep.ipynb fits pykrige's OrdinaryKriging on all IBIS sites with a
+# selling price and solves one system with every observation, O(n^3) in time
+# and O(n^2) in memory, which does not fit the whole country. Here:
+# * the variogram is fitted once like pykrige does (6 lag bins, soft-L1 least
+#   squares), on at most maxFitPoints observations
+# * every target is kriged from its nNeighbours nearest observations (cKDTree),
+#   a (nNeighbours + 1) system per target, solved in batches with
+#   np.linalg.solve
+# * chunks of targets are spread over worker processes
+# * the grid is written to a GeoTIFF with the transform of export_kde_raster
+# With nNeighbours=None every observation is used, which is global kriging.
+#
+# compareWithPykrige checks both against pykrige's OrdinaryKriging on a subset
+# of the observations, with pykrige's variogram. Global kriging must match it to
+# pykrigeTolerance. Local kriging must match it to localTolerance (RMS) on the
+# supported grid points, those within the median observation spacing of an
+# observation: candidate sites are IBIS sites, so that is where the raster is
+# sampled. Far from every observation local kriging extrapolates from a few
+# sites while global kriging reverts to the mean of all, and they differ by
+# up to the spread of the prices. On 600 of the sites in ibisForOptim.shp with
+# 64 neighbours, local kriging was within an RMS of 0.3% (exponential) and
+# 1.0% (spherical) of the price std on the supported points, against 16% and 11%
+# over the whole bounding-box grid. Two variograms fail there:
+# * gaussian without nugget: the global system is near-singular, and pykrige
+#   and solveGlobal already disagree.
+# * linear with a zero slope (pure nugget): global kriging is the mean of all
+#   sites, local kriging the mean of the neighbours.
+#
+# usage:
+#   Z, sigmaSquared, params = krigeGrid(coords, values, XX, YY, 'exponential', nNeighbours=64)
+#   exportRaster(Z, XX, YY, 'results/landPrice_local_exponential.tif')
+#   compareWithGlobal(coords, values, XX, YY) # check against global kriging
+#   compareWithPykrige(coords, values, XX, YY) # check both against pykrige
+#   python localKriging.py --points data/ibisForOptim.shp --column pPerSqm
+
+variogramModels = ('linear', 'power', 'gaussian', 'spherical', 'exponential', 'hole-effect')
+defaultNeighbours = 64
+defaultNLags = 6
+maxFitPoints = 2000
+chunkTargets = 4096
+# compareWithPykrige: differences relative to the std of the observed prices
+comparePoints = 600 # pykrige solves one dense system, keep it small
+pykrigeTolerance = 1e-6 # largest difference of global kriging
+localTolerance = 0.02 # RMS difference of local kriging on the supported grid points
+
+
+# ---------- VARIOGRAM MODELS (parameters as in pykrige) ----------
+def variogram(model, params, d):
+    if model == 'linear':
+        slope, nugget = params
+        return slope * d + nugget
+    if model == 'power':
+        scale, exponent, nugget = params
+        return scale * d ** exponent + nugget
+    psill, range_, nugget = params
+    if model == 'gaussian':
+        return psill * (1 - np.exp(-d ** 2 / (range_ * 4 / 7) ** 2)) + nugget
+    if model == 'exponential':
+        return psill * (1 - np.exp(-d / (range_ / 3))) + nugget
+    if model == 'spherical':
+        return np.where(d > range_, psill + nugget, psill * (1.5 * d / range_ - 0.5 * (d / range_) ** 3) + nugget)
+    if model == 'hole-effect':
+        return psill * (1 - (1 - d / (range_ / 3)) * np.exp(-d / (range_ / 3))) + nugget
+    raise ValueError('unknown variogram model {!r}, expected one of {}'.format(model, variogramModels))
+
+
+def experimentalVariogram(coords, values, nlags=defaultNLags):
+    '''Mean lag distance and semivariance per distance bin, like pykrige.'''
+    d = pdist(coords)
+    g = 0.5 * pdist(values[:, None], metric='sqeuclidean')
+    dmin, dmax = d.min(), d.max()
+    bins = [dmin + n * (dmax - dmin) / nlags for n in range(nlags)] + [dmax + 0.001]
+    lags, semivariance = [], []
+    for low, high in zip(bins[:-1], bins[1:]):
+        inBin = (d >= low) & (d < high)
+        if inBin.any():
+            lags.append(d[inBin].mean())
+            semivariance.append(g[inBin].mean())
+    return np.array(lags), np.array(semivariance)
+
+
+def fitVariogram(coords, values, model, nlags=defaultNLags, maxPoints=maxFitPoints, seed=0):
+    '''Variogram parameters fitted like pykrige (start values and bounds included).'''
+    coords, values = np.asarray(coords, dtype=float), np.asarray(values, dtype=float)
+    if len(values) > maxPoints:
+        keep = np.random.default_rng(seed).choice(len(values), maxPoints, replace=False)
+        coords, values = coords[keep], values[keep]
+    lags, semivariance = experimentalVariogram(coords, values, nlags)
+    svMin, svMax = semivariance.min(), semivariance.max()
+    if model == 'linear':
+        x0 = [(svMax - svMin) / (lags.max() - lags.min()), svMin]
+        bounds = ([0, 0], [np.inf, svMax])
+    elif model == 'power':
+        x0 = [(svMax - svMin) / (lags.max() - lags.min()), 1.1, svMin]
+        bounds = ([0, 0.001, 0], [np.inf, 1.999, svMax])
+    else:
+        x0 = [svMax - svMin, 0.25 * lags.max(), svMin]
+        bounds = ([0, 0, 0], [10 * svMax, lags.max(), svMax])
+    res = least_squares(lambda params: variogram(model, params, lags) - semivariance, x0, bounds=bounds,
+                        loss='soft_l1')
+    return res.x
+
+
+# ---------- KRIGING SYSTEMS ----------
+def solveSystems(obsCoords, obsValues, targets, neighbours, model, params):
+    '''Ordinary kriging of targets, each from its own observations (neighbours: (targets, k) indexes).'''
+    nTargets, k = neighbours.shape
+    points = obsCoords[neighbours] # (targets, k, 2)
+    a = np.ones((nTargets, k + 1, k + 1))
+    a[:, :k, :k] = -variogram(model, params, np.sqrt(((points[:, :, None] - points[:, None]) ** 2).sum(axis=3)))
+    a[:, range(k), range(k)] = 0.0
+    a[:, k, k] = 0.0
+    d = np.sqrt(((points - targets[:, None]) ** 2).sum(axis=2))
+    b = np.ones((nTargets, k + 1))
+    b[:, :k] = -variogram(model, params, d)
+    b[:, :k][d <= 1e-10] = 0.0 # exact at the observations
+    x = np.linalg.solve(a, b[..., None])[..., 0]
+    Z = (x[:, :k] * obsValues[neighbours]).sum(axis=1)
+    sigmaSquared = (x * -b).sum(axis=1)
+    return Z, sigmaSquared
+
+
+def krigeChunk(targets, obsCoords, obsValues, model, params, nNeighbours, tree=None):
+    if nNeighbours is None or nNeighbours >= len(obsValues):
+        return solveGlobal(obsCoords, obsValues, targets, model, params)
+    tree = cKDTree(obsCoords) if tree is None else tree
+    _, neighbours = tree.query(targets, k=nNeighbours)
+    Z = np.empty(len(targets))
+    sigmaSquared = np.empty(len(targets))
+    # batches keep the (targets, k + 1, k + 1) systems small
+    batch = max(1, (1 << 24) // (nNeighbours + 1) ** 2)
+    for start in range(0, len(targets), batch):
+        rows = slice(start, start + batch)
+        Z[rows], sigmaSquared[rows] = solveSystems(obsCoords, obsValues, targets[rows], neighbours[rows],
+                                                   model, params)
+    return Z, sigmaSquared
+
+
+def globalMatrix(obsCoords, model, params):
+    n = len(obsCoords)
+    a = np.ones((n + 1, n + 1))
+    a[:n, :n] = -variogram(model, params, np.sqrt(((obsCoords[:, None] - obsCoords[None]) ** 2).sum(axis=2)))
+    np.fill_diagonal(a, 0.0)
+    return a
+
+
+def solveGlobal(obsCoords, obsValues, targets, model, params):
+    # one system with every observation, factorized once for all targets
+    from scipy.linalg import lu_factor, lu_solve
+    n = len(obsValues)
+    lu = lu_factor(globalMatrix(obsCoords, model, params))
+    d = np.sqrt(((targets[:, None] - obsCoords[None]) ** 2).sum(axis=2))
+    b = np.ones((len(targets), n + 1))
+    b[:, :n] = -variogram(model, params, d)
+    b[:, :n][d <= 1e-10] = 0.0
+    x = lu_solve(lu, b.T).T
+    return (x[:, :n] * obsValues).sum(axis=1), (x * -b).sum(axis=1)
+
+
+# ---------- WORKERS ----------
+_worker = {}
+
+def initWorker(obsCoords, obsValues, model, params, nNeighbours):
+    _worker.update(obsCoords=obsCoords, obsValues=obsValues, model=model, params=params,
+                   nNeighbours=nNeighbours, tree=cKDTree(obsCoords))
+
+
+def krigeChunkInWorker(targets):
+    w = _worker
+    return krigeChunk(targets, w['obsCoords'], w['obsValues'], w['model'], w['params'], w['nNeighbours'], w['tree'])
+
+
+def krigePoints(obsCoords, obsValues, targets, model='exponential', nNeighbours=defaultNeighbours, params=None,
+                nWorkers=None, chunkSize=chunkTargets):
+    '''Kriged value and variance at every target; returns (Z, sigmaSquared, params).
+
+    params are the variogram parameters, fitted when None. nWorkers=0 solves in
+    this process.
+    '''
+    obsCoords = np.asarray(obsCoords, dtype=float)
+    obsValues = np.asarray(obsValues, dtype=float)
+    targets = np.asarray(targets, dtype=float).reshape(-1, 2)
+    params = fitVariogram(obsCoords, obsValues, model) if params is None else np.asarray(params, dtype=float)
+    chunks = [targets[i:i + chunkSize] for i in range(0, len(targets), chunkSize)]
+    if nWorkers == 0 or len(chunks) <= 1:
+        tree = cKDTree(obsCoords)
+        results = [krigeChunk(chunk, obsCoords, obsValues, model, params, nNeighbours, tree) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=nWorkers or os.cpu_count(), initializer=initWorker,
+                                 initargs=(obsCoords, obsValues, model, params, nNeighbours)) as pool:
+            results = list(pool.map(krigeChunkInWorker, chunks))
+    if not results:
+        return np.zeros(0), np.zeros(0), params
+    return np.concatenate([r[0] for r in results]), np.concatenate([r[1] for r in results]), params
+
+
+def krigeGrid(obsCoords, obsValues, XX, YY, model='exponential', nNeighbours=defaultNeighbours, params=None,
+              nWorkers=None):
+    '''Kriging on the grid XX x YY, shape (len(YY), len(XX)) like pykrige's execute('grid', ...).'''
+    gridX, gridY = np.meshgrid(XX, YY)
+    Z, sigmaSquared, params = krigePoints(obsCoords, obsValues, np.column_stack([gridX.ravel(), gridY.ravel()]),
+                                          model, nNeighbours, params, nWorkers)
+    return Z.reshape(gridX.shape), sigmaSquared.reshape(gridX.shape), params
+
+
+def compareWithGlobal(obsCoords, obsValues, XX, YY, model='exponential', nNeighbours=defaultNeighbours):
+    '''RMS and largest difference between local and global kriging on a grid (same variogram).'''
+    params = fitVariogram(obsCoords, obsValues, model)
+    local, _, _ = krigeGrid(obsCoords, obsValues, XX, YY, model, nNeighbours, params, nWorkers=0)
+    full, _, _ = krigeGrid(obsCoords, obsValues, XX, YY, model, None, params, nWorkers=0)
+    diff = np.abs(local - full)
+    return {'rms': float(np.sqrt((diff ** 2).mean())), 'max': float(diff.max()), 'std': float(full.std())}
+
+
+def compareWithPykrige(obsCoords, obsValues, XX, YY, model='exponential', nNeighbours=defaultNeighbours,
+                       maxPoints=comparePoints, seed=0):
+    '''Global and local kriging against pykrige's OrdinaryKriging on at most maxPoints observations.
+
+    All three use pykrige's variogram parameters. Differences are relative to
+    the std of the observations; ok says whether both are within tolerance.
+    '''
+    from pykrige.ok import OrdinaryKriging
+    obsCoords, obsValues = np.asarray(obsCoords, dtype=float), np.asarray(obsValues, dtype=float)
+    if len(obsValues) > maxPoints:
+        keep = np.random.default_rng(seed).choice(len(obsValues), maxPoints, replace=False)
+        obsCoords, obsValues = obsCoords[keep], obsValues[keep]
+    OK = OrdinaryKriging(obsCoords[:, 0], obsCoords[:, 1], obsValues, variogram_model=model, verbose=False,
+                         enable_plotting=False, coordinates_type='euclidean')
+    reference = np.asarray(OK.execute('grid', XX, YY)[0])
+    params = np.asarray(OK.variogram_model_parameters, dtype=float)
+    full, _, _ = krigeGrid(obsCoords, obsValues, XX, YY, model, None, params, nWorkers=0)
+    local, _, _ = krigeGrid(obsCoords, obsValues, XX, YY, model, nNeighbours, params, nWorkers=0)
+
+    # supported grid points: within the median observation spacing of an observation
+    tree = cKDTree(obsCoords)
+    spacing = np.median(tree.query(obsCoords, k=2)[0][:, 1])
+    gridX, gridY = np.meshgrid(XX, YY)
+    supported = tree.query(np.column_stack([gridX.ravel(), gridY.ravel()]))[0].reshape(gridX.shape) <= spacing
+
+    scale = obsValues.std()
+    localDiff = (local - reference)[supported]
+    res = {
+        'model': model,
+        'points': len(obsValues),
+        'params': params.tolist(),
+        'globalMax': float(np.abs(full - reference).max() / scale),
+        'localRms': float(np.sqrt((localDiff ** 2).mean()) / scale) if localDiff.size else np.nan,
+        'localMax': float(np.abs(localDiff).max() / scale) if localDiff.size else np.nan,
+        'localRmsAll': float(np.sqrt(((local - reference) ** 2).mean()) / scale),
+        'supportedShare': float(supported.mean()),
+    }
+    res['ok'] = bool(res['globalMax'] <= pykrigeTolerance and res['localRms'] <= localTolerance)
+    return res
+
+
+# ---------- RASTER ----------
+def exportRaster(Z, XX, YY, filename, proj='EPSG:28992'):
+    '''Write Z as a GeoTIFF with the transform of export_kde_raster in dataPrep.ipynb.'''
+    import rasterio
+    from rasterio.transform import Affine
+    min_x, max_x, min_y, max_y = XX[0], XX[-1], YY[0], YY[-1]
+    xres = (max_x - min_x) / len(XX)
+    yres = (max_y - min_y) / len(YY)
+    transform = Affine.translation(min_x - xres / 2, min_y - yres / 2) * Affine.scale(xres, yres)
+    with rasterio.open(filename, mode='w', driver='GTiff', height=Z.shape[0], width=Z.shape[1], count=1,
+                       dtype=Z.dtype, crs=proj, transform=transform) as raster:
+        raster.write(Z, 1)
+
+
+if __name__ == '__main__':
+    import argparse
+    import pandas as pd
+    parser = argparse.ArgumentParser(description='Compare global and local kriging with pykrige on a subset')
+    parser.add_argument('--points', help='shapefile of observations, default the IBIS sites of dataPipeline.py')
+    parser.add_argument('--column', default='MX_VPRIJS', help='observed value, e.g. pPerSqm of ibisForOptim.shp')
+    parser.add_argument('--models', nargs='+', default=['exponential', 'spherical', 'gaussian'])
+    parser.add_argument('--neighbours', type=int, default=defaultNeighbours)
+    parser.add_argument('--subset', type=int, default=comparePoints)
+    parser.add_argument('--gridSize', type=int, default=40)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    if args.points:
+        import geopandas as gpd
+        points = gpd.read_file(args.points)
+    else:
+        from dataPipeline import Pipeline
+        points = Pipeline().get('ibis')
+    points = points[points[args.column] > 0]
+    coords = np.column_stack([points.geometry.x, points.geometry.y])
+    XX = np.linspace(coords[:, 0].min(), coords[:, 0].max(), args.gridSize)
+    YY = np.linspace(coords[:, 1].min(), coords[:, 1].max(), args.gridSize)
+    table = pd.DataFrame([compareWithPykrige(coords, points[args.column].to_numpy(dtype=float), XX, YY, model,
+                                             args.neighbours, args.subset, args.seed) for model in args.models])
+    print(table.drop(columns='params').to_string(index=False))
+    print('tolerances (of the observed std): global max {:g}, local rms {:g}'.format(
+        pykrigeTolerance, localTolerance))
@@ -0,0 +1,155 @@
+from concurrent.futures import as_completed
+import os
+import numpy as np
+import pandas as pd
+import costEngine
+import parallelAnnealing
+import spatialAnnealing
+from problemData import indexesToStr, loadProblemData, strToIndexes
+
+# Best cost effectiveness as a function of the number of hubs.
+#
+# Every nHubs value is annealed in a worker pool (see parallelAnnealing.py).
+#   pass 'kmeans'   - each nHubs starts from its k-means first guess
+#   pass 'neighbor' - each nHubs starts from the optimum of nHubs-1 with the
+#                     best extra hub added, or of nHubs+1 with the least useful
+#                     hub dropped (whichever is better), and keeps the result
+#                     only if it beats the previous best
+# Completed runs are appended to a checkpoint csv straight away, so an
+# interrupted sweep resumes where it stopped.
+#
+# usage:
+#   curve = runSweep(range(1, 50), schedule=scheduleSPSANN(initialTemperature=None))
+#   curve[['nHubs', 'objective']]
+
+checkpointColumns = ['nHubs', 'pass', 'start', 'objective', 'candiIndexes']
+
+
+# ---------- CHECKPOINT ----------
+def readCheckpoint(path):
+    if path is None or not os.path.exists(path):
+        return pd.DataFrame(columns=checkpointColumns)
+    return pd.read_csv(path)
+
+
+def appendCheckpoint(path, row):
+    if path is None:
+        return
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    pd.DataFrame([row], columns=checkpointColumns).to_csv(path, mode='a', index=False, header=not os.path.exists(path))
+
+
+# ---------- WARM STARTS FROM NEIGHBOURING nHubs ----------
+# starts are ranked with the transport model the chains anneal with (spatialAnnealing.defaultTransport)
+def addBestHub(hubIndex, data, transport=None):
+    # try every closed candidate as an extra hub in one batch evaluation
+    closed = np.setdiff1d(np.arange(data.nCandi), hubIndex)
+    solutions = np.column_stack([np.repeat([hubIndex], len(closed), axis=0), closed])
+    values = costEngine.calcCostEffectivenessBatch(solutions, data.supply, data.demand, data.pPerSqm, data.cost_matrix,
+                                                   transport=transport)
+    return solutions[np.argmin(values)]
+
+
+def dropWorstHub(hubIndex, data, transport=None):
+    # try removing every hub in one batch evaluation
+    solutions = np.array([np.delete(hubIndex, i) for i in range(len(hubIndex))])
+    values = costEngine.calcCostEffectivenessBatch(solutions, data.supply, data.demand, data.pPerSqm, data.cost_matrix,
+                                                   transport=transport)
+    return solutions[np.argmin(values)]
+
+
+def neighborStart(nHubs, best, data, transport=None):
+    # best: {nHubs: (objective, hubIndex)} from earlier runs
+    transport = spatialAnnealing.defaultTransport() if transport is None else transport
+    options = []
+    if nHubs - 1 in best:
+        options.append(addBestHub(best[nHubs - 1][1], data, transport))
+    if nHubs + 1 in best:
+        options.append(dropWorstHub(best[nHubs + 1][1], data, transport))
+    if not options:
+        return None
+    values = [costEngine.calcCostEffectivenessArrays(o, data.supply, data.demand, data.pPerSqm, data.cost_matrix,
+                                                     transport=transport)
+              for o in options]
+    return options[int(np.argmin(values))]
+
+
+# ---------- SWEEP ----------
+def runSweep(nHubsValues=range(1, 50), region='ams', schedule=None, passes=('kmeans', 'neighbor'),
+             checkpointPath=None, nWorkers=None, seed=0, data=None, verbose=True, transport=None):
+    '''Anneal every nHubs value and return one row per nHubs with the best objective found.
+
+    checkpointPath defaults to results/nHubsSweep_{region}.csv; transport to
+    costEffectiveness.transportModel (see spatialAnnealing.defaultTransport).
+    '''
+    data = loadProblemData(region) if data is None else data
+    transport = spatialAnnealing.defaultTransport() if transport is None else transport
+    if checkpointPath is None:
+        checkpointPath = 'results/nHubsSweep_{}.csv'.format(region)
+    nHubsValues = list(nHubsValues)
+    firstGuesses = spatialAnnealing.readFirstGuesses(
+        os.path.join(getattr(data, 'dataDir', 'data'), 'firstGuesses_{}.csv'.format(region)))
+
+    checkpoint = readCheckpoint(checkpointPath)
+    best = {}
+    for row in checkpoint.itertuples():
+        if row.nHubs not in best or row.objective < best[row.nHubs][0]:
+            best[row.nHubs] = (row.objective, strToIndexes(row.candiIndexes))
+    done = set(zip(checkpoint.nHubs, checkpoint['pass']))
+
+    pool, blocks = parallelAnnealing.makePool(data, nWorkers, transport)
+    try:
+        with pool:
+            for passNumber, sweepPass in enumerate(passes):
+                futures = {}
+                for nHubs in nHubsValues:
+                    if (nHubs, sweepPass) in done:
+                        continue
+                    if sweepPass == 'kmeans':
+                        start, startName = firstGuesses[nHubs], 'kmeans'
+                    else:
+                        start, startName = neighborStart(nHubs, best, data, transport), 'neighbor'
+                        if start is None:
+                            continue
+                    start = spatialAnnealing.uniqueHubs(start, data.candiCoords)
+                    future = pool.submit(parallelAnnealing.runChain, start, schedule,
+                                         np.random.SeedSequence([seed, nHubs, passNumber]))
+                    futures[future] = (nHubs, startName)
+                for future in as_completed(futures):
+                    nHubs, startName = futures[future]
+                    res = future.result()
+                    appendCheckpoint(checkpointPath, {
+                        'nHubs': nHubs, 'pass': sweepPass, 'start': startName,
+                        'objective': res['objective'], 'candiIndexes': indexesToStr(res['hubIndex'])})
+                    if nHubs not in best or res['objective'] < best[nHubs][0]:
+                        best[nHubs] = (res['objective'], res['hubIndex'])
+                    if verbose:
+                        print('{} pass, nHubs {}: {:.6g} (best {:.6g})'.format(
+                            sweepPass, nHubs, res['objective'], best[nHubs][0]))
+    finally:
+        parallelAnnealing.releaseBlocks(blocks)
+
+    return pd.DataFrame([{'nHubs': n, 'objective': best[n][0], 'candiIndexes': indexesToStr(best[n][1])}
+                         for n in sorted(best) if n in nHubsValues])
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Best cost effectiveness for every number of hubs')
+    parser.add_argument('--region', default='ams')
+    parser.add_argument('--minHubs', type=int, default=1)
+    parser.add_argument('--maxHubs', type=int, default=49)
+    parser.add_argument('--initialTemperature', type=float, help='default: calibrated from every start')
+    parser.add_argument('--chains', type=int, default=500)
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--checkpoint')
+    parser.add_argument('--out', help='csv for the curve, default results/nHubsCurve_{region}.csv')
+    args = parser.parse_args()
+    curve = runSweep(range(args.minHubs, args.maxHubs + 1), args.region,
+                     spatialAnnealing.scheduleSPSANN(initialTemperature=args.initialTemperature, chains=args.chains),
+                     checkpointPath=args.checkpoint, nWorkers=args.workers)
+    out = args.out or 'results/nHubsCurve_{}.csv'.format(args.region)
+    curve.to_csv(out, index=False)
+    print(curve[['nHubs', 'objective']].to_string(index=False))
@@ -0,0 +1,165 @@
+from collections import OrderedDict
+import atexit
+import os
+import sqlite3
+import weakref
+import numpy as np
+
+# Memoization of objective values across an optimizer run.
+#
+# Wraps an objective that takes an array of candidate indexes and caches its
+# value under the canonical (sorted) index tuple, so configurations the
+# annealer proposes again are not recomputed. The in-memory layer is an LRU
+# bounded to maxSize entries; with persistPath the values are also stored in a
+# sqlite file, so a restarted run reuses earlier evaluations. Values are written
+# every flushEvery new entries and when the interpreter exits.
+#
+# usage:
+#   objective = MemoizedObjective(f, persistPath='results/objectiveCache.sqlite', namespace='ams')
+#   objective(hubIndex)
+#   print(objective.report())
+#
+# The namespace separates values of different regions / objective versions in
+# the same file; include a tag of the input data in it (costEffectiveness.py
+# uses ProblemData.dataTag) so values of older inputs are not reused.
+
+defaultMaxSize = 100000
+
+# persisted caches still open; closed (and flushed) when the interpreter exits
+_openCaches = weakref.WeakSet()
+
+@atexit.register
+def closeOpenCaches():
+    for objectiveCache in list(_openCaches):
+        objectiveCache.close()
+
+
+class MemoizedObjective:
+    def __init__(self, objective, maxSize=defaultMaxSize, persistPath=None, namespace='default', flushEvery=100):
+        self.objective = objective
+        self.maxSize = maxSize
+        self.namespace = namespace
+        self.flushEvery = flushEvery
+        self.values = OrderedDict()
+        self.hits = 0
+        self.diskHits = 0
+        self.misses = 0
+        self.pending = []
+        self.db = None
+        if persistPath is not None:
+            directory = os.path.dirname(persistPath)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.db = sqlite3.connect(persistPath)
+            self.db.execute('CREATE TABLE IF NOT EXISTS objective '
+                            '(namespace TEXT, key TEXT, value REAL, PRIMARY KEY (namespace, key))')
+            _openCaches.add(self) # runs that never call flush keep their last values
+
+    @staticmethod
+    def key(hubIndex):
+        return tuple(sorted(int(h) for h in np.asarray(hubIndex).ravel()))
+
+    def _remember(self, key, value):
+        self.values[key] = value
+        self.values.move_to_end(key)
+        while len(self.values) > self.maxSize:
+            self.values.popitem(last=False)
+
+    def _lookup(self, key):
+        # cached value of key - memory first, then disk - or None
+        if key in self.values:
+            self.hits += 1
+            self.values.move_to_end(key)
+            return self.values[key]
+        if self.db is not None:
+            row = self.db.execute('SELECT value FROM objective WHERE namespace = ? AND key = ?',
+                                  (self.namespace, keyToText(key))).fetchone()
+            if row is not None:
+                self.diskHits += 1
+                self._remember(key, row[0])
+                return row[0]
+        return None
+
+    def _store(self, key, value):
+        self._remember(key, value)
+        if self.db is not None:
+            self.pending.append((self.namespace, keyToText(key), value))
+            if len(self.pending) >= self.flushEvery:
+                self.flush()
+
+    def __call__(self, hubIndex):
+        key = self.key(hubIndex)
+        value = self._lookup(key)
+        if value is None:
+            self.misses += 1
+            value = float(self.objective(np.array(key, dtype=np.intp)))
+            self._store(key, value)
+        return value
+
+    def evaluateMany(self, hubIndexes, batchObjective):
+        '''Return the values for the rows of hubIndexes (shape (K, nHubs)).
+
+        Rows that are not cached are evaluated together with one call to
+        batchObjective, which takes a 2-D array of sorted rows.
+        '''
+        hubIndexes = np.atleast_2d(np.asarray(hubIndexes))
+        values = np.empty(len(hubIndexes))
+        missing = {}
+        for i, hubIndex in enumerate(hubIndexes):
+            key = self.key(hubIndex)
+            if key in missing:
+                self.hits += 1 # repeated within the batch
+                missing[key].append(i)
+                continue
+            value = self._lookup(key)
+            if value is None:
+                missing[key] = [i]
+            else:
+                values[i] = value
+        if missing:
+            keys = list(missing)
+            self.misses += len(keys)
+            newValues = batchObjective(np.array(keys, dtype=np.intp))
+            for key, value in zip(keys, newValues):
+                values[missing[key]] = float(value)
+                self._store(key, float(value))
+        return values
+
+    def flush(self):
+        if self.db is not None and self.pending:
+            self.db.executemany('INSERT OR REPLACE INTO objective VALUES (?, ?, ?)', self.pending)
+            self.db.commit()
+            self.pending = []
+
+    def close(self):
+        self.flush()
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+        _openCaches.discard(self)
+
+    def __del__(self):
+        # also flush caches that are dropped before the interpreter exits
+        if getattr(self, 'db', None) is not None:
+            self.close()
+
+    # ---------- REPORTING ----------
+    def stats(self):
+        calls = self.hits + self.diskHits + self.misses
+        return {
+            'calls': calls,
+            'hits': self.hits,
+            'diskHits': self.diskHits,
+            'misses': self.misses,
+            'hitRate': (self.hits + self.diskHits) / calls if calls else 0.0,
+            'entries': len(self.values),
+        }
+
+    def report(self):
+        s = self.stats()
+        return ('objective calls: {calls}, memory hits: {hits}, disk hits: {diskHits}, '
+                'evaluated: {misses}, hit rate: {hitRate:.1%}').format(**s)
+
+
+def keyToText(key):
+    return ','.join(str(k) for k in key)
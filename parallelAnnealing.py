@@ -0,0 +1,189 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import os
+import numpy as np
+import pandas as pd
+import spatialAnnealing
+from problemData import loadProblemData
+
+# Several annealing chains (see spatialAnnealing.py) run in a process pool.
+#
+# The read-only inputs (supply, demand, land price, candidate coordinates and
+# the cost matrix) are put in shared memory once; workers attach to them in
+# their initializer instead of receiving a pickled copy per task. A cost matrix
+# store (.cmx, see costMatrixStore.py) is memory-mapped, so workers just open
+# the same file and share the page cache.
+#
+# Two modes:
+#   runMultiStart        - N independent chains, best one wins
+#   runParallelTempering - N chains at fixed temperatures that exchange
+#                          states between rounds
+#
+# usage (from a script, guarded by if __name__ == '__main__' on Windows):
+#   res = runMultiStart(firstGuess(45), nChains=16, schedule=scheduleSPSANN(initialTemperature=None))
+#   res['hubIndex'], res['objective'], res['traces']
+
+sharedArrays = ('supply', 'demand', 'pPerSqm', 'candiCoords')
+
+
+# ---------- SHARED MEMORY ----------
+class SharedProblemData:
+    '''The attributes of ProblemData that the annealer needs, backed by shared memory.'''
+    def __init__(self, arrays, cost_matrix):
+        self.supply = arrays['supply']
+        self.demand = arrays['demand']
+        self.pPerSqm = arrays['pPerSqm']
+        self.candiCoords = arrays['candiCoords']
+        self.cost_matrix = cost_matrix
+        self.nCandi = len(self.pPerSqm)
+        self.nCells = len(self.supply)
+
+
+def shareProblemData(data):
+    '''Copy the arrays of data into shared memory; return (spec, blocks).
+
+    spec is small and picklable, blocks must be kept alive (and unlinked) by the caller.
+    '''
+    spec = {'arrays': {}, 'cost_matrix': None}
+    blocks = []
+    def share(name, array):
+        array = np.ascontiguousarray(array)
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        blocks.append(block)
+        return {'name': block.name, 'shape': array.shape, 'dtype': array.dtype.str}
+    for name in sharedArrays:
+        spec['arrays'][name] = share(name, getattr(data, name))
+    cost_matrix = data.cost_matrix
+    if hasattr(cost_matrix, 'path'): # memory-mapped store, workers open the file themselves
+        spec['cost_matrix'] = {'path': cost_matrix.path}
+    else:
+        spec['cost_matrix'] = share('cost_matrix', np.asarray(cost_matrix))
+    return spec, blocks
+
+
+def releaseBlocks(blocks):
+    for block in blocks:
+        block.close()
+        block.unlink()
+
+
+_worker = {}
+
+def attachSharedData(spec, transport=None):
+    # pool initializer: map the shared blocks into this worker
+    blocks = []
+    def attach(entry):
+        block = shared_memory.SharedMemory(name=entry['name'])
+        blocks.append(block)
+        return np.ndarray(tuple(entry['shape']), dtype=np.dtype(entry['dtype']), buffer=block.buf)
+    arrays = {name: attach(entry) for name, entry in spec['arrays'].items()}
+    if 'path' in spec['cost_matrix']:
+        from costMatrixStore import openCostMatrix
+        cost_matrix = openCostMatrix(spec['cost_matrix']['path'])
+    else:
+        cost_matrix = attach(spec['cost_matrix'])
+    _worker['blocks'] = blocks # keep the mappings alive
+    _worker['data'] = SharedProblemData(arrays, cost_matrix)
+    _worker['transport'] = transport
+
+
+def runChain(startHubIndex, schedule, seed):
+    res = spatialAnnealing.optimizeHubs(startHubIndex, schedule=schedule, seed=seed, data=_worker['data'],
+                                        transport=_worker['transport'])
+    return res
+
+
+def makePool(data, nWorkers, transport=None):
+    spec, blocks = shareProblemData(data)
+    # the parent's transport model, also when workers are spawned rather than forked
+    transport = spatialAnnealing.defaultTransport() if transport is None else transport
+    pool = ProcessPoolExecutor(max_workers=nWorkers or os.cpu_count(), initializer=attachSharedData,
+                               initargs=(spec, transport))
+    return pool, blocks
+
+
+# ---------- INDEPENDENT CHAINS ----------
+def runMultiStart(startHubIndexes, nChains=None, region='ams', schedule=None, nWorkers=None, seed=None, data=None):
+    '''Run independent annealing chains in parallel and return the best one.
+
+    startHubIndexes is either one start (used by all nChains chains, each with
+    its own random seed) or a list of starts, one per chain.
+    '''
+    data = loadProblemData(region) if data is None else data
+    starts = np.atleast_2d(np.asarray(startHubIndexes, dtype=np.intp))
+    if nChains is not None and len(starts) == 1:
+        starts = np.repeat(starts, nChains, axis=0)
+    seeds = np.random.SeedSequence(seed).spawn(len(starts))
+    pool, blocks = makePool(data, nWorkers)
+    try:
+        with pool:
+            results = list(pool.map(runChain, starts, [schedule] * len(starts), seeds))
+    finally:
+        releaseBlocks(blocks)
+
+    best = min(range(len(results)), key=lambda i: results[i]['objective'])
+    traces = [r['trace'].assign(chainId=i) for i, r in enumerate(results)]
+    return {
+        'hubIndex': results[best]['hubIndex'],
+        'objective': results[best]['objective'],
+        'bestChain': best,
+        'traces': traces,
+        'results': results,
+    }
+
+
+# ---------- PARALLEL TEMPERING ----------
+def runParallelTempering(startHubIndex, temperatures, rounds=50, chainsPerRound=1, region='ams',
+                         swapProbability=0.2, nWorkers=None, seed=None, data=None, verbose=False):
+    '''Replica exchange: one chain per temperature, neighbouring states swap between rounds.
+
+    Every round each replica runs chainsPerRound chains at its fixed temperature;
+    afterwards adjacent replicas exchange states with probability
+    min(1, exp((1/Ti - 1/Tj) * (Ei - Ej))).
+    '''
+    data = loadProblemData(region) if data is None else data
+    temperatures = np.sort(np.asarray(temperatures, dtype=float))
+    nReplicas = len(temperatures)
+    rng = np.random.default_rng(seed)
+    seeds = np.random.SeedSequence(seed).spawn(nReplicas * rounds)
+    extent = data.candiCoords.max(axis=0) - data.candiCoords.min(axis=0)
+    schedules = [spatialAnnealing.scheduleSPSANN(
+        initialAcceptance=(0, 1), initialTemperature=t, temperatureDecrease=1.0,
+        chains=chainsPerRound, stopping=chainsPerRound + 1, swapProbability=swapProbability,
+        xMax=extent[0] / 2, xMin=extent[0] / 2, yMax=extent[1] / 2, yMin=extent[1] / 2) for t in temperatures]
+
+    states = [spatialAnnealing.uniqueHubs(startHubIndex, data.candiCoords)] * nReplicas
+    best, bestHubIndex = np.inf, None
+    traces = [[] for _ in range(nReplicas)]
+    swapsAccepted = 0
+    pool, blocks = makePool(data, nWorkers)
+    try:
+        with pool:
+            for r in range(rounds):
+                results = list(pool.map(runChain, states, schedules, seeds[r * nReplicas:(r + 1) * nReplicas]))
+                states = [res['finalHubIndex'] for res in results]
+                energies = [res['finalObjective'] for res in results]
+                for i, res in enumerate(results):
+                    traces[i].append(res['trace'].assign(round=r, replica=i))
+                    if res['objective'] < best:
+                        best, bestHubIndex = res['objective'], res['hubIndex']
+                # exchange states between neighbouring temperatures (alternate even / odd pairs)
+                for i in range(r % 2, nReplicas - 1, 2):
+                    delta = (1 / temperatures[i] - 1 / temperatures[i + 1]) * (energies[i] - energies[i + 1])
+                    if delta >= 0 or rng.random() < np.exp(delta):
+                        states[i], states[i + 1] = states[i + 1], states[i]
+                        energies[i], energies[i + 1] = energies[i + 1], energies[i]
+                        swapsAccepted += 1
+                if verbose:
+                    print('round {}: best {:.6g}, replica energies {}'.format(
+                        r, best, ', '.join('{:.4g}'.format(e) for e in energies)))
+    finally:
+        releaseBlocks(blocks)
+
+    return {
+        'hubIndex': bestHubIndex,
+        'objective': best,
+        'swapsAccepted': swapsAccepted,
+        'traces': [pd.concat(t, ignore_index=True) for t in traces],
+    }
@@ -0,0 +1,195 @@
+import hashlib
+import os
+import numpy as np
+import pandas as pd
+
+# Lazy, memoized loading of the optimization inputs prepared in dataPrep.ipynb:
+# * candiInfo - candidate hub locations with land price (data/candiInfo_{region}.shp)
+# * infoGrid - supply and demand per grid cell (data/infoGrid_{region}.csv or .shp)
+# * cost_matrix - network distance from every grid cell to every candidate
+#   (data/costMatrix_{region}.cmx, .npy or .csv)
+#
+# Nothing is read at import time. The first access to an attribute reads the
+# files it needs; the compact arrays are also written to
+# data/problemData_{region}.npz so other processes (pool workers, new R
+# sessions) skip the shapefiles entirely.
+#
+# usage:
+#   data = loadProblemData('ams')
+#   data.supply, data.demand, data.pPerSqm, data.cost_matrix
+
+regions = ('ams', 'nl')
+arrayNames = ('supply', 'demand', 'pPerSqm', 'candiCoords', 'gridCoords')
+
+
+class ProblemData:
+    def __init__(self, region='ams', dataDir='data'):
+        if region not in regions:
+            raise ValueError('unknown region {!r}, expected one of {}'.format(region, regions))
+        self.region = region
+        self.dataDir = dataDir
+        self._arrays = None
+        self._cost_matrix = None
+        self._candiInfo = None
+        self._infoGrid = None
+        self._dataTag = None
+
+    def path(self, name):
+        return os.path.join(self.dataDir, name.format(region=self.region))
+
+    # ---------- GEODATAFRAMES (only read when asked for) ----------
+    @property
+    def candiInfo(self):
+        if self._candiInfo is None:
+            import geopandas as gpd
+            self._candiInfo = gpd.read_file(self.path('candiInfo_{region}.shp'))
+        return self._candiInfo
+
+    @property
+    def infoGrid(self):
+        if self._infoGrid is None:
+            self._infoGrid = readInfoGrid(self.path('infoGrid_{region}.csv'), self.path('infoGrid_{region}.shp'))
+        return self._infoGrid
+
+    # ---------- COMPACT ARRAYS ----------
+    def _sourceFiles(self):
+        return [f for f in (self.path('candiInfo_{region}.shp'), self.path('infoGrid_{region}.csv'),
+                            self.path('infoGrid_{region}.shp')) if os.path.exists(f)]
+
+    def _loadArrays(self):
+        cachePath = self.path('problemData_{region}.npz')
+        sources = self._sourceFiles()
+        if os.path.exists(cachePath) and all(os.path.getmtime(cachePath) >= os.path.getmtime(f) for f in sources):
+            with np.load(cachePath) as cached:
+                return {name: cached[name] for name in arrayNames}
+
+        infoGrid = self.infoGrid
+        candiInfo = self.candiInfo
+        arrays = {
+            'supply': infoGrid.totKgSupply.to_numpy(dtype=float),
+            'demand': infoGrid.totKgDemand.to_numpy(dtype=float),
+            'pPerSqm': candiInfo.pPerSqm.to_numpy(dtype=float),
+            'candiCoords': np.column_stack([candiInfo.geometry.x, candiInfo.geometry.y]),
+            'gridCoords': np.column_stack([infoGrid.x, infoGrid.y]),
+        }
+        try:
+            np.savez(cachePath, **arrays)
+        except OSError:
+            pass # read-only data dir, keep the arrays in memory only
+        return arrays
+
+    def _array(self, name):
+        if self._arrays is None:
+            self._arrays = self._loadArrays()
+        return self._arrays[name]
+
+    @property
+    def supply(self):
+        return self._array('supply')
+
+    @property
+    def demand(self):
+        return self._array('demand')
+
+    @property
+    def pPerSqm(self):
+        return self._array('pPerSqm')
+
+    @property
+    def candiCoords(self):
+        return self._array('candiCoords')
+
+    @property
+    def gridCoords(self):
+        return self._array('gridCoords')
+
+    @property
+    def nCells(self):
+        return len(self.supply)
+
+    @property
+    def nCandi(self):
+        return len(self.pPerSqm)
+
+    def dataTag(self):
+        '''Short hash of the inputs of the objective, to tell cached values of other data apart.
+
+        Covers supply, demand and pPerSqm and the size and mtime of the cost matrix file.
+        '''
+        if self._dataTag is None:
+            h = hashlib.sha256()
+            for name in ('supply', 'demand', 'pPerSqm'):
+                h.update(np.ascontiguousarray(self._array(name), dtype=float).tobytes())
+            for path in (self.path('costMatrix_{region}.cmx'), self.path('costMatrix_{region}.npy'),
+                         self.path('costMatrix_{region}.csv')):
+                if os.path.exists(path): # the file readCostMatrix reads
+                    h.update('{} {} {}'.format(os.path.basename(path), os.path.getsize(path),
+                                               os.path.getmtime(path)).encode())
+                    break
+            self._dataTag = h.hexdigest()[:12]
+        return self._dataTag
+
+    # ---------- COST MATRIX ----------
+    @property
+    def cost_matrix(self):
+        if self._cost_matrix is None:
+            cost_matrix = readCostMatrix(self.path('costMatrix_{region}.cmx'), self.path('costMatrix_{region}.npy'),
+                                         self.path('costMatrix_{region}.csv'))
+            if cost_matrix.shape != (self.nCells, self.nCandi):
+                raise ValueError('cost matrix for {} has shape {}, expected (infoGrid cells, candidates) = {}'.format(
+                    self.region, cost_matrix.shape, (self.nCells, self.nCandi)))
+            self._cost_matrix = cost_matrix
+        return self._cost_matrix
+
+
+# ---------- READERS ----------
+def readInfoGrid(csvPath, shpPath):
+    # the csv holds exactly the cells the cost matrix was built for, so prefer it
+    if os.path.exists(csvPath):
+        infoGrid = pd.read_csv(csvPath, index_col=0)
+    elif os.path.exists(shpPath):
+        import geopandas as gpd
+        infoGrid = gpd.read_file(shpPath)
+        infoGrid = infoGrid.rename(columns={'totKgDeman': 'totKgDemand',
+                                            'totKgSuppl': 'totKgSupply'})
+        infoGrid['x'] = infoGrid.geometry.x
+        infoGrid['y'] = infoGrid.geometry.y
+    else:
+        raise FileNotFoundError('no infoGrid file found: {} or {}'.format(csvPath, shpPath))
+    missing = {'totKgSupply', 'totKgDemand'} - set(infoGrid.columns)
+    if missing:
+        raise ValueError('infoGrid has no {} column(s) - rerun dataPrep.ipynb'.format(', '.join(sorted(missing))))
+    return infoGrid.reset_index(drop=True)
+
+
+def readCostMatrix(cmxPath, npyPath, csvPath):
+    # memory-mapped store first (see costMatrixStore.py), then the makeCostMatrix outputs
+    if os.path.exists(cmxPath):
+        from costMatrixStore import openCostMatrix
+        return openCostMatrix(cmxPath)
+    if os.path.exists(npyPath):
+        return np.load(npyPath, mmap_mode='r')
+    if os.path.exists(csvPath):
+        return pd.read_csv(csvPath, index_col=0).to_numpy(dtype=float)
+    raise FileNotFoundError('no cost matrix found: {}, {} or {}'.format(cmxPath, npyPath, csvPath))
+
+
+# ---------- CANDIDATE INDEX STRINGS ----------
+def indexesToStr(hubIndex):
+    # 1-based and comma separated, like firstGuesses_ams.csv
+    return ','.join(str(int(i) + 1) for i in sorted(hubIndex))
+
+
+def strToIndexes(s):
+    return np.array([int(i) - 1 for i in str(s).split(',')], dtype=np.intp)
+
+
+# ---------- MEMOIZED ACCESS ----------
+_problemData = {}
+
+def loadProblemData(region='ams', dataDir='data'):
+    '''Return the (lazily loaded) ProblemData for region, one instance per region and data dir.'''
+    key = (region, os.path.abspath(dataDir))
+    if key not in _problemData:
+        _problemData[key] = ProblemData(region, dataDir)
+    return _problemData[key]
@@ -0,0 +1,109 @@
+import numpy as np
+
+# Vectorized raster lookup for pricing candidate sites.
+#
+# dataPrep.ipynb clipped the IBIS sites to the raster extent and called
+# raster.sample on a list of coordinate pairs. Here the row/col of all points
+# come from the inverse affine transform in one array operation:
+#   x = a * col + b * row + c
+#   y = d * col + e * row + f
+# (rasterio's Affine order). Only the window of the band that covers the
+# points is read from a GeoTIFF. Nearest sampling returns the value of the
+# pixel under the point, like rasterio's sample; bilinear interpolates between
+# the four surrounding pixel centres. Points outside the raster or on nodata
+# get NaN.
+#
+# usage:
+#   raster = readRaster('results/landPrice_pk_kriging_exponential.tif', coords)
+#   candiInfo['pPerSqm'] = raster.sample(coords, method='bilinear')
+#   repriceCandidates(candiInfo, 'results/landPrice_pk_kriging_exponential.tif')
+
+
+def rowCol(transform, coords):
+    '''Fractional (row, col) of every point; pixel (i, j) spans [i, i + 1) x [j, j + 1).'''
+    a, b, c, d, e, f = transform[:6]
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    x, y = coords[:, 0] - c, coords[:, 1] - f
+    det = a * e - b * d
+    return (a * y - d * x) / det, (e * x - b * y) / det
+
+
+class Raster:
+    def __init__(self, band, transform, nodata=None):
+        self.band = band
+        self.transform = tuple(float(t) for t in transform[:6]) # a, b, c, d, e, f
+        self.nodata = nodata
+
+    @property
+    def shape(self):
+        return self.band.shape
+
+    @property
+    def bounds(self):
+        '''(xmin, ymin, xmax, ymax) of the pixel corners.'''
+        a, b, c, d, e, f = self.transform
+        rows, cols = self.shape
+        corners = np.array([[0, 0], [cols, 0], [0, rows], [cols, rows]], dtype=float)
+        x = a * corners[:, 0] + b * corners[:, 1] + c
+        y = d * corners[:, 0] + e * corners[:, 1] + f
+        return x.min(), y.min(), x.max(), y.max()
+
+    def rowCol(self, coords):
+        return rowCol(self.transform, coords)
+
+    def _values(self, row, col):
+        values = self.band[row, col].astype(float)
+        if self.nodata is not None:
+            values[values == self.nodata] = np.nan
+        return values
+
+    def sample(self, coords, method='nearest'):
+        '''Raster value at every point, aligned with coords.'''
+        row, col = self.rowCol(coords)
+        nRows, nCols = self.shape
+        out = np.full(len(row), np.nan)
+        if method == 'nearest':
+            i, j = np.floor(row).astype(np.intp), np.floor(col).astype(np.intp)
+            inside = (i >= 0) & (i < nRows) & (j >= 0) & (j < nCols)
+            out[inside] = self._values(i[inside], j[inside])
+            return out
+        if method != 'bilinear':
+            raise ValueError('unknown method {!r}, expected nearest or bilinear'.format(method))
+        inside = (row >= 0) & (row <= nRows) & (col >= 0) & (col <= nCols)
+        # between pixel centres; beyond the outer centres the edge pixels are used
+        r = np.clip(row[inside] - 0.5, 0, nRows - 1)
+        c = np.clip(col[inside] - 0.5, 0, nCols - 1)
+        i0 = np.minimum(np.floor(r).astype(np.intp), max(nRows - 2, 0))
+        j0 = np.minimum(np.floor(c).astype(np.intp), max(nCols - 2, 0))
+        i1, j1 = np.minimum(i0 + 1, nRows - 1), np.minimum(j0 + 1, nCols - 1)
+        fr, fc = r - i0, c - j0
+        out[inside] = ((1 - fr) * (1 - fc) * self._values(i0, j0) + (1 - fr) * fc * self._values(i0, j1) +
+                       fr * (1 - fc) * self._values(i1, j0) + fr * fc * self._values(i1, j1))
+        return out
+
+
+def readRaster(path, coords=None, band=1):
+    '''Read a GeoTIFF band; with coords only the window covering them (plus one pixel).'''
+    import rasterio
+    from rasterio.windows import Window
+    with rasterio.open(path) as src:
+        transform = src.transform
+        if coords is None:
+            return Raster(src.read(band), transform, src.nodata)
+        row, col = rowCol(transform, coords)
+        row0 = int(np.clip(np.floor(np.nanmin(row)) - 1, 0, src.height))
+        row1 = int(np.clip(np.ceil(np.nanmax(row)) + 1, row0, src.height))
+        col0 = int(np.clip(np.floor(np.nanmin(col)) - 1, 0, src.width))
+        col1 = int(np.clip(np.ceil(np.nanmax(col)) + 1, col0, src.width))
+        window = Window(col0, row0, col1 - col0, row1 - row0)
+        return Raster(src.read(band, window=window), src.window_transform(window), src.nodata)
+
+
+def pointCoords(gdf):
+    return np.column_stack([gdf.geometry.x, gdf.geometry.y])
+
+
+def repriceCandidates(candiInfo, rasterPath, method='nearest'):
+    '''Land price of every candidate from a raster, as an array aligned with candiInfo.'''
+    coords = pointCoords(candiInfo)
+    return readRaster(rasterPath, coords).sample(coords, method)
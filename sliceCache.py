@@ -0,0 +1,132 @@
+from collections import OrderedDict
+import numpy as np
+
+# LRU cache of nearest-hub assignments for sets of open hubs.
+#
+# For every hub set it keeps the nearest-hub assignment (cellHub, cellDist).
+# Entries are keyed by the sorted hub tuple, so a set that is revisited - or
+# the same set in a different order - skips both the column gather and the
+# argmin.
+#
+# Every entry is also indexed under each of its subsets with one hub left out.
+# A set that differs from a cached set by one swap (what the annealer proposes
+# from its current state) is derived from it: only the cells of the hub that
+# left are assigned again, the other cells are compared with the new hub's
+# column. This is what makes the cache useful behind MemoizedObjective, which
+# already answers exact revisits.
+#
+# Because the key ignores hub order, ties between equally distant hubs go to
+# the lowest candidate index (instead of the first hub in the given order).
+#
+# usage:
+#   cache = SliceCache(cost_matrix, maxBytes=512 * 2**20)
+#   cellHub, cellDist = cache.assignCells(hubIndex)
+#   cache.stats() # hits, derived, misses, hitRate, ...
+
+defaultMaxBytes = 256 * 2**20
+
+
+class SliceCache:
+    def __init__(self, cost_matrix, maxBytes=defaultMaxBytes):
+        self.cost_matrix = cost_matrix
+        self.maxBytes = maxBytes
+        self.entries = OrderedDict()
+        self.subsets = {} # hub set with one hub left out -> key of a cached set
+        self.clear()
+
+    @staticmethod
+    def key(hubIndex):
+        return tuple(sorted(int(h) for h in hubIndex))
+
+    @staticmethod
+    def leaveOneOut(key):
+        return [(key[:i] + key[i + 1:], key[i]) for i in range(len(key))]
+
+    def lookup(self, hubIndex):
+        '''Return (cellHub, cellDist) for hubIndex.'''
+        key = self.key(hubIndex)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry
+
+        hubs = np.array(key, dtype=np.intp)
+        for subset, added in self.leaveOneOut(key):
+            parent = self.subsets.get(subset)
+            if parent is not None:
+                self.derived += 1
+                self.entries.move_to_end(parent)
+                removed = (set(parent) - set(subset)).pop()
+                entry = self.swap(self.entries[parent], hubs, removed, added)
+                break
+        else:
+            self.misses += 1
+            subMatrix = np.asarray(self.cost_matrix[:, hubs], dtype=float)
+            nearest = np.argmin(subMatrix, axis=1)
+            entry = (hubs[nearest], subMatrix[np.arange(len(nearest)), nearest])
+        self.insert(key, entry)
+        return entry
+
+    def swap(self, entry, hubs, removed, added):
+        '''Assignment after replacing hub removed by hub added in a cached assignment.'''
+        cellHub, cellDist = entry[0].copy(), entry[1].copy()
+        # cells of the removed hub: nearest of all hubs of the new set
+        moved = np.flatnonzero(cellHub == removed)
+        if len(moved):
+            subMatrix = np.asarray(self.cost_matrix[np.ix_(moved, hubs)], dtype=float)
+            nearest = np.argmin(subMatrix, axis=1)
+            cellHub[moved] = hubs[nearest]
+            cellDist[moved] = subMatrix[np.arange(len(moved)), nearest]
+        # other cells: the new hub if it is closer (or as close and a lower index)
+        column = np.asarray(self.cost_matrix[:, added], dtype=float)
+        closer = (column < cellDist) | ((column == cellDist) & (added < cellHub))
+        closer[moved] = False
+        cellHub[closer] = added
+        cellDist[closer] = column[closer]
+        return cellHub, cellDist
+
+    def insert(self, key, entry):
+        entryBytes = sum(a.nbytes for a in entry)
+        if entryBytes > self.maxBytes:
+            return
+        self.entries[key] = entry
+        self.nBytes += entryBytes
+        for subset, _ in self.leaveOneOut(key):
+            self.subsets[subset] = key
+        self._evict()
+
+    def _evict(self):
+        while self.nBytes > self.maxBytes:
+            key, entry = self.entries.popitem(last=False)
+            self.nBytes -= sum(a.nbytes for a in entry)
+            for subset, _ in self.leaveOneOut(key):
+                if self.subsets.get(subset) == key:
+                    del self.subsets[subset]
+            self.evictions += 1
+
+    def assignCells(self, hubIndex):
+        '''Same as costEngine.assignCells, served from the cache when possible.'''
+        return self.lookup(hubIndex)
+
+    def clear(self):
+        self.entries.clear()
+        self.subsets.clear()
+        self.nBytes = 0
+        self.hits = 0
+        self.derived = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self):
+        lookups = self.hits + self.derived + self.misses
+        return {
+            'hits': self.hits,
+            'derived': self.derived,
+            'misses': self.misses,
+            'hitRate': (self.hits + self.derived) / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'entries': len(self.entries),
+            'nBytes': self.nBytes,
+            'maxBytes': self.maxBytes,
+        }
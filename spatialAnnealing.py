@@ -0,0 +1,287 @@
+import time
+import warnings
+import numpy as np
+import pandas as pd
+from deltaEvaluator import DeltaEvaluator
+from problemData import loadProblemData, strToIndexes
+
+# Simulated annealing of hub locations in Python, driving the cost
+# effectiveness objective directly (see deltaEvaluator.py) instead of
+# spsann::optimUSER calling back into costEffectiveness.py via reticulate.
+#
+# The schedule mirrors spsann's scheduleSPSANN: a chain has chainLength x nHubs
+# iterations, the temperature is multiplied by temperatureDecrease after every
+# chain, the jitter window shrinks linearly from xMax/yMax to xMin/yMin over
+# the chains, and the run stops after `stopping` chains without improvement.
+#
+# With initialTemperature=None the temperature is calibrated from the start:
+# the objective changes of calibrationMoves moves proposed from it are sampled
+# and the temperature is set so that, on average, a share of them three
+# quarters up the initialAcceptance window would be accepted (0.98 for the
+# spsann window 0.95 - 0.99). Not the middle: from a first guess the first chain
+# mostly descends, so fewer moves go downhill as it runs (45 hubs in ams,
+# 20 seeds: aiming at the middle gave 0.95 on average). The objective is a ratio
+# of order 1e-3 whose changes per move depend on the number of hubs and the
+# transport model (ams, k-means first guesses: calibrated temperatures of about
+# 5e-4 for 10 hubs and 1e-4 for 45), so no fixed temperature fits every run.
+#
+# usage:
+#   schedule = scheduleSPSANN(initialTemperature=None) # calibrated per start
+#   res = optimizeHubs(firstGuess(45), schedule=schedule)
+#   res['hubIndex'], res['objective'], res['trace']
+
+
+# ---------- SCHEDULE ----------
+def scheduleSPSANN(initialAcceptance=(0.95, 0.99), initialTemperature=0.001, temperatureDecrease=0.95,
+                   chains=500, chainLength=1, stopping=10, xMax=None, xMin=0, yMax=None, yMin=0,
+                   swapProbability=0.2):
+    '''Annealing schedule with the knobs (and defaults) of spsann::scheduleSPSANN.
+
+    xMax/yMax default to half the extent of the candidate sites. swapProbability
+    is the share of moves that relocate a hub to any closed candidate; the other
+    moves jitter it to a candidate within the current window. initialTemperature
+    None calibrates it from the start (see calibrateTemperature).
+    '''
+    return {
+        'initialAcceptance': initialAcceptance, 'initialTemperature': initialTemperature,
+        'temperatureDecrease': temperatureDecrease, 'chains': chains, 'chainLength': chainLength,
+        'stopping': stopping, 'xMax': xMax, 'xMin': xMin, 'yMax': yMax, 'yMin': yMin,
+        'swapProbability': swapProbability,
+    }
+
+
+# ---------- STARTING SOLUTIONS ----------
+def readFirstGuesses(path='data/firstGuesses_ams.csv'):
+    '''Return {nHubs: 0-based candiInfo indexes} from a firstGuesses csv (stored 1-based for R).'''
+    firstGuesses = pd.read_csv(path, index_col=0)
+    return {int(row.nHubs): strToIndexes(row.candiIndexes) for row in firstGuesses.itertuples()}
+
+
+def firstGuess(nHubs, region='ams', dataDir='data'):
+    return readFirstGuesses('{}/firstGuesses_{}.csv'.format(dataDir, region))[nHubs]
+
+
+def uniqueHubs(hubIndex, candiCoords):
+    '''Replace repeated hubs by the nearest candidate that is not open yet.
+
+    k-means first guesses can snap two centroids onto the same candidate.
+    '''
+    hubIndex = np.array(hubIndex, dtype=np.intp)
+    isOpen = np.zeros(len(candiCoords), dtype=bool)
+    for i, hub in enumerate(hubIndex):
+        if isOpen[hub]:
+            closed = np.flatnonzero(~isOpen)
+            hub = closed[np.argmin(((candiCoords[closed] - candiCoords[hub]) ** 2).sum(axis=1))]
+            hubIndex[i] = hub
+        isOpen[hub] = True
+    return hubIndex
+
+
+# ---------- MOVES ----------
+def proposeCandidate(rng, hub, closed, candiCoords, window, swapProbability):
+    # swap: any closed candidate; relocate: a closed candidate within the jitter window
+    if rng.random() < swapProbability:
+        return rng.choice(closed)
+    offset = np.abs(candiCoords[closed] - candiCoords[hub])
+    nearby = closed[(offset[:, 0] <= window[0]) & (offset[:, 1] <= window[1])]
+    if len(nearby) == 0:
+        return None
+    return rng.choice(nearby)
+
+
+# ---------- INITIAL TEMPERATURE ----------
+calibrationMoves = 200
+calibrationTarget = 0.75 # position in the initialAcceptance window
+
+def targetAcceptance(schedule):
+    low, high = schedule['initialAcceptance']
+    return low + calibrationTarget * (high - low)
+
+
+def sampleDeltas(evaluator, isOpen, rng, candiCoords, window, swapProbability, moves=calibrationMoves):
+    # objective changes of moves proposed from the current state; none is committed
+    deltas = []
+    for _ in range(moves):
+        hub = evaluator.hubIndex[rng.integers(len(evaluator.hubIndex))]
+        candidate = proposeCandidate(rng, hub, np.flatnonzero(~isOpen), candiCoords, window, swapProbability)
+        if candidate is None:
+            continue
+        deltas.append(evaluator.proposeMove(hub, candidate) - evaluator.costEffectiveness)
+        evaluator.rollback()
+    return np.array(deltas)
+
+
+def temperatureForAcceptance(deltas, acceptance):
+    '''Temperature at which the Metropolis criterion accepts, on average, this share of moves with these deltas.'''
+    uphill = deltas[deltas > 0]
+    if len(uphill) == 0 or np.mean(deltas <= 0) >= acceptance:
+        # any temperature would do; scale to the typical change
+        typical = np.median(np.abs(deltas[deltas != 0])) if np.any(deltas != 0) else 1.0
+        return float(typical / -np.log(acceptance))
+    def accepted(logT):
+        return (len(deltas) - len(uphill) + np.exp(-uphill / np.exp(logT)).sum()) / len(deltas)
+    # acceptance grows with the temperature: bisect on log T
+    low, high = np.log(uphill.min()) - 10, np.log(uphill.max()) + 10
+    for _ in range(60):
+        middle = (low + high) / 2
+        low, high = (middle, high) if accepted(middle) < acceptance else (low, middle)
+    return float(np.exp(high))
+
+
+def calibrateTemperature(startHubIndex, region='ams', schedule=None, seed=None, data=None, transport=None,
+                         acceptance=None, moves=calibrationMoves):
+    '''Initial temperature for startHubIndex, from the objective changes of sampled moves.
+
+    Moves are drawn like those of the first chain of schedule; acceptance
+    defaults to targetAcceptance(schedule).
+    '''
+    schedule = scheduleSPSANN() if schedule is None else schedule
+    data = loadProblemData(region) if data is None else data
+    transport = defaultTransport() if transport is None else transport
+    acceptance = targetAcceptance(schedule) if acceptance is None else acceptance
+    hubIndex = uniqueHubs(startHubIndex, data.candiCoords)
+    evaluator = DeltaEvaluator(hubIndex, data.supply, data.demand, data.pPerSqm, data.cost_matrix, transport)
+    isOpen = np.zeros(data.nCandi, dtype=bool)
+    isOpen[evaluator.hubIndex] = True
+    deltas = sampleDeltas(evaluator, isOpen, np.random.default_rng(seed), data.candiCoords,
+                          firstWindow(schedule, data.candiCoords), schedule['swapProbability'], moves)
+    return temperatureForAcceptance(deltas, acceptance)
+
+
+# ---------- OPTIMIZATION ----------
+def defaultTransport():
+    # the transport model calcTotCostEffectiveness uses (see costEffectiveness.py)
+    import costEffectiveness
+    return costEffectiveness.transportModel
+
+
+def firstWindow(schedule, candiCoords):
+    # xMax/yMax default to half the extent of the candidates
+    extent = candiCoords.max(axis=0) - candiCoords.min(axis=0)
+    return (extent[0] / 2 if schedule['xMax'] is None else schedule['xMax'],
+            extent[1] / 2 if schedule['yMax'] is None else schedule['yMax'])
+
+
+def optimizeHubs(startHubIndex, region='ams', schedule=None, seed=None, data=None, verbose=False, transport=None):
+    '''Anneal the open hubs starting from startHubIndex (0-based candiInfo indexes).
+
+    Repeated hubs in the start are first replaced with uniqueHubs. transport
+    defaults to costEffectiveness.transportModel, so the annealed objective is
+    the one calcTotCostEffectiveness reports.
+
+    Returns a dict with the best hubIndex, its objective, the final hubIndex and
+    a per-chain trace (temperature, acceptance rate, current and best objective).
+    '''
+    schedule = scheduleSPSANN() if schedule is None else schedule
+    data = loadProblemData(region) if data is None else data
+    rng = np.random.default_rng(seed)
+    candiCoords = data.candiCoords
+    xMax, yMax = firstWindow(schedule, candiCoords)
+
+    timeStart = time.time()
+    startHubIndex = uniqueHubs(startHubIndex, candiCoords)
+    transport = defaultTransport() if transport is None else transport
+    evaluator = DeltaEvaluator(startHubIndex, data.supply, data.demand, data.pPerSqm, data.cost_matrix, transport)
+    nHubs = len(evaluator.hubIndex)
+    isOpen = np.zeros(data.nCandi, dtype=bool)
+    isOpen[evaluator.hubIndex] = True
+    current = evaluator.costEffectiveness
+    best, bestHubIndex = current, evaluator.hubIndex.copy()
+    temperature = schedule['initialTemperature']
+    if temperature is None:
+        deltas = sampleDeltas(evaluator, isOpen, rng, candiCoords, (xMax, yMax), schedule['swapProbability'])
+        temperature = temperatureForAcceptance(deltas, targetAcceptance(schedule))
+    initialTemperature = temperature
+    iterationsPerChain = schedule['chainLength'] * nHubs
+    nChains = schedule['chains']
+    trace = []
+    chainsWithoutImprovement = 0
+    iterations = 0
+
+    for chain in range(nChains):
+        # jitter window shrinks linearly from max to min over the chains
+        shrink = chain / max(nChains - 1, 1)
+        window = (xMax - (xMax - schedule['xMin']) * shrink, yMax - (yMax - schedule['yMin']) * shrink)
+        accepted = 0
+        improved = False
+        for _ in range(iterationsPerChain):
+            iterations += 1
+            hub = evaluator.hubIndex[rng.integers(nHubs)]
+            candidate = proposeCandidate(rng, hub, np.flatnonzero(~isOpen), candiCoords, window,
+                                         schedule['swapProbability'])
+            if candidate is None:
+                continue
+            proposed = evaluator.proposeMove(hub, candidate)
+            # Metropolis criterion, as in spsann
+            if proposed <= current or rng.random() < np.exp(-(proposed - current) / temperature):
+                evaluator.commit()
+                isOpen[hub], isOpen[candidate] = False, True
+                current = proposed
+                accepted += 1
+                if current < best:
+                    best, bestHubIndex = current, evaluator.hubIndex.copy()
+                    improved = True
+            else:
+                evaluator.rollback()
+
+        acceptance = accepted / iterationsPerChain
+        trace.append({'chain': chain, 'temperature': temperature, 'acceptance': acceptance,
+                      'objective': current, 'best': best})
+        if verbose:
+            print('chain {}: temperature {:.4g}, acceptance {:.2f}, current {:.6g}, best {:.6g}'.format(
+                chain, temperature, acceptance, current, best))
+        if chain == 0:
+            low, high = schedule['initialAcceptance']
+            if acceptance < low:
+                warnings.warn('initial acceptance {:.2f} below {}: increase initialTemperature'.format(acceptance, low))
+            elif acceptance > high:
+                warnings.warn('initial acceptance {:.2f} above {}: decrease initialTemperature'.format(acceptance, high))
+
+        chainsWithoutImprovement = 0 if improved else chainsWithoutImprovement + 1
+        if chainsWithoutImprovement >= schedule['stopping']:
+            break
+        temperature *= schedule['temperatureDecrease']
+
+    elapsed = time.time() - timeStart
+    return {
+        'hubIndex': bestHubIndex,
+        'objective': best,
+        'finalHubIndex': evaluator.hubIndex.copy(),
+        'finalObjective': current,
+        'initialTemperature': initialTemperature,
+        'trace': pd.DataFrame(trace),
+        'iterations': iterations,
+        'elapsed': elapsed,
+        'iterationsPerSecond': iterations / elapsed if elapsed > 0 else float('inf'),
+    }
+
+
+# ---------- RESULTS ----------
+def saveResPoints(hubIndex, path, region='ams', data=None):
+    '''Write the chosen hubs as points, like results/resPoints_45.shp from the R script.'''
+    import geopandas as gpd
+    data = loadProblemData(region) if data is None else data
+    coords = data.candiCoords[hubIndex]
+    resPoints = gpd.GeoDataFrame({'id': np.asarray(hubIndex) + 1}, # 1-based, as in the R output
+                                 geometry=gpd.points_from_xy(coords[:, 0], coords[:, 1]), crs='EPSG:28992')
+    resPoints.to_file(path)
+    return resPoints
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Anneal hub locations starting from the k-means first guess')
+    parser.add_argument('--region', default='ams')
+    parser.add_argument('--nHubs', type=int, default=45)
+    parser.add_argument('--initialTemperature', type=float, help='default: calibrated from the first guess')
+    parser.add_argument('--chains', type=int, default=500)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--out', help='shapefile for the best hubs, e.g. results/resPoints_45.shp')
+    args = parser.parse_args()
+    res = optimizeHubs(firstGuess(args.nHubs, args.region), args.region,
+                       scheduleSPSANN(initialTemperature=args.initialTemperature, chains=args.chains),
+                       seed=args.seed, verbose=True)
+    print('best cost effectiveness: {:.6g} ({} iterations, {:.0f} per second)'.format(
+        res['objective'], res['iterations'], res['iterationsPerSecond']))
+    if args.out:
+        saveResPoints(res['hubIndex'], args.out, args.region)
@@ -0,0 +1,194 @@
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import os
+import time
+import warnings
+import numpy as np
+import pandas as pd
+import localKriging
+
+# Variogram model selection for the land price kriging.
+#
+# dataPrep.ipynb was rerun by hand for every variogramModel and exponential was
+# picked from the r2 of a single train_test_split(test_size=0.2,
+# random_state=42). Here every model is fitted and scored on nFolds folds in a
+# process pool, one task per (model, fold):
+# * fold 0 holds out exactly the test set of that train_test_split (same
+#   RandomState permutation), the other folds the next, disjoint blocks of it
+# * the variogram is fitted on the training part (localKriging.fitVariogram)
+#   and the held-out sites are kriged from their nNeighbours nearest training
+#   sites (nNeighbours=None kriges globally, one dense system per task)
+# * the pool has no more workers than the free memory holds tasks
+# * fitted parameters are cached in a json file under a hash of the training
+#   data and model, so a rerun only kriges
+# The result is one row per model with mean r2, RMSE and fit time over the
+# folds (and their spread).
+#
+# usage:
+#   python variogramSelection.py --folds 5 --out results/variogramSelection.csv
+#   table, folds = selectVariogram(coords, values)
+
+defaultCachePath = 'results/variogramCache.json'
+
+
+# ---------- FOLDS ----------
+def cvSplits(n, nFolds=5, testSize=0.2, seed=42):
+    '''(train, test) index pairs; fold 0 is train_test_split(test_size, random_state=seed).
+
+    Test sets are disjoint; when nFolds blocks of ceil(testSize * n) do not fit
+    in n, the last fold holds the remaining sites.
+    '''
+    permutation = np.random.RandomState(seed).permutation(n)
+    nTest = int(np.ceil(testSize * n))
+    splits = []
+    for fold in range(nFolds):
+        test = permutation[fold * nTest:(fold + 1) * nTest]
+        if len(test) == 0:
+            raise ValueError('{} folds of {} sites do not fit in {} sites'.format(nFolds, nTest, n))
+        splits.append((np.setdiff1d(permutation, test), np.sort(test)))
+    return splits
+
+
+def r2Score(actual, predicted):
+    return 1 - ((actual - predicted) ** 2).sum() / ((actual - actual.mean()) ** 2).sum()
+
+
+# ---------- MEMORY ----------
+def taskBytes(nTrain, nTest, nNeighbours):
+    '''Rough peak memory of one scoreFold task.'''
+    if nNeighbours is None or nNeighbours >= nTrain:
+        # the (n + 1) system and its LU factors, (test, n + 1) right-hand sides and solutions
+        return 8 * (2 * (nTrain + 1) ** 2 + 3 * nTest * (nTrain + 1))
+    # a batch of (k + 1) systems and the pairwise distances of their neighbours (localKriging.krigeChunk)
+    k = nNeighbours + 1
+    batch = min(nTest, max(1, (1 << 24) // k ** 2))
+    return 8 * 4 * batch * k ** 2
+
+
+def availableMemory():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+    except (AttributeError, ValueError, OSError): # not on this platform
+        return None
+
+
+def poolSize(nWorkers, nTasks, nTrain, nTest, nNeighbours):
+    '''nWorkers (default all cores), at most one per task and as many as the free memory holds.'''
+    workers = min(nWorkers or os.cpu_count(), nTasks)
+    memory = availableMemory()
+    if memory is not None:
+        fit = max(1, int(memory // taskBytes(nTrain, nTest, nNeighbours)))
+        if fit < workers:
+            warnings.warn('{} workers instead of {}: each task needs about {:.0f} MB'.format(
+                fit, workers, taskBytes(nTrain, nTest, nNeighbours) / 2**20))
+            workers = fit
+    return workers
+
+
+# ---------- PARAMETER CACHE ----------
+def fitKey(coords, values, model, nlags):
+    h = hashlib.sha256()
+    for array in (coords, values):
+        h.update(np.ascontiguousarray(array, dtype=float).tobytes())
+    h.update('{}-{}-{}'.format(model, nlags, localKriging.maxFitPoints).encode())
+    return h.hexdigest()[:16]
+
+
+def readCache(path):
+    if path is None or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def writeCache(path, cache):
+    if path is None:
+        return
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(cache, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+# ---------- ONE (MODEL, FOLD) ----------
+def scoreFold(coords, values, train, test, model, fold, nNeighbours, nlags, params=None):
+    '''Fit on train (unless params are given) and score the kriged test sites.'''
+    timeStart = time.time()
+    if params is None:
+        params = localKriging.fitVariogram(coords[train], values[train], model, nlags)
+    fitTime = time.time() - timeStart
+    timeStart = time.time()
+    predicted, _, _ = localKriging.krigePoints(coords[train], values[train], coords[test], model, nNeighbours,
+                                               params, nWorkers=0)
+    actual = values[test]
+    return {
+        'model': model,
+        'fold': fold,
+        'r2': r2Score(actual, predicted),
+        'rmse': float(np.sqrt(((actual - predicted) ** 2).mean())),
+        'fitTime': fitTime,
+        'predictTime': time.time() - timeStart,
+        'params': [float(p) for p in params],
+    }
+
+
+def selectVariogram(coords, values, models=localKriging.variogramModels, nFolds=5,
+                    nNeighbours=localKriging.defaultNeighbours, nlags=localKriging.defaultNLags,
+                    cachePath=defaultCachePath, nWorkers=None):
+    '''Score every variogram model on every fold; returns (table per model, rows per fold).
+
+    nWorkers=0 runs in this process, otherwise the pool is capped by the free
+    memory (see poolSize). fitTime is 0 for parameters from the cache.
+    '''
+    coords = np.asarray(coords, dtype=float)
+    values = np.asarray(values, dtype=float)
+    splits = cvSplits(len(values), nFolds)
+    cache = readCache(cachePath)
+    tasks = []
+    for model in models:
+        for fold, (train, test) in enumerate(splits):
+            key = fitKey(coords[train], values[train], model, nlags)
+            tasks.append((key, (coords, values, train, test, model, fold, nNeighbours, nlags, cache.get(key))))
+
+    if nWorkers == 0:
+        rows = [scoreFold(*args) for _, args in tasks]
+    else:
+        train, test = splits[0]
+        nWorkers = poolSize(nWorkers, len(tasks), len(train), len(test), nNeighbours)
+        with ProcessPoolExecutor(max_workers=nWorkers) as pool:
+            rows = list(pool.map(scoreFold, *zip(*[args for _, args in tasks])))
+    for (key, _), row in zip(tasks, rows):
+        cache[key] = row['params']
+    writeCache(cachePath, cache)
+
+    folds = pd.DataFrame(rows)
+    table = folds.groupby('model', sort=False).agg(
+        r2=('r2', 'mean'), r2Std=('r2', 'std'), rmse=('rmse', 'mean'), rmseStd=('rmse', 'std'),
+        fitTime=('fitTime', 'mean'), predictTime=('predictTime', 'mean')).reset_index()
+    table = table.sort_values('r2', ascending=False).reset_index(drop=True)
+    return table, folds
+
+
+if __name__ == '__main__':
+    import argparse
+    from dataPipeline import Pipeline
+    parser = argparse.ArgumentParser(description='Cross-validate the kriging variogram models on the IBIS land prices')
+    parser.add_argument('--ibis', help='IBIS shapefile, default that of dataPipeline.py')
+    parser.add_argument('--models', nargs='+', default=list(localKriging.variogramModels))
+    parser.add_argument('--folds', type=int, default=5)
+    parser.add_argument('--neighbours', type=int, default=localKriging.defaultNeighbours,
+                        help='krige from this many nearest observations, 0 for global kriging')
+    parser.add_argument('--cache', default=defaultCachePath)
+    parser.add_argument('--workers', type=int, help='default all cores, capped by the free memory')
+    parser.add_argument('--out', default='results/variogramSelection.csv')
+    args = parser.parse_args()
+    ibis = Pipeline(files={'ibis': args.ibis} if args.ibis else None).get('ibis')
+    landPrice = ibis[ibis.MX_VPRIJS > 0]
+    table, folds = selectVariogram(np.column_stack([landPrice.geometry.x, landPrice.geometry.y]),
+                                   landPrice.MX_VPRIJS, args.models, args.folds, args.neighbours or None,
+                                   cachePath=args.cache, nWorkers=args.workers)
+    table.to_csv(args.out, index=False)
+    print(table.to_string(index=False))